@@ -0,0 +1,235 @@
+"""
+Generator for synthetic EDGAR fixtures used by the benchmark suite: quarterly master.gz index files,
+SGML header files, multi-document filing archives with uuencoded binary exhibits, and SC 13D bodies.
+Fixtures are deterministic for a given size and seed, and are laid out like a sectoolkit data
+directory, with the index files under a separate mirror directory that the benchmarks serve over HTTP.
+"""
+
+import os
+import json
+import gzip
+import random
+import binascii
+import numpy as np
+
+
+# Fixture sizes.  rows is the number of index records per quarter.
+sizes = {
+    'small':  {'quarters': 1, 'rows': 100000, 'headers': 200, 'archives': 20, 'bodies': 100},
+    'medium': {'quarters': 2, 'rows': 1000000, 'headers': 2000, 'archives': 100, 'bodies': 1000},
+    'large':  {'quarters': 4, 'rows': 2500000, 'headers': 10000, 'archives': 500, 'bodies': 5000},
+}
+
+# Approximate form type mix of a recent EDGAR quarter.
+form_types = [('4', 0.36), ('8-K', 0.08), ('424B2', 0.08), ('497', 0.05), ('SC 13G/A', 0.05), ('FWP', 0.04),
+              ('D', 0.04), ('6-K', 0.04), ('10-Q', 0.035), ('3', 0.03), ('497K', 0.03), ('13F-HR', 0.02),
+              ('SC 13G', 0.02), ('S-8', 0.01), ('10-K', 0.015), ('SC 13D/A', 0.015), ('SC 13D', 0.005),
+              ('CORRESP', 0.02), ('UPLOAD', 0.02), ('N-PX', 0.03)]
+
+master_header = "Description:           Master Index of EDGAR Dissemination Feed\n" \
+    "Last Data Received:    March 31, 2020\n" \
+    "Comments:              webmaster@sec.gov\n" \
+    "Anonymous FTP:         ftp://ftp.sec.gov/edgar/\n" \
+    "Cloud HTTP:            https://www.sec.gov/Archives/\n\n\n\n\n" \
+    "CIK|Company Name|Form Type|Date Filed|Filename\n" + '-' * 80 + "\n"
+
+_words = ['CAPITAL', 'HOLDINGS', 'PARTNERS', 'GROUP', 'TRUST', 'ENERGY', 'BANCORP', 'TECHNOLOGIES', 'PHARMA',
+          'FUND', 'INVESTMENTS', 'RESOURCES', 'MANAGEMENT', 'SYSTEMS', 'FINANCIAL', 'REALTY', 'MEDICAL', 'GLOBAL']
+_suffixes = ['INC', 'CORP', 'LLC', 'LP', 'LTD', 'CO', 'PLC', 'N.V.', '& CO', 'INC.']
+
+
+def company_name(rnd):
+    return ' '.join([rnd.choice(_words).title() if rnd.random() < 0.2 else rnd.choice(_words) \
+                     for _ in range(rnd.randrange(1, 4))] + [rnd.choice(_suffixes)])
+
+
+def quarter_list(quarters, year = 2020):
+    return [(year, q) for q in range(1, quarters + 1)]
+
+
+def write_master_file(path, rows, year, quarter, seed = 0):
+    """
+    Writes a gzip compressed master index file with the given number of rows.  CIKs follow a skewed
+    distribution over a pool of companies, so that a few filers account for many filings, as in EDGAR.
+    """
+    rng = np.random.default_rng(seed)
+    rnd = random.Random(seed)
+    ncompanies = max(rows // 15, 1000)
+    pool = np.unique(rng.integers(1000, 2000000, size = ncompanies * 2))[:ncompanies]
+    names = [company_name(rnd) for _ in range(len(pool))]
+    which = np.minimum(rng.zipf(1.3, size = rows) - 1, len(pool) - 1)
+    ciks = pool[rng.permutation(len(pool))][which]
+    name_of = dict(zip(pool.tolist(), names))
+    forms = np.array([f for f, _ in form_types])
+    weights = np.array([w for _, w in form_types])
+    form = forms[rng.choice(len(forms), size = rows, p = weights / weights.sum())]
+    first = np.datetime64('%d-%02d-01' % (year, 3 * quarter - 2))
+    days = np.busday_offset(first, rng.integers(0, 60, size = rows), roll = 'forward')
+    dates = np.datetime_as_string(days)
+    agents = rng.integers(1000000, 1999999, size = rows)
+    lines = ['%d|%s|%s|%s|edgar/data/%d/%010d-%02d-%06d.txt\n' % (c, name_of[c], f, d, c, a, year % 100, i) \
+             for i, (c, f, d, a) in enumerate(zip(ciks.tolist(), form.tolist(), dates.tolist(), agents.tolist()))]
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with gzip.open(path + '.tmp', 'wt', encoding = 'latin-1', compresslevel = 6) as f:
+        f.write(master_header)
+        f.writelines(lines)
+    os.replace(path + '.tmp', path)
+
+
+def sgml_header(accession, form_type, cik, rnd):
+    """
+    Returns an SGML header file for a filing, with a subject company and one to three filers.
+    """
+    lines = ['<SEC-HEADER>%s.hdr.sgml : 20200102' % accession, '<ACCEPTANCE-DATETIME>20200102161523',
+             '<ACCESSION-NUMBER>%s' % accession, '<TYPE>%s' % form_type, '<PUBLIC-DOCUMENT-COUNT>4',
+             '<FILING-DATE>20200102', '<DATE-OF-FILING-DATE-CHANGE>20200102']
+
+    def company(role, name, cik):
+        lines.append('<%s>' % role)
+        lines.extend(['<COMPANY-DATA>', '<CONFORMED-NAME>%s' % name, '<CIK>%010d' % cik,
+                      '<ASSIGNED-SIC>%d' % rnd.randrange(1000, 9999), '<IRS-NUMBER>%09d' % rnd.randrange(10 ** 9),
+                      '<STATE-OF-INCORPORATION>DE', '<FISCAL-YEAR-END>1231', '</COMPANY-DATA>',
+                      '<FILING-VALUES>', '<FORM-TYPE>%s' % form_type, '<ACT>34', '<FILE-NUMBER>005-%05d' % (cik % 100000),
+                      '<FILM-NUMBER>20500001', '</FILING-VALUES>',
+                      '<BUSINESS-ADDRESS>', '<STREET1>%d MAIN STREET' % rnd.randrange(1, 9999), '<CITY>NEW YORK',
+                      '<STATE>NY', '<ZIP>10001', '<PHONE>2125550100', '</BUSINESS-ADDRESS>',
+                      '<MAIL-ADDRESS>', '<STREET1>PO BOX %d' % rnd.randrange(1, 999), '<CITY>NEW YORK', '<STATE>NY',
+                      '<ZIP>10001', '</MAIL-ADDRESS>'])
+        for j in range(rnd.randrange(3)):
+            lines.extend(['<FORMER-COMPANY>', '<FORMER-CONFORMED-NAME>%s' % company_name(rnd),
+                          '<DATE-CHANGED>1999070%d' % (j + 1), '</FORMER-COMPANY>'])
+        lines.append('</%s>' % role)
+
+    company('SUBJECT-COMPANY', company_name(rnd), cik)
+    for j in range(rnd.randrange(1, 4)):
+        company('FILED-BY', company_name(rnd), rnd.randrange(1000, 2000000))
+    lines.append('</SEC-HEADER>')
+    return '\n'.join(lines) + '\n'
+
+
+_item_headings = ['Security and Issuer', 'Identity and Background',
+                  'Source and Amount of Funds or Other Consideration', 'Purpose of Transaction',
+                  'Interest in Securities of the Issuer',
+                  'Contracts, Arrangements, Understandings or Relationships With Respect to Securities of the Issuer',
+                  'Material to be Filed as Exhibits']
+_sentence = 'The Reporting Persons acquired the Shares in the ordinary course of business for investment purposes '
+
+
+def sc13d_body(rnd, paragraphs = 6):
+    """
+    Returns the text of an SC 13D filing with cover pages, the seven items and a signature block, in the
+    inconsistent spacing and page footers of typical filings.
+    """
+    parts = ['SECURITIES AND EXCHANGE COMMISSION\nWashington, D.C. 20549\n\nSCHEDULE 13D\n\n'
+             'Under the Securities Exchange Act of 1934\n(Amendment No. %d)*\n\n' % rnd.randrange(10)]
+    for page in range(rnd.randrange(2, 5)):
+        parts.append('CUSIP No. %09d\n\n1  NAMES OF REPORTING PERSONS\n   %s\n\n7  SOLE VOTING POWER\n     %d\n\n'
+                     'page %d of 12 \n' % (rnd.randrange(10 ** 9), company_name(rnd), rnd.randrange(10 ** 7), page + 1))
+    for n, heading in enumerate(_item_headings, 1):
+        sep = rnd.choice(['. ', '.  ', '.\n', ' - '])
+        parts.append('\n\nItem %d%s%s.\n\n' % (n, sep, heading))
+        for _ in range(rnd.randrange(1, paragraphs)):
+            parts.append('  ' + _sentence * rnd.randrange(2, 8) + '\n\n')
+    parts.append('\n\nSIGNATURE\n\nAfter reasonable inquiry and to the best of my knowledge and belief, I certify '
+                 'that the information set forth in this statement is true, complete and correct.\n')
+    return ''.join(parts)
+
+
+def _uuencode(data, filename):
+    lines = ['begin 644 %s' % filename]
+    for i in range(0, len(data), 45):
+        lines.append(binascii.b2a_uu(data[i:i + 45]).decode('ascii').rstrip('\n'))
+    lines.extend(['`', 'end'])
+    return '\n'.join(lines)
+
+
+def filing_archive(accession, header, body, rnd, exhibits = 2, exhibit_size = 100000):
+    """
+    Returns a filing archive (.txt) holding the header, the SC 13D document as HTML, a text exhibit and
+    uuencoded PDF exhibits.
+    """
+    html = '<html><body>' + ''.join('<p>%s</p>' % p.replace('&', '&amp;') for p in body.split('\n\n')) + \
+        '</body></html>'
+    docs = [('SC 13D', 'd%s.htm' % accession[-6:], 'SCHEDULE 13D', html),
+            ('EX-99.1', 'ex99-1.txt', 'JOINT FILING AGREEMENT', _sentence * 40)]
+    for j in range(exhibits):
+        data = rnd.getrandbits(8 * exhibit_size).to_bytes(exhibit_size, 'little')
+        docs.append(('GRAPHIC', 'g%d.pdf' % j, 'GRAPHIC', _uuencode(data, 'g%d.pdf' % j)))
+    parts = ['<SEC-DOCUMENT>%s.txt : 20200102\n' % accession, header]
+    for seq, (doctype, filename, description, text) in enumerate(docs, 1):
+        parts.append('<DOCUMENT>\n<TYPE>%s\n<SEQUENCE>%d\n<FILENAME>%s\n<DESCRIPTION>%s\n<TEXT>\n%s\n</TEXT>\n'
+                     '</DOCUMENT>\n' % (doctype, seq, filename, description, text))
+    parts.append('</SEC-DOCUMENT>\n')
+    return ''.join(parts)
+
+
+def generate(outdir, size = 'small', seed = 0, verbose = False):
+    """
+    Writes the fixtures for one size below outdir/<size> unless they already exist, and returns the
+    fixture description (also saved as fixtures.json), holding the paths and the SEC file names of the
+    generated filings.
+
+    Arguments:
+
+    outdir  :   directory holding the fixtures of all sizes
+    size    :   (default = 'small') one of the keys of sizes
+    seed    :   (default = 0) random seed
+    verbose :   (default = False)
+
+    """
+    params = sizes[size]
+    root = os.path.abspath(os.path.join(outdir, size))
+    descpath = os.path.join(root, 'fixtures.json')
+    if os.path.exists(descpath):
+        with open(descpath) as f:
+            desc = json.load(f)
+        if desc['params'] == params and desc['seed'] == seed:
+            return desc
+
+    rnd = random.Random(seed)
+    mirror = os.path.join(root, 'mirror')
+    datadir = os.path.join(root, 'secdata')
+    quarters = quarter_list(params['quarters'])
+    for year, quarter in quarters:
+        if verbose:
+            print('Writing {} index rows for {} Q{} ...'.format(params['rows'], year, quarter))
+        write_master_file(os.path.join(mirror, 'edgar', 'full-index', str(year), 'QTR%d' % quarter, 'master.gz'), \
+                          params['rows'], year, quarter, seed = seed + quarter)
+    # An empty daily index listing, so that index updates find nothing newer than the quarterly files.
+    for year, quarter in quarters:
+        listing = os.path.join(mirror, 'edgar', 'daily-index', str(year), 'QTR%d' % quarter, 'index.json')
+        os.makedirs(os.path.dirname(listing), exist_ok = True)
+        with open(listing, 'w') as f:
+            json.dump({'directory': {'item': []}}, f)
+
+    if verbose:
+        print('Writing {} header files, {} filing archives and {} SC 13D bodies ...'.format(params['headers'], \
+              params['archives'], params['bodies']))
+    filings = []
+    for k in range(max(params['headers'], params['archives'])):
+        cik = rnd.randrange(1000, 2000000)
+        accession = '%010d-20-%06d' % (rnd.randrange(1000000, 1999999), k)
+        filings.append('edgar/data/%d/%s.txt' % (cik, accession))
+        header = sgml_header(accession, 'SC 13D', cik, rnd)
+        if k < params['headers']:
+            path = os.path.join(datadir, 'headerfiles', str(cik), accession + '.hdr.sgml')
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, 'w', encoding = 'latin-1') as f:
+                f.write(header)
+        if k < params['archives']:
+            path = os.path.join(datadir, 'filings', str(cik), accession + '.txt')
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            with open(path, 'w', encoding = 'latin-1') as f:
+                f.write(filing_archive(accession, header, sc13d_body(rnd), rnd))
+    bodiesdir = os.path.join(root, 'bodies')
+    os.makedirs(bodiesdir, exist_ok = True)
+    for k in range(params['bodies']):
+        with open(os.path.join(bodiesdir, '%06d.txt' % k), 'w', encoding = 'latin-1') as f:
+            f.write(sc13d_body(rnd))
+
+    desc = {'size': size, 'seed': seed, 'params': params, 'root': root, 'mirror': mirror, 'datadir': datadir,
+            'quarters': quarters, 'bodies': bodiesdir, 'headers': filings[:params['headers']],
+            'archives': filings[:params['archives']]}
+    with open(descpath, 'w') as f:
+        json.dump(desc, f)
+    return desc
@@ -0,0 +1,319 @@
+"""
+Offline benchmark suite for sectoolkit.
+
+Times idx.filter_index(), headerfile.get_headerDict(), filingArchive.get_filingArchive() and
+parser_13D.parse() (plus the initial index download and conversion by idx.updateidx()) on synthetic
+EDGAR fixtures of several sizes, and writes throughput and peak memory to a JSON file that can be
+compared across runs.  Index files are served from a local HTTP mirror, so no requests reach the SEC.
+
+Usage:
+
+    python -m benchmarks.run --sizes small medium --output results.json
+    python -m benchmarks.run --sizes small --compare baseline.json
+
+Each benchmark group runs in its own process, so that peak memory figures are not inflated by earlier
+groups.  Fixtures are generated on first use and reused (see benchmarks/fixtures.py).
+"""
+
+import os
+import io
+import sys
+import json
+import glob
+import time
+import shutil
+import resource
+import platform
+import argparse
+import tempfile
+import functools
+import threading
+import statistics
+import subprocess
+import tracemalloc
+import contextlib
+import http.server
+
+from . import fixtures
+
+
+groups = ['updateidx', 'filter_index', 'get_headerDict', 'get_filingArchive', 'parser_13D']
+# Marks the line on which a group process reports its results.
+_result_marker = '@@benchmark-results@@ '
+
+
+class _quiet_handler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def mirror_server(mirror):
+    """
+    Serves the fixture mirror directory over HTTP and points sectoolkit at it for the duration.
+    SimpleHTTPRequestHandler answers conditional GETs with 304, like the SEC website.
+    """
+    from sectoolkit import config
+    handler = functools.partial(_quiet_handler, directory = mirror)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    base_url = config.sec_base_url
+    config.sec_base_url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    try:
+        yield config.sec_base_url
+    finally:
+        config.sec_base_url = base_url
+        server.shutdown()
+
+
+@contextlib.contextmanager
+def _silenced():
+    # Progress bars and timing messages of the library would interleave with the report.
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def _make_idx(desc, datadir):
+    from sectoolkit import idx, worker_pool
+    with _silenced():
+        return idx(datadir = datadir, start_year = desc['quarters'][0][0], end_year = desc['quarters'][-1][0], \
+                   end_quarter = desc['quarters'][-1][1], rate_limiter = None, \
+                   user_agent = 'sectoolkit benchmarks bench@example.com', pool = worker_pool())
+
+
+def _dir_bytes(paths):
+    return sum(os.path.getsize(x) for x in paths)
+
+
+def cases_updateidx(desc, workdir):
+    """
+    Initial download of the quarterly index files from the local mirror and their conversion into
+    columnar stores, posting lists and the company name index.
+    """
+    rows = desc['params']['rows'] * len(desc['quarters'])
+    masters = glob.glob(os.path.join(desc['mirror'], 'edgar', 'full-index', '*', '*', 'master.gz'))
+    datadir = os.path.join(workdir, 'updateidx')
+
+    def prepare():
+        shutil.rmtree(datadir, ignore_errors = True)
+
+    yield {'name': 'updateidx', 'items': rows, 'unit': 'rows', 'bytes': _dir_bytes(masters), \
+           'prepare': prepare, 'run': lambda: _make_idx(desc, datadir)}
+
+
+def cases_filter_index(desc, workdir):
+    """
+    Filters on CIKs (posting list lookups), form types, a date range and the whole index.
+    """
+    import pandas as pd
+    from sectoolkit.idxstore import read_index_store
+    rows = desc['params']['rows'] * len(desc['quarters'])
+    i = _make_idx(desc, os.path.join(desc['root'], 'idx'))
+    sample = read_index_store(i.idxlist[0], {})
+    ciks = sample['CIK'].drop_duplicates().sample(50, random_state = 0).tolist()
+    year, quarter = desc['quarters'][0]
+    start = pd.Timestamp(year, 3 * quarter - 2, 1)
+
+    def run(**kwargs):
+        with _silenced():
+            i.filter_index(**kwargs)
+        return len(i.working_idx)
+
+    yield {'name': 'filter_index/cik', 'items': rows, 'unit': 'rows', 'run': lambda: run(filters = {'CIK': ciks})}
+    yield {'name': 'filter_index/form_type', 'items': rows, 'unit': 'rows', \
+           'run': lambda: run(filters = {'Form Type': ['SC 13D', 'SC 13D/A']})}
+    yield {'name': 'filter_index/date_range', 'items': rows, 'unit': 'rows', \
+           'run': lambda: run(filters = {}, start_date = start, end_date = start + pd.Timedelta(days = 14))}
+    yield {'name': 'filter_index/all', 'items': rows, 'unit': 'rows', 'run': lambda: run(filters = {})}
+    i.pool.close()
+
+
+def cases_get_headerDict(desc, workdir):
+    """
+    Reading and converting cached SGML header files to dictionaries.
+    """
+    from sectoolkit import headerfile
+    from sectoolkit.manifest import cache_manifest
+    manifest = cache_manifest(desc['datadir'])
+    manifest.rebuild()
+    headers = [headerfile(x, datadir = desc['datadir'], rate_limiter = None, manifest = manifest) \
+               for x in desc['headers']]
+    nbytes = _dir_bytes(h.localpath for h in headers)
+
+    def run():
+        for h in headers:
+            h.get_headerDict()
+        return len(headers)
+
+    yield {'name': 'get_headerDict', 'items': len(headers), 'unit': 'files', 'bytes': nbytes, 'run': run}
+
+
+def cases_get_filingArchive(desc, workdir):
+    """
+    Opening cached filing archives, including their header files, and locating all documents.
+    """
+    from sectoolkit import filingArchive
+    from sectoolkit.manifest import cache_manifest
+    manifest = cache_manifest(desc['datadir'])
+    manifest.rebuild()
+    paths = [os.path.join(desc['datadir'], 'filings', *x.split('/')[2:]) for x in desc['archives']]
+
+    def run():
+        documents = 0
+        for sec_filepath in desc['archives']:
+            archive = filingArchive(sec_filepath, datadir = desc['datadir'], ratelimiter = None, manifest = manifest)
+            archive.get_filingArchive(text_only = False)
+            documents += len(archive.files)
+        return documents
+
+    yield {'name': 'get_filingArchive', 'items': len(paths), 'unit': 'archives', 'bytes': _dir_bytes(paths), \
+           'run': run}
+
+
+def cases_parser_13D(desc, workdir):
+    """
+    Parsing the seven items of SC 13D bodies.
+    """
+    from sectoolkit.formparsers import parser_13D
+    paths = sorted(glob.glob(os.path.join(desc['bodies'], '*.txt')))
+    bodies = []
+    for path in paths:
+        with open(path, encoding = 'latin-1') as f:
+            bodies.append(f.read())
+
+    def run():
+        for body in bodies:
+            parser_13D(body).parse()
+        return len(bodies)
+
+    yield {'name': 'parser_13D', 'items': len(bodies), 'unit': 'documents', 'bytes': _dir_bytes(paths), 'run': run}
+
+
+def _measure(case, repeats, trace):
+    times = []
+    for _ in range(repeats):
+        if case.get('prepare'):
+            case['prepare']()
+        start = time.perf_counter()
+        case['run']()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    result = {'benchmark': case['name'], 'items': case['items'], 'unit': case['unit'], \
+              'bytes': case.get('bytes'), 'seconds': best, 'median_seconds': statistics.median(times), \
+              'times': times, 'throughput': case['items'] / best if best > 0 else None}
+    if case.get('bytes'):
+        result['mb_per_second'] = case['bytes'] / best / 1e6 if best > 0 else None
+    if trace:
+        # A separate run, since tracing slows Python code down.  Allocations made by pyarrow and other
+        # native libraries are not traced; peak_rss_bytes covers those.
+        if case.get('prepare'):
+            case['prepare']()
+        tracemalloc.start()
+        case['run']()
+        result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    # ru_maxrss is the high-water mark of the group process so far, in kilobytes on Linux and bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss_bytes'] = rss if sys.platform == 'darwin' else rss * 1024
+    return result
+
+
+def run_group(group, size, repeats, fixturedir, trace = True):
+    """
+    Runs all cases of one benchmark group at one fixture size in the current process and returns the
+    list of results.
+    """
+    desc = fixtures.generate(fixturedir, size)
+    results = []
+    with mirror_server(desc['mirror']), tempfile.TemporaryDirectory() as workdir:
+        for case in globals()['cases_' + group](desc, workdir):
+            result = _measure(case, repeats, trace)
+            result['size'] = size
+            results.append(result)
+    return results
+
+
+def _run_group_process(group, size, args):
+    command = [sys.executable, '-m', 'benchmarks.run', '--group', group, '--sizes', size, '--repeats', \
+               str(args.repeats), '--fixtures', args.fixtures]
+    if args.no_trace:
+        command.append('--no-trace')
+    proc = subprocess.run(command, capture_output = True, text = True, cwd = _repo_root())
+    for line in proc.stdout.splitlines():
+        if line.startswith(_result_marker):
+            return json.loads(line[len(_result_marker):])
+    raise RuntimeError('Benchmark group {} ({}) failed:\n{}'.format(group, size, proc.stderr[-4000:]))
+
+
+def _repo_root():
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _environment(args):
+    import sectoolkit
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, \
+                                cwd = _repo_root()).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'suite': 'sectoolkit-benchmarks', 'version': sectoolkit.__version__, 'git_commit': commit, \
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(), \
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeats': args.repeats, 'sizes': args.sizes}
+
+
+def compare(baseline, results):
+    """
+    Returns a text table comparing the best times of two result sets, by benchmark and size.  Ratios
+    below 1 mean the current run is faster.
+    """
+    before = {(r['benchmark'], r['size']): r for r in baseline['results']}
+    lines = ['{:<26} {:<7} {:>10} {:>10} {:>7}'.format('benchmark', 'size', 'baseline', 'current', 'ratio')]
+    for r in results['results']:
+        old = before.get((r['benchmark'], r['size']))
+        if old is None:
+            continue
+        lines.append('{:<26} {:<7} {:>9.3f}s {:>9.3f}s {:>7.2f}'.format(r['benchmark'], r['size'], \
+                     old['seconds'], r['seconds'], r['seconds'] / old['seconds']))
+    return '\n'.join(lines)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run the sectoolkit benchmark suite on synthetic fixtures.')
+    parser.add_argument('--sizes', nargs = '+', default = ['small'], choices = list(fixtures.sizes))
+    parser.add_argument('--groups', nargs = '+', default = groups, choices = groups)
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--fixtures', default = os.path.join(tempfile.gettempdir(), 'sectoolkit-bench-fixtures'), \
+                        help = 'directory in which fixtures are generated and kept between runs')
+    parser.add_argument('--output', default = 'benchmark-results.json')
+    parser.add_argument('--compare', help = 'earlier results file to compare against')
+    parser.add_argument('--no-trace', action = 'store_true', help = 'skip the tracemalloc peak memory run')
+    parser.add_argument('--group', help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.group:
+        # Group process started by the parent run.
+        results = run_group(args.group, args.sizes[0], args.repeats, args.fixtures, trace = not args.no_trace)
+        print(_result_marker + json.dumps(results))
+        return
+
+    report = _environment(args)
+    report['results'] = []
+    for size in args.sizes:
+        print('Preparing {} fixtures ...'.format(size))
+        fixtures.generate(args.fixtures, size, verbose = True)
+        for group in args.groups:
+            for r in _run_group_process(group, size, args):
+                report['results'].append(r)
+                print('{:<26} {:<7} {:>9.3f}s {:>14,.0f} {}/s  peak rss {:,.0f} MB'.format(r['benchmark'], size, \
+                      r['seconds'], r['throughput'] or 0, r['unit'], r['peak_rss_bytes'] / 1e6))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print('Results written to {}'.format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report))
+
+
+if __name__ == '__main__':
+    main()
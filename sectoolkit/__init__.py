@@ -5,4 +5,10 @@ from .secmeta import (idx, headerfile)
 from .secfiling import (filingDocument, filingArchive)
 from .formparsers import parsers, parser_base
 from .limiter import rate_limiter
-from .utils import get_ticker_name_dicts
\ No newline at end of file
+from .session import sec_session
+from .pool import worker_pool
+from .utils import get_ticker_name_dicts
+from .tickers import ticker_lookup, get_ticker_lookup
+from .textindex import text_index
+from . import metrics
+from . import profiling
@@ -0,0 +1,259 @@
+import os
+import re
+import sys
+import html
+import binascii
+import threading
+from collections import namedtuple, OrderedDict
+
+from bs4 import BeautifulSoup
+
+from . import config
+from . import metrics
+from .cache import map_cached
+from .formparsers import parsers
+
+
+_document_start = b'<DOCUMENT>'
+_document_end = b'</DOCUMENT>'
+_text_start = b'<TEXT>'
+# Document metadata fields appear one per line between <DOCUMENT> and <TEXT>.
+_document_field = re.compile(rb'<(TYPE|SEQUENCE|FILENAME|DESCRIPTION)>([^\r\n]*)', re.I)
+_text_end = b'</TEXT>'
+_uu_begin = re.compile(rb'^begin(-base64)? [0-7]{3,4} ([^\r\n]*)\r?$', re.M)
+_base64_only = re.compile(rb'[A-Za-z0-9+/=\s]*\Z')
+# Documents with these file name suffixes are never treated as base64 encoded.
+_text_suffixes = ('txt', 'htm', 'html', 'xml', 'xsd', 'xbrl', 'js', 'css', 'json', 'paper')
+_acceptance_datetime = re.compile(rb'<ACCEPTANCE-DATETIME>([^\r\n<]*)', re.I)
+# Documents with these file name suffixes hold prose worth full-text indexing.
+_prose_suffixes = ('txt', 'htm', 'html')
+_markup = re.compile(rb'<[^>]*>')
+_whitespace = re.compile(r'\s+')
+
+document_entry = namedtuple('document_entry', \
+    ['start', 'end', 'text', 'type', 'sequence', 'filename', 'description'])
+document_entry.__doc__ = """
+Location and metadata of one <DOCUMENT> in a filing archive.  start and end are byte offsets of the
+document including its <DOCUMENT> tags, text is the offset of its <TEXT> tag (-1 if there is none), and
+missing metadata fields are given as '_'.
+"""
+
+
+def _field_value(value):
+    return html.unescape(value.decode('latin-1')).strip()
+
+
+def scan_documents(data):
+    """
+    Scans the raw bytes of a filing archive (bytes or an mmap) for <DOCUMENT> sections and yields a
+    document_entry for each one, reading TYPE, SEQUENCE, FILENAME and DESCRIPTION from the lines before
+    the document's <TEXT> tag.  Document content is not decoded or parsed, so large embedded binary
+    files cost no more than a substring search.
+    """
+    pos = 0
+    while True:
+        start = data.find(_document_start, pos)
+        if start < 0:
+            return
+        end = data.find(_document_end, start)
+        end = len(data) if end < 0 else end + len(_document_end)
+        text = data.find(_text_start, start, end)
+        fields = {}
+        for m in _document_field.finditer(data, start, text if text >= 0 else end):
+            fields.setdefault(m.group(1).upper(), _field_value(m.group(2)))
+        # Document types repeat across archives, so share one string object per type.
+        yield document_entry(start, end, text, sys.intern(fields.get(b'TYPE') or '_'), fields.get(b'SEQUENCE') or '_', \
+            fields.get(b'FILENAME') or '_', fields.get(b'DESCRIPTION') or '_')
+        pos = end
+
+
+def acceptance_datetime(data):
+    """
+    Returns the acceptance date and time (YYYYMMDDHHMMSS) from the header section of a filing archive,
+    or an empty string if it is not present.
+    """
+    first = data.find(_document_start)
+    m = _acceptance_datetime.search(data, 0, first if first >= 0 else len(data))
+    return _field_value(m.group(1))[:14] if m else ''
+
+
+def document_soup(data, entry):
+    """
+    Parses a single document of a filing archive with BeautifulSoup and returns its <document> element.
+    """
+    soup = BeautifulSoup(data[entry.start:entry.end].decode('latin-1'), 'lxml')
+    return soup.find('document')
+
+
+def document_text(data, entry):
+    """
+    Returns the plain text of one document of a filing archive for full-text indexing, or None for 
+    documents without a text section and for binary, XBRL and other non-prose documents.  Markup is removed 
+    with a regular expression instead of a full HTML parse, entities are unescaped and runs of whitespace 
+    are collapsed, which is far cheaper than document_soup() when many documents are indexed.
+    """
+    if entry.text < 0 or entry.filename.split('.')[-1].lower() not in _prose_suffixes:
+        return None
+    start = entry.text + len(_text_start)
+    stop = data.find(_text_end, start, entry.end)
+    stop = stop if stop >= 0 else entry.end
+    # Some filers uuencode their text documents too.
+    if _uu_begin.search(data, start, min(stop, start + 1024)):
+        return None
+    text = _markup.sub(b' ', data[start:stop]).decode('latin-1')
+    return _whitespace.sub(' ', html.unescape(text)).strip()
+
+
+def _uudecode_line(line):
+    try:
+        return binascii.a2b_uu(line)
+    except binascii.Error:
+        # Some encoders pad lines incorrectly, so decode only as many characters as the length byte implies.
+        nbytes = ((line[0] - 32) & 63) * 4 // 3
+        return binascii.a2b_uu(line[:nbytes + 4])
+
+
+def decode_document(data, entry, f = None):
+    """
+    Decodes the content of one document of a filing archive (bytes or an mmap) from its text section.
+    uuencoded and base64 encoded binary files (PDF, images, spreadsheets, zip files) are decoded to their
+    original bytes; other documents are returned as the raw bytes of their text section.  Only the
+    document's own byte range is read, and uuencoded content is decoded line by line straight from the
+    buffer.  If a writable binary file object f is supplied, the content is written to it and the number
+    of bytes written is returned instead of the content.
+    """
+    out = bytearray()
+    emit = f.write if f is not None else out.extend
+    written = 0
+    if entry.text >= 0:
+        start = entry.text + len(_text_start)
+        stop = data.find(_text_end, start, entry.end)
+        stop = stop if stop >= 0 else entry.end
+        m = _uu_begin.search(data, start, stop)
+        if m and not m.group(1):
+            pos = m.end()
+            while pos < stop:
+                eol = data.find(b'\n', pos, stop)
+                eol = eol if eol >= 0 else stop
+                line = data[pos:eol].rstrip(b'\r')
+                pos = eol + 1
+                if line.rstrip() == b'end':
+                    break
+                # Skip blank lines and the zero length line (a backquote) that closes the content.
+                if line and line[0] != 96:
+                    chunk = _uudecode_line(line)
+                    emit(chunk)
+                    written += len(chunk)
+        else:
+            if m:
+                raw = data[m.end():stop]
+                tail = raw.find(b'====')
+                raw = binascii.a2b_base64(raw[:tail] if tail >= 0 else raw)
+            else:
+                raw = data[start:stop]
+                stripped = raw.translate(None, b' \t\r\n')
+                if entry.filename.split('.')[-1].lower() not in _text_suffixes and stripped \
+                        and len(stripped) % 4 == 0 and _base64_only.match(raw):
+                    try:
+                        raw = binascii.a2b_base64(raw)
+                    except binascii.Error:
+                        raw = raw.lstrip(b'\r\n')
+                else:
+                    raw = raw.lstrip(b'\r\n')
+            emit(raw)
+            written = len(raw)
+    return written if f is not None else bytes(out)
+
+
+def extract_documents(localpath, outdir, document_types = 'ALL', suffixes = None):
+    """
+    Decodes all documents of the requested types (and optionally file name suffixes) from a locally
+    cached filing archive into outdir, keeping their original file names.  Returns the list of files
+    written.  Runs in worker processes for bulk extraction, so it only takes picklable arguments.
+    """
+    written = []
+    with map_cached(localpath) as data:
+        for entry in scan_documents(data):
+            if document_types != 'ALL' and entry.type not in document_types:
+                continue
+            if suffixes and entry.filename.split('.')[-1].lower() not in suffixes:
+                continue
+            os.makedirs(outdir, exist_ok = True)
+            outpath = os.path.join(outdir, os.path.basename(entry.filename))
+            with open(outpath + '.part', 'wb') as f:
+                decode_document(data, entry, f)
+            os.replace(outpath + '.part', outpath)
+            written.append(outpath)
+    return written
+
+
+def parse_archive_documents(localpath, document_types = None):
+    """
+    Parses every document in a locally cached filing archive that has a registered parser (optionally
+    only those of the listed document types) and returns a list of dictionaries holding the document's
+    sequence, file name and type followed by the parsed items.  A document that fails to parse yields a
+    record with an 'Error' entry instead, so that one bad filing does not stop a bulk run.
+    """
+    records = []
+    with map_cached(localpath) as data:
+        for entry in scan_documents(data):
+            if entry.type not in parsers or (document_types and entry.type not in document_types):
+                continue
+            record = {'Sequence': entry.sequence, 'Document': entry.filename, 'Type': entry.type}
+            try:
+                body = document_soup(data, entry).get_text() if entry.text >= 0 else '_'
+                record.update(parsers[entry.type](body).parse())
+            except Exception as e:
+                record['Error'] = '{}: {}'.format(type(e).__name__, e)
+            records.append(record)
+    return records
+
+
+class document_cache(object):
+
+    """
+    Thread-safe least recently used cache for parsed filing documents, bounded by the approximate total
+    size of the cached items in bytes rather than by their number.
+
+    Arguments:
+
+    max_bytes   :   (default = None uses config.document_cache_size, read on every insert) size bound in
+                    bytes; 0 disables caching
+
+    """
+
+    def __init__(self, max_bytes = None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+        metrics.inc('cache_lookups_total', kind = 'document', result = 'miss' if item is None else 'hit')
+        return None if item is None else item[0]
+
+    def put(self, key, value, size):
+        limit = config.document_cache_size if self.max_bytes is None else self.max_bytes
+        if size > limit:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > limit:
+                _, (_, evicted) = self._items.popitem(last = False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+# Shared by all filingDocument objects.
+documents = document_cache()
@@ -0,0 +1,137 @@
+import os
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class record_sink(object):
+
+    """
+    Append-only output for bulk parsing results.  Records (dictionaries) are written as they arrive, so
+    results never have to be held in memory all at once.  A progress file (outpath + '.done') lists the
+    accession numbers whose results have been written completely, which allows an interrupted run to be
+    resumed.
+
+    Arguments:
+
+    outpath :   output path.  Paths ending in '.parquet' are written as a directory of Parquet part files,
+                one per batch, with every value stored as a string; anything else is written as a JSON lines
+                file with one record per line.
+
+    Usage:
+
+    with record_sink('parsed.jsonl') as sink:
+        done = sink.done()
+        sink.write(records, accessions)
+
+    """
+
+    def __init__(self, outpath):
+        self.outpath = outpath
+        self.parquet = outpath.endswith('.parquet')
+        self.donepath = outpath + '.done'
+        self._f = None
+        self._done = None
+        self._part = 0
+
+    def __enter__(self):
+        if self.parquet:
+            os.makedirs(self.outpath, exist_ok = True)
+            self._part = len([x for x in os.listdir(self.outpath) if x.endswith('.parquet')])
+        else:
+            parent = os.path.dirname(self.outpath)
+            if parent:
+                os.makedirs(parent, exist_ok = True)
+            _truncate_partial_line(self.outpath)
+            self._f = open(self.outpath, 'a', encoding = 'utf-8')
+        _truncate_partial_line(self.donepath)
+        self._done = open(self.donepath, 'a', encoding = 'utf-8')
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def done(self):
+        """
+        Returns the set of accession numbers recorded as complete by earlier runs.
+        """
+        if not os.path.exists(self.donepath):
+            return set()
+        with open(self.donepath, encoding = 'utf-8') as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def write(self, records, accessions):
+        """
+        Appends a batch of records and then marks the accessions they came from as complete.  Results are
+        flushed before the progress file is updated, so a crash can at worst repeat one batch on restart; 
+        read_records() drops such repeated records.
+        """
+        if len(records) != 0:
+            if self.parquet:
+                path = os.path.join(self.outpath, 'part-{:06d}.parquet'.format(self._part))
+                pq.write_table(_string_table(records), path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self._part += 1
+            else:
+                self._f.write(''.join(json.dumps(r, default = str) + '\n' for r in records))
+                self._f.flush()
+        if len(accessions) != 0:
+            self._done.write(''.join(x + '\n' for x in accessions))
+            self._done.flush()
+
+    def close(self):
+        for f in (self._f, self._done):
+            if f is not None:
+                f.close()
+        self._f = None
+        self._done = None
+
+
+def _truncate_partial_line(path, blocksize = 65536):
+    # A crash while appending can leave an incomplete last line, which would run into the first line 
+    # appended by the next run.  Cuts the file back to its last newline.
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - blocksize)
+            f.seek(start)
+            block = f.read(pos - start)
+            i = block.rfind(b'\n')
+            if i >= 0:
+                pos = start + i + 1
+                break
+            pos = start
+        if pos != end:
+            f.truncate(pos)
+
+
+def _string_table(records):
+    # Columns depend on the parsers and errors in each batch, and a column that is empty in one batch would 
+    # get a null type, so values are stored as strings and part files are combined by read_records().
+    columns = list(dict.fromkeys(key for record in records for key in record))
+    return pa.table({col: [None if r.get(col) is None else str(r[col]) for r in records] for col in columns}, \
+                    schema = pa.schema([(col, pa.string()) for col in columns]))
+
+
+def read_records(outpath):
+    """
+    Reads the output of a bulk parsing run written by record_sink into a dataframe.  Parquet part files
+    are read one by one and concatenated, so parts with different columns can be combined.  Records of a 
+    batch written again after an interrupted run are dropped (keeping the last copy of each accession 
+    number, document sequence and document file name, as several documents can share a sequence).
+    """
+    if outpath.endswith('.parquet'):
+        parts = sorted(x for x in os.listdir(outpath) if x.endswith('.parquet'))
+        frames = [pd.read_parquet(os.path.join(outpath, x)) for x in parts]
+        records = pd.concat(frames, ignore_index = True) if frames else pd.DataFrame()
+    else:
+        records = pd.read_json(outpath, lines = True, dtype = False)
+    keys = [x for x in ('Accession', 'Sequence', 'Document') if x in records.columns]
+    if keys:
+        records = records.drop_duplicates(keys, keep = 'last').reset_index(drop = True)
+    return records
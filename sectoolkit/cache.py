@@ -0,0 +1,207 @@
+import os
+import io
+import gzip
+import shutil
+import tempfile
+import mmap
+from contextlib import contextmanager
+from time import perf_counter
+
+from . import config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# File name suffixes used for compressed files in the local filing and header caches.
+compression_suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _check_compression(compression):
+    if compression not in (None, 'gzip', 'zstd'):
+        raise ValueError("Cache compression must be None, 'gzip' or 'zstd', not {!r}.".format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("zstd cache compression requires the zstandard package (pip install zstandard).")
+
+
+def cached_path(localpath):
+    """
+    Returns the path under which a cached file is actually stored, which may carry a compression suffix,
+    or None if the file is not present in the cache.
+    """
+    if os.path.exists(localpath):
+        return localpath
+    for suffix in compression_suffixes.values():
+        if os.path.exists(localpath + suffix):
+            return localpath + suffix
+    return None
+
+
+def cache_exists(localpath):
+    """
+    Returns True if a file is present in the local cache in compressed or uncompressed form.
+    """
+    return cached_path(localpath) is not None
+
+
+def _compression_of(path):
+    for compression, suffix in compression_suffixes.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def open_cached(localpath, mode = 'rb'):
+    """
+    Opens a cached file for reading, decompressing it transparently if it is stored compressed.  In text
+    mode ('r') the content is decoded as latin-1, matching the encoding used for downloads.
+    """
+    path = cached_path(localpath)
+    if path is None:
+        raise FileNotFoundError(localpath)
+    compression = _compression_of(path)
+    if compression == 'gzip':
+        f = gzip.open(path, 'rb')
+    elif compression == 'zstd':
+        _check_compression(compression)
+        f = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd = True)
+        f = io.BufferedReader(f)
+    else:
+        f = open(path, 'rb')
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding = 'latin-1', newline = None)
+
+
+def read_cached(localpath, binary = False):
+    """
+    Returns the content of a cached file as a latin-1 decoded string, or as bytes if binary is True.
+    """
+    with open_cached(localpath, 'rb') as f:
+        data = f.read()
+    return data if binary else data.decode('latin-1')
+
+
+@contextmanager
+def map_cached(localpath):
+    """
+    Context manager that provides the raw content of a cached file as a read-only buffer.  Uncompressed
+    files are memory-mapped, so only the pages that are actually touched are read from disk; compressed
+    files are decompressed into memory.
+    """
+    path = cached_path(localpath)
+    if path is None:
+        raise FileNotFoundError(localpath)
+    if _compression_of(path) is not None or os.path.getsize(path) == 0:
+        yield read_cached(localpath, binary = True)
+        return
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        yield m
+    finally:
+        m.close()
+
+
+def remove_cached(localpath):
+    """
+    Deletes a cached file in whatever form it is stored.  Returns True if a file was deleted.
+    """
+    path = cached_path(localpath)
+    if path is None:
+        return False
+    os.remove(path)
+    return True
+
+
+def store_file(srcpath, localpath, compression = None):
+    """
+    Moves a completely downloaded file into the cache under localpath, compressing it on the way if
+    requested.  Any previously cached version of the file, compressed or not, is replaced.  Returns the
+    path of the stored file.
+    """
+    _check_compression(compression)
+    target = localpath + compression_suffixes[compression] if compression else localpath
+    if compression:
+        tmppath = target + '.tmp'
+        with open(srcpath, 'rb') as src, open(tmppath, 'wb') as dst:
+            if compression == 'gzip':
+                with gzip.GzipFile(fileobj = dst, mode = 'wb', compresslevel = 6, mtime = 0) as z:
+                    shutil.copyfileobj(src, z, config.download_chunk_size)
+            else:
+                zstandard.ZstdCompressor(level = 10).copy_stream(src, dst)
+        os.replace(tmppath, target)
+        os.remove(srcpath)
+    else:
+        os.replace(srcpath, target)
+    # Remove stale copies stored under a different compression setting.
+    for other in [localpath] + [localpath + x for x in compression_suffixes.values()]:
+        if other != target and os.path.exists(other):
+            os.remove(other)
+    return target
+
+
+def migrate_cache(localdir, compression = None, verbose = False):
+    """
+    Converts every file in a local cache directory tree to the requested compression (None, 'gzip' or
+    'zstd').  Files that are already stored in the requested form are left alone, so an interrupted
+    migration can simply be run again.  Returns the number of files converted.
+    """
+    _check_compression(compression)
+    converted = 0
+    for root, dirs, files in os.walk(localdir):
+        for fname in files:
+            if fname.endswith('.part') or fname.endswith('.tmp'):
+                continue
+            path = os.path.join(root, fname)
+            current = _compression_of(path)
+            if current == compression:
+                continue
+            localpath = path[:-len(compression_suffixes[current])] if current else path
+            # Decompress to a temporary file first, then store it with the new compression.
+            tmppath = localpath + '.migrate.part'
+            with open_cached(path, 'rb') as src, open(tmppath, 'wb') as dst:
+                shutil.copyfileobj(src, dst, config.download_chunk_size)
+            # store_file() removes the old copy only after the new one is in place.
+            store_file(tmppath, localpath, compression = compression)
+            converted += 1
+            if verbose and converted % 1000 == 0:
+                print('Converted {} files ...'.format(converted))
+    if verbose:
+        print('Converted {} files in {}.'.format(converted, localdir))
+    return converted
+
+
+def benchmark_cache_read(localpaths, compression = 'gzip'):
+    """
+    Measures read throughput of a set of cached files in uncompressed form and in the requested
+    compressed form.  Compressed copies are written to a temporary directory and deleted afterwards.
+    Returns a dictionary with the total uncompressed and on-disk sizes, read times and throughput in
+    MB/s of uncompressed content for both layouts.
+    """
+    _check_compression(compression)
+    if compression is None:
+        raise ValueError("Specify the compression to compare against, 'gzip' or 'zstd'.")
+    results = {'files': 0, 'bytes': 0, 'compressed_bytes': 0}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        copies = []
+        for i, localpath in enumerate(localpaths):
+            raw = os.path.join(tmpdir, '{}.raw'.format(i))
+            with open_cached(localpath, 'rb') as src, open(raw, 'wb') as dst:
+                shutil.copyfileobj(src, dst, config.download_chunk_size)
+            results['bytes'] += os.path.getsize(raw)
+            shutil.copyfile(raw, raw + '.src')
+            stored = store_file(raw + '.src', os.path.join(tmpdir, '{}.cmp'.format(i)), compression)
+            results['compressed_bytes'] += os.path.getsize(stored)
+            copies.append((raw, os.path.join(tmpdir, '{}.cmp'.format(i))))
+            results['files'] += 1
+        for label, index in (('uncompressed', 0), (compression, 1)):
+            start = perf_counter()
+            for item in copies:
+                read_cached(item[index], binary = True)
+            elapsed = perf_counter() - start
+            results[label + '_seconds'] = elapsed
+            results[label + '_mb_per_s'] = results['bytes'] / 1e6 / elapsed if elapsed > 0 else float('inf')
+    return results
@@ -3,6 +3,30 @@ import os
 # Config items
 default_datadir = '.' + os.sep + 'secdata'
 sec_base_url = 'https://www.sec.gov/Archives/'
+sec_tickers_url = 'https://www.sec.gov/files/company_tickers.json'
 binary_file_types = ['gz', 'zip', 'Z']
 sec_rate_limit = 8   # maximum downloads per rate interval
-sec_rate_interval = 1.0  # rate interval in seconds
\ No newline at end of file
+sec_rate_interval = 1.0  # rate interval in seconds
+sec_rate_burst = 1  # maximum number of back to back requests after an idle period
+sec_rate_shared = True  # share one request budget across all processes on the host
+index_row_group_size = 8192  # rows per Parquet row group in the columnar index stores
+sec_max_workers = 8  # maximum number of concurrent file requests
+download_chunk_size = 1 << 20  # bytes read per chunk when streaming downloads to disk
+cache_compression = None  # compression of cached filings and header files: None, 'gzip' or 'zstd'
+document_cache_size = 256 << 20  # approximate bytes of parsed filing documents kept in memory, 0 disables
+pool_backend = 'process'  # worker pool used by idx for CPU bound work: 'process', 'thread' or 'serial'
+pool_max_workers = 0  # number of worker pool workers, 0 uses all CPU cores
+cache_max_bytes = 0  # size budget of the cached filing archives and header files in bytes, 0 for no limit
+cache_max_age = 0  # days since last use after which cached files are evicted, 0 for no limit
+cache_eviction_policy = 'lru'  # 'lru' (least recently used first) or 'lfu' (least frequently used first)
+cache_sweep_interval = 0  # seconds between background eviction sweeps by idx instances, 0 for on demand only
+ticker_max_age = 86400  # seconds after which the cached company tickers table is refreshed in the background
+metrics_enabled = os.environ.get('SECTOOLKIT_METRICS', '') not in ('', '0')  # record metrics (see metrics.py)
+profile_enabled = os.environ.get('SECTOOLKIT_PROFILE', '') not in ('', '0')  # profile stages (see profiling.py)
+profile_memory = True  # also trace memory allocations with tracemalloc while profiling
+profile_dir = os.environ.get('SECTOOLKIT_PROFILE_DIR', 'sectoolkit-profiles')  # where profile reports are written
+sec_rate_adaptive = True  # slow down on throttling responses (HTTP 429/503) and speed up again afterwards
+sec_max_retries = 5  # retries of a failed download after the first attempt
+sec_retry_backoff = 1.0  # base delay in seconds of the jittered exponential backoff between retries
+sec_retry_max_backoff = 60.0  # longest delay in seconds between retries, also for Retry-After
+text_index_on_fetch = False  # add newly fetched filing archives to the full-text index in idx.fetch_filings()
@@ -5,143 +5,102 @@ import re
 
 from .parser_base import parser_base
 
-class parser_13D(parser_base):
-	
-
-	def _cleanFileText(self):
-			
-		text = self.body.get_text()
-		
-		text = unicodedata.normalize("NFKD", text)
-		text = re.sub(r'\n+', '\n',text)
-		text = re.sub(r'\n +', '\n',text)
-		text = re.sub(r'\n+', '\n',text)
-		text = re.sub(r' +', ' ',text)
-	#     text = re.sub(r"&nbsp;", " ", text)
-	#     text = re.sub(r"\n", " ", text)
-		pattern = re.compile(r"(?i)^(Item [1-7]?[.])\s", re.M)
-		text = re.sub(pattern, r'\1 ', text)
-		# Addition: Dec 18, 2018 or so
-		add_the = re.compile(r"(?i)^(Item 5. Interest in Securities of Issuer)\.?", re.M)
-		text = re.sub(add_the, r'Item 5. Interest in Securities of the Issuer.', text)
-		# Remove page numbering footers if present
-		text = re.sub(r'page \d+ of \d+ ', ' ', text, flags = re.IGNORECASE|re.M)
 
-		self.cleanedText = text
-		
-		
-	def _findItems(self):
-		
-		self._cleanFileText()
+# Text cleaning patterns, applied in this order.  Runs of newlines and spaces following a newline collapse
+# into a single newline, which is what the former separate newline and leading-space passes produced.
+_newlines = re.compile(r'\n[\n ]*')
+_spaces = re.compile(r'  +')
+_item_heading = re.compile(r"(?i)^(Item [1-7]?[.])\s", re.M)
+# Addition: Dec 18, 2018 or so
+_add_the = re.compile(r"(?i)^(Item 5. Interest in Securities of Issuer)\.?", re.M)
+# Page numbering footers
+_page_footer = re.compile(r'page \d+ of \d+ ', re.I|re.M)
+
+# Item headings and the normalized headings that replace them in the processed text.
+_items = [
+	(1, re.compile(r"(?i)^Item[^1]?1[^r'Security']*Security[^r'and']*and[^r'Issuer']*Issuer[ \s.]?", re.M|re.S),
+		'Security and Issuer.'),
+	(2, re.compile(r"(?i)^Item[^2]?2[^r'Identity']*Identity[^r'and']*and[^r'Background']*Background[ \s.]?", re.M|re.S),
+		'Identity and Background.'),
+	(3, re.compile(r"(?i)^Item[^3]?3[^r'Source']*Source[^r'and']*and[^r'Amount']*Amount[^r'of']*of[^r'Funds']*Funds[^r'or']*or[^r'Other']*Other[^r'Consideration']*Consideration[ \s.]?", re.M|re.S),
+		'Source and Amount of Funds or Other Consideration.'),
+	(4, re.compile(r"(?i)^Item[^4]?4[^r'Purpose']*Purpose[^r'of']*of[^r'Transaction']*Transaction[ \s.]?", re.M|re.S),
+		'Purpose of Transaction.'),
+	(5, re.compile(r"(?i)^Item[^5]?5[^r'Interest']*Interest[^r'in']*in[^r'Securities']*Securities[^r'of']*of[^r'the']*the[^r'Issuer']*Issuer[ \s.]?", re.M|re.S),
+		'Interest in Securities of the Issuer.'),
+	(6, re.compile(r"(?i)^Item[^6]?6[^r'Contracts,']*Contracts,[^r'Arrangements,']*Arrangements,[^r'Understandings']*Understandings[^r'or']*or[^r'Relationships']*Relationships[^r'with']*with[^r'respect']*respect[^r'to']*to[^r'Securities']*Securities[^r'of']*of[^r'the']*the[^r'Issuer']*Issuer[ \s.]?", re.M|re.S),
+		'Contracts, Arrangements, Understandings or Relationships With Respect to Securities of the Issuer.'),
+	(7, re.compile(r"(?i)^Item[^7]?7[^r'Material']*Material[^r'to']*to[^r'be']*be[^r'Filed']*Filed[^r'as']*as[^r'Exhibits']*Exhibits[ \s.]?", re.M|re.S),
+		'Material to be Filed as Exhibits.'),
+]
+_signature = re.compile(r"(?i)^Signature[s \s.]?", re.M|re.S)
 
-		text = self.cleanedText
 
-		# The first item is the document length
-		Items = [0, 0, 0, 0, 0, 0, 0, 0, 0]
-		Items[0] = len(text) 
-		it = [0, 0, 0, 0, 0, 0, 0, 0, 0]
+class parser_13D(parser_base):
 
-		#Item 1. Security and Issuer. 
-		it = [[m.start(), m.end()] for m in \
-			   re.finditer(r"(?i)^Item[^1]?1[^r'Security']*Security[^r'and']*and[^r'Issuer']*Issuer[ \s.]?",text,re.M|re.S)]
+	"""
+	Parser for forms SC 13D and SC 13D/A.  The document text is cleaned and the item headings are located
+	once per document; all items are then sliced from the same processed text.  The document body may be
+	supplied either as text or as a BeautifulSoup element.
+	"""
 
-		if it:
-			#print('1',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 1_ Security and Issuer.\n\n'+text[it[0][1]:]
-			#print('1',text[it[0][0]-20:it[0][1]+20])
-			Items[1] = it[0][0]
-		else:
-			Items[1] = 0
 
-		# Item 2. Identity and Background. 
-		it = [[m.start(), m.end()] for m in \
-			   re.finditer(r"(?i)^Item[^2]?2[^r'Identity']*Identity[^r'and']*and[^r'Background']*Background[ \s.]?",text,re.M|re.S)]
+	def _bodyText(self):
+		return self.body.get_text() if hasattr(self.body, 'get_text') else self.body
 
-		if it:
-			#print('2',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 2_ Identity and Background.\n\n'+text[it[0][1]:]
-			#print('2',text[it[0][0]-20:it[0][1]+20])
-			Items[2] = it[0][0]
-		else:
-			Items[2] = 0  
 
-		# Item 3. Source and Amount of Funds or Other Consideration. 
-		it = [[m.start(), m.end()] for m in \
-			   re.finditer(r"(?i)^Item[^3]?3[^r'Source']*Source[^r'and']*and[^r'Amount']*Amount[^r'of']*of[^r'Funds']*Funds[^r'or']*or[^r'Other']*Other[^r'Consideration']*Consideration[ \s.]?",text,re.M|re.S)]
+	def _cleanFileText(self):
 
-		if it:
-			#print('3',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 3_ Source and Amount of Funds or Other Consideration.\n\n'+text[it[0][1]:]
-			#print('3',text[it[0][0]-20:it[0][1]+20])
-			Items[3] = it[0][0]
-		else:
-			Items[3] = 0          
+		if getattr(self, 'cleanedText', None) is not None:
+			return
 
-		# Item 4. Purpose of Transaction.  
-		it = [[m.start(), m.end()] for m in \
-			   re.finditer(r"(?i)^Item[^4]?4[^r'Purpose']*Purpose[^r'of']*of[^r'Transaction']*Transaction[ \s.]?",text,re.M|re.S)]
+		text = unicodedata.normalize("NFKD", self._bodyText())
+		text = _newlines.sub('\n', text)
+		text = _spaces.sub(' ', text)
+		text = _item_heading.sub(r'\1 ', text)
+		text = _add_the.sub(r'Item 5. Interest in Securities of the Issuer.', text)
+		text = _page_footer.sub(' ', text)
 
-		if it:
-			#print('4',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 4_ Purpose of Transaction.\n\n'+text[it[0][1]:]
-			#print('4',text[it[0][0]-20:it[0][1]+20])
-			Items[4] = it[0][0]
-		else:
-			Items[4] = 0  
+		self.cleanedText = text
 
-		# Item 5. Interest in Securities of the Issuer.    
-		it = [[m.start(), m.end()] for m in \
-			   #re.finditer(r"^(?i)Item[^5]?5[^r'Interest']*Interest[^r'in']*in[^r'Securities']*Securities[^r'of']*of[^r'the']*the[^r'Issuer']*Issuer[ \s.]?",text,re.M|re.S)]
-			   re.finditer(r"(?i)^Item[^5]?5[^r'Interest']*Interest[^r'in']*in[^r'Securities']*Securities[^r'of']*of[^r'the']*the[^r'Issuer']*Issuer[ \s.]?",text,re.M|re.S)]
 
-		if it:
-			#print('5',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 5_ Interest in Securities of the Issuer.\n\n'+text[it[0][1]:]
-			#print('5',text[it[0][0]-20:it[0][1]+20])
-			Items[5] = it[0][0]
-		else:
-			Items[5] = 0      
+	def _findItems(self):
 
-		# Item 6. Contracts, Arrangements, Understandings or Relationships With Respect to Securities of the Issuer.    
-		it = [[m.start(), m.end()] for m in \
-			   re.finditer(r"(?i)^Item[^6]?6[^r'Contracts,']*Contracts,[^r'Arrangements,']*Arrangements,[^r'Understandings']*Understandings[^r'or']*or[^r'Relationships']*Relationships[^r'with']*with[^r'respect']*respect[^r'to']*to[^r'Securities']*Securities[^r'of']*of[^r'the']*the[^r'Issuer']*Issuer[ \s.]?",text,re.M|re.S)]
+		if getattr(self, 'processedText', None) is not None:
+			return
 
-		if it:
-			#print('6',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 6_ Contracts, Arrangements, Understandings or Relationships With Respect to Securities of the Issuer.\n\n'+text[it[0][1]:]
-			#print('6',text[it[0][0]-20:it[0][1]+20])
-			Items[6] = it[0][0]
-		else:
-			Items[6] = 0   
+		self._cleanFileText()
 
-		# Item 7. Material to be Filed as Exhibits.    
-		it = [[m.start(), m.end()] for m in \
-			   re.finditer(r"(?i)^Item[^7]?7[^r'Material']*Material[^r'to']*to[^r'be']*be[^r'Filed']*Filed[^r'as']*as[^r'Exhibits']*Exhibits[ \s.]?",text,re.M|re.S)]
+		text = self.cleanedText
 
-		if it:
-			#print('7',text[it[0][0]:it[0][1]])
-			text = text[:it[0][0]-1]+'\n\n_Item 7_ Material to be Filed as Exhibits.\n\n'+text[it[0][1]:]
-			#print('7',text[it[0][0]-20:it[0][1]+20])
-			Items[7] = it[0][0]
-		else:
-			Items[7] = 0   
+		# The first item is the document length
+		Items = [0, 0, 0, 0, 0, 0, 0, 0, 0]
+		Items[0] = len(text)
+
+		# Each heading is located in the text as modified by the preceding replacements, and only its first
+		# occurrence is used, so the search stops there instead of scanning the rest of the document.
+		for itemNumber, pattern, heading in _items:
+			m = pattern.search(text)
+			if m:
+				text = text[:m.start()-1]+'\n\n_Item {}_ {}\n\n'.format(itemNumber, heading)+text[m.end():]
+				Items[itemNumber] = m.start()
+			else:
+				Items[itemNumber] = 0
 
 		# Signature: pick the first token after the last item
-		it = [[m.start(), m.end()] for m in re.finditer(r"(?i)^Signature[s \s.]?",text, re.M|re.S)]
+		it = [[m.start(), m.end()] for m in _signature.finditer(text)]
 		if it:
-			#print (it, len(it))
 			if len(it) == 1:
 				Items[8] = it[0][0]
 				text = text[:it[0][0]-1]+'\n\n_Signature/s_ .\n\n'+text[it[0][1]:]
 
 			else:
-				found = 0
-				for i in range(len(it)):
-					if (it[i][0] > max(Items[1:7])) and (found == 0):
-						Items[8] = it[i][0]
-						text = text[:it[i][0]-1]+'\n_Signature/s_ .\n'+text[it[i][1]:]
-						found = 1
-			#print(text[Items[8]:Items[8]+30])                          
+				last = max(Items[1:7])
+				for start, end in it:
+					if start > last:
+						Items[8] = start
+						text = text[:start-1]+'\n_Signature/s_ .\n'+text[end:]
+						break
 		else:
 			Items[8] = 0
 
@@ -152,7 +111,7 @@ class parser_13D(parser_base):
 	def _get_item(self, itemNumber):
 
 		if itemNumber == 0:
-			return self.body.get_text()
+			return self._bodyText()
 
 		else:
 			self._findItems()
@@ -172,4 +131,4 @@ class parser_13D(parser_base):
 
 	def _parsing_work_function(self):
 		for itemnum in range(1,8):
-			self.parsed['item_'+str(itemnum)] = self._get_item(itemnum)
\ No newline at end of file
+			self.parsed['item_'+str(itemnum)] = self._get_item(itemnum)
@@ -1,3 +1,5 @@
+from .. import metrics, profiling
+
 
 class parser_base(object):
 
@@ -20,8 +22,12 @@ class parser_base(object):
 
     def parse(self):
         # Call one or more internal functions that will populate the 
-        # self.parsed dictionary
-        self._parsing_work_function()
+        # self.parsed dictionary, recording the parser's throughput.
+        name = type(self).__name__
+        with metrics.timed('parser_seconds', parser = name), profiling.stage(name + '.parse'):
+            self._parsing_work_function()
+        metrics.inc('parser_documents_total', parser = name)
+        metrics.inc('parser_bytes_total', len(getattr(self, 'body', None) or ''), parser = name)
   
         # Return the dictionary of parsed items.
         return self.parsed
\ No newline at end of file
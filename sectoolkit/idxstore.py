@@ -0,0 +1,526 @@
+import os
+import io
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+
+from .config import index_row_group_size
+from .cache import open_cached
+
+
+# Column layout of the SEC quarterly master index files.
+index_columns = ['CIK', 'Company Name', 'Form Type', 'Date Filed', 'Filename']
+categorical_columns = ['Company Name', 'Form Type']
+# Columns covered by the posting list index.
+indexed_columns = ['CIK', 'Form Type']
+
+
+def store_path(idxpath):
+    """
+    Returns the path of the columnar store that corresponds to a cached quarterly master.gz index file.
+    """
+    return os.path.splitext(idxpath)[0] + '.parquet'
+
+
+def read_master_file(idxpath, compression = 'gzip'):
+    """
+    Reads a raw SEC master index file and returns a typed dataframe with integer CIKs, categorical
+    company names and form types and datetime64 filing dates.
+    """
+    df = pd.read_csv(idxpath, sep = '|', skiprows = 9, compression = compression, dtype = str, \
+        encoding = 'latin-1', low_memory = False)
+    df.dropna(inplace = True)
+    df['CIK'] = pd.to_numeric(df['CIK'], errors = 'coerce')
+    df['Date Filed'] = pd.to_datetime(df['Date Filed'], errors = 'coerce')
+    df.dropna(inplace = True)
+    df['CIK'] = df['CIK'].astype('int64')
+    for col in categorical_columns:
+        df[col] = df[col].astype('category')
+    return df.reset_index(drop = True)
+
+
+def read_daily_index_file(localpath):
+    """
+    Reads a cached EDGAR daily master index file (master.YYYYMMDD.idx), which may be stored compressed,
+    and returns a dataframe with the same columns and data types as read_master_file().
+    """
+    with open_cached(localpath, 'r') as f:
+        lines = f.read().splitlines()
+    # Records follow the column heading line and the line of dashes beneath it.
+    start = next((i for i, line in enumerate(lines) if line.startswith('CIK|')), len(lines)) + 2
+    df = pd.read_csv(io.StringIO('\n'.join(lines[start:])), sep = '|', names = index_columns, dtype = str, \
+        keep_default_na = False)
+    df['CIK'] = pd.to_numeric(df['CIK'], errors = 'coerce')
+    # Daily index files give filing dates as YYYYMMDD.
+    df['Date Filed'] = pd.to_datetime(df['Date Filed'], format = '%Y%m%d', errors = 'coerce')
+    df = df[df['CIK'].notna() & df['Date Filed'].notna() & (df['Filename'] != '')].copy()
+    df['CIK'] = df['CIK'].astype('int64')
+    for col in categorical_columns:
+        df[col] = df[col].astype('category')
+    return df.reset_index(drop = True)
+
+
+def _write_store(df, storepath):
+    # Keep each CIK in a contiguous run of rows so that the posting index can point at a few row groups.
+    df = df.sort_values('CIK', kind = 'mergesort', ignore_index = True)
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    # Write to a temporary file first so that an interrupted conversion never leaves a truncated store.
+    tmppath = storepath + '.tmp'
+    pq.write_table(table, tmppath, row_group_size = index_row_group_size)
+    os.replace(tmppath, storepath)
+    return storepath
+
+
+def convert_index_file(idxpath):
+    """
+    Converts a cached quarterly master.gz index file into a typed Parquet store saved alongside it.
+    Returns the path of the store.
+    """
+    return _write_store(read_master_file(idxpath), store_path(idxpath))
+
+
+def _record_keys(df):
+    return pd.MultiIndex.from_arrays([df['CIK'].values, df['Filename'].astype(str).values])
+
+
+def store_keys(idxpath):
+    """
+    Returns the (CIK, Filename) pairs of all records in the columnar store for an index file.
+    """
+    return _record_keys(pq.read_table(store_path(idxpath), columns = ['CIK', 'Filename']).to_pandas())
+
+
+def new_records(df, keys):
+    """
+    Returns the records of df whose (CIK, Filename) pair is not among the supplied store keys.
+    """
+    return df[~_record_keys(df).isin(keys)].reset_index(drop = True)
+
+
+def append_to_store(idxpath, df):
+    """
+    Adds the records of df that are not yet present to the columnar store for a quarterly index file, for
+    example entries from the daily index files that are newer than the cached master.gz file.  Returns
+    the records that were added.
+    """
+    current = pq.read_table(store_path(idxpath)).to_pandas()
+    added = new_records(df.drop_duplicates(['CIK', 'Filename']), _record_keys(current))
+    if len(added) != 0:
+        merged = pd.concat([current, added], ignore_index = True)
+        for col in categorical_columns:
+            merged[col] = merged[col].astype(str).astype('category')
+        _write_store(merged, store_path(idxpath))
+    return added
+
+
+def last_date_filed(idxpath):
+    """
+    Returns the latest 'Date Filed' in the columnar store for an index file, or None if it is empty.
+    """
+    dates = pq.read_table(store_path(idxpath), columns = ['Date Filed']).column(0)
+    if len(dates) == 0:
+        return None
+    return pd.Timestamp(pc.max(dates).as_py())
+
+
+def store_is_current(idxpath):
+    """
+    Returns True if the columnar store for an index file exists and is newer than the index file itself.
+    """
+    storepath = store_path(idxpath)
+    return os.path.exists(storepath) and os.path.getmtime(storepath) >= os.path.getmtime(idxpath)
+
+
+def remove_store(idxpath):
+    """
+    Deletes the columnar store for an index file if it exists.
+    """
+    storepath = store_path(idxpath)
+    if os.path.exists(storepath):
+        os.remove(storepath)
+
+
+def _coerce_filter_values(key, values):
+    """
+    Converts filter values to the data type used for the column in the store.
+    """
+    if isinstance(values, (str, int)):
+        values = [values]
+    if key == 'CIK':
+        return [int(v) for v in values]
+    if key == 'Date Filed':
+        return list(pd.to_datetime(values))
+    return [str(v) for v in values]
+
+
+def _pushdown(filters, date_range):
+    """
+    Translates a filters dictionary and (start, end) date range into (column, op, value) predicates.
+    """
+    pushdown = [(key, 'in', _coerce_filter_values(key, values)) for key, values in filters.items()]
+    if date_range is not None:
+        start, end = date_range
+        if start is not None:
+            pushdown.append(('Date Filed', '>=', pd.Timestamp(start)))
+        if end is not None:
+            pushdown.append(('Date Filed', '<=', pd.Timestamp(end)))
+    return pushdown
+
+
+def read_index_store(idxpath, filters = {}, columns = None, row_groups = None, date_range = None):
+    """
+    Reads the columnar store for a quarterly index file, pushing the column filters specified in the
+    filters dictionary down into the Parquet reader.  The store is built first if it does not exist yet.
+    If a list of row groups is supplied (see posting_index.plan()), only those row groups are read.
+    A (start, end) date_range tuple restricts 'Date Filed' to an inclusive range; either end may be None.
+    """
+    if not store_is_current(idxpath):
+        convert_index_file(idxpath)
+    pushdown = _pushdown(filters, date_range)
+    if row_groups is None:
+        table = pq.read_table(store_path(idxpath), columns = columns, filters = pushdown or None)
+        return table.to_pandas()
+    table = pq.ParquetFile(store_path(idxpath)).read_row_groups(row_groups, columns = columns)
+    return _apply_pushdown(table.to_pandas(), pushdown)
+
+
+def _apply_pushdown(df, pushdown):
+    for key, op, value in pushdown:
+        if op == 'in':
+            df = df[df[key].isin(value)]
+        elif op == '>=':
+            df = df[df[key] >= value]
+        else:
+            df = df[df[key] <= value]
+    return df.reset_index(drop = True)
+
+
+def filter_index_frame(df, filters = {}, date_range = None):
+    """
+    Applies the same column filters and (start, end) date range as read_index_store() to an index
+    dataframe that is already in memory.
+    """
+    pushdown = _pushdown(filters, date_range)
+    return _apply_pushdown(df, pushdown)
+
+
+def quarter_overlaps(idxpath, date_range):
+    """
+    Returns True if the calendar quarter covered by a quarterly index file overlaps the (start, end)
+    date range.  Either end of the range may be None.
+    """
+    if date_range is None:
+        return True
+    year, qtr = quarter_key(idxpath).split('/')
+    qstart = pd.Timestamp(int(year), 3 * (int(qtr[3:]) - 1) + 1, 1)
+    qend = qstart + pd.offsets.QuarterEnd(0)
+    start, end = date_range
+    if start is not None and pd.Timestamp(start) > qend:
+        return False
+    if end is not None and pd.Timestamp(end) < qstart:
+        return False
+    return True
+
+
+def quarter_key(idxpath):
+    """
+    Returns the 'YYYY/QTRn' key used by the posting index for a quarterly index file path.
+    """
+    parts = os.path.normpath(idxpath).split(os.sep)
+    return '/'.join(parts[-3:-1])
+
+
+class _quarter_index(object):
+
+    """
+    Base class for persistent indexes derived from the quarterly columnar stores.  Keeps track of the
+    quarters covered by the index and the modification time of the store each was built from, so that
+    only new or refreshed quarters need to be indexed.
+    """
+
+    def __init__(self, idxdir, name):
+        self.idxdir = idxdir
+        self.quarters_path = os.path.join(idxdir, name + '.json')
+
+
+    def _read_quarters(self):
+        """
+        Returns a dictionary mapping quarter keys to the modification time of the store they were built from.
+        """
+        if not os.path.exists(self.quarters_path):
+            return {}
+        with open(self.quarters_path, 'r') as f:
+            return json.load(f)
+
+
+    def _write_quarters(self, quarters):
+        with open(self.quarters_path, 'w') as f:
+            json.dump(quarters, f)
+
+
+    def _mark_current(self, idxpaths):
+        """
+        Records the supplied index files as covered by the index as of their current store versions.
+        """
+        quarters = self._read_quarters()
+        for idxpath in idxpaths:
+            quarters[quarter_key(idxpath)] = os.path.getmtime(store_path(idxpath))
+        self._write_quarters(quarters)
+
+
+    def remove(self, idxpath):
+        """
+        Marks a quarter as no longer covered by the index, e.g. when its index file is about to be refreshed.
+        """
+        quarters = self._read_quarters()
+        if quarters.pop(quarter_key(idxpath), None) is not None:
+            self._write_quarters(quarters)
+
+
+    def stale(self, idxpaths):
+        """
+        Returns the index files whose columnar stores are missing from, or newer than, the index.
+        """
+        quarters = self._read_quarters()
+        stale = []
+        for idxpath in idxpaths:
+            storepath = store_path(idxpath)
+            if not os.path.exists(storepath):
+                continue
+            if quarters.get(quarter_key(idxpath), -1.0) < os.path.getmtime(storepath):
+                stale.append(idxpath)
+        return stale
+
+
+
+class posting_index(_quarter_index):
+
+    """
+    Persistent secondary index mapping CIK and form type values to the quarters and Parquet row groups
+    of the columnar index stores that contain them.  Row group r of a quarter covers store rows
+    r * index_row_group_size up to (r + 1) * index_row_group_size.
+
+
+    Required arguments:
+
+    idxdir  :   Directory holding the cached quarterly index files.
+
+    """
+
+    def __init__(self, idxdir):
+        super().__init__(idxdir, 'postings')
+        self.path = os.path.join(idxdir, 'postings.parquet')
+
+
+    def _quarter_postings(self, idxpath):
+        """
+        Builds the posting list entries for a single quarterly columnar store.
+        """
+        df = pq.read_table(store_path(idxpath), columns = indexed_columns).to_pandas()
+        row_group = np.arange(len(df), dtype = 'int32') // index_row_group_size
+        postings = []
+        for col in indexed_columns:
+            p = pd.DataFrame({'value': df[col].astype(str).values, 'row_group': row_group})
+            p = p.drop_duplicates()
+            p.insert(0, 'field', col)
+            postings.append(p)
+        postings = pd.concat(postings, ignore_index = True)
+        postings['quarter'] = quarter_key(idxpath)
+        return postings
+
+
+    def update(self, idxpaths, verbose = False):
+        """
+        Adds or replaces the posting lists for the supplied quarterly index files.  Entries for all other
+        quarters are left untouched, so refreshing the newest quarter only re-indexes that quarter.
+        """
+        idxpaths = [x for x in idxpaths if os.path.exists(store_path(x))]
+        if len(idxpaths) == 0:
+            return
+        if verbose:
+            print('Updating posting index for {} quarters ...'.format(len(idxpaths)))
+        keys = [quarter_key(x) for x in idxpaths]
+        postings = [self._quarter_postings(x) for x in idxpaths]
+        if os.path.exists(self.path):
+            old = pq.read_table(self.path).to_pandas()
+            postings.append(old[~old['quarter'].isin(keys)])
+        postings = pd.concat(postings, ignore_index = True)
+        # Sorting on field and value lets the Parquet row group statistics prune lookups.
+        postings = postings.sort_values(['field', 'value', 'quarter', 'row_group'], ignore_index = True)
+        postings['field'] = postings['field'].astype('category')
+        postings['quarter'] = postings['quarter'].astype('category')
+        tmppath = self.path + '.tmp'
+        pq.write_table(pa.Table.from_pandas(postings, preserve_index = False), tmppath)
+        os.replace(tmppath, self.path)
+        self._mark_current(idxpaths)
+
+
+    def plan(self, idxpaths, filters):
+        """
+        Determines which quarters and row groups can contain rows matching the CIK and form type filters.
+        Returns a list of (idxpath, row_groups) tuples, where row_groups is None for quarters that are not
+        covered by the posting index and must therefore be scanned in full.  Quarters that cannot contain
+        a match are omitted.
+        """
+        keys = [k for k in indexed_columns if k in filters]
+        if len(keys) == 0 or not os.path.exists(self.path):
+            return [(x, None) for x in idxpaths]
+        stale = set(self.stale(idxpaths))
+        covered = set(self._read_quarters().keys())
+        groups = None
+        for key in keys:
+            values = [str(v) for v in _coerce_filter_values(key, filters[key])]
+            hits = pq.read_table(self.path, columns = ['quarter', 'row_group'], \
+                filters = [('field', '=', key), ('value', 'in', values)]).to_pandas()
+            hits = set(zip(hits['quarter'].astype(str), hits['row_group']))
+            groups = hits if groups is None else groups & hits
+        plan = []
+        for idxpath in idxpaths:
+            key = quarter_key(idxpath)
+            if idxpath in stale or key not in covered:
+                plan.append((idxpath, None))
+                continue
+            row_groups = sorted(int(rg) for q, rg in groups if q == key)
+            if len(row_groups) > 0:
+                plan.append((idxpath, row_groups))
+        return plan
+
+
+
+# Trigram alphabet for the company name index: space, A-Z, 0-9 and a catch-all symbol.
+_trigram_bits = 6
+_trigram_space = 1 << (3 * _trigram_bits)
+_char_codes = np.full(256, 37, dtype = 'int32')
+_char_codes[ord(' ')] = 0
+_char_codes[np.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', dtype = 'uint8')] = np.arange(1, 27)
+_char_codes[np.frombuffer(b'0123456789', dtype = 'uint8')] = np.arange(27, 37)
+
+
+def _normalize_names(names):
+    """
+    Upper-cases company names, replaces punctuation with spaces and collapses runs of whitespace.
+    """
+    names = pd.Series(names, dtype = object).astype(str).str.upper()
+    names = names.str.replace(r'[^A-Z0-9]+', ' ', regex = True).str.strip()
+    return names
+
+
+def _name_trigrams(names):
+    """
+    Computes the distinct trigram codes of each name in a single vectorized pass over the concatenated
+    names.  Returns parallel arrays of name ids and trigram codes, ordered by trigram code.
+    """
+    padded = '  ' + _normalize_names(names) + ' '
+    lengths = padded.str.len().values.astype('int64')
+    chars = _char_codes[np.frombuffer(''.join(padded).encode('latin-1', 'replace'), dtype = 'uint8')]
+    codes = (chars[:-2] << (2 * _trigram_bits)) | (chars[1:-1] << _trigram_bits) | chars[2:]
+    ids = np.repeat(np.arange(len(lengths), dtype = 'int64'), lengths)[:-2]
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)[:-2]
+    # Drop trigrams that straddle two names.
+    valid = (np.arange(len(ids)) - starts) < (lengths[ids] - 2)
+    keys = (codes[valid].astype('int64') << 32) | ids[valid]
+    keys.sort()
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    return keys & 0xFFFFFFFF, keys >> 32
+
+
+class name_index(_quarter_index):
+
+    """
+    Persistent trigram index over the distinct company names found in the quarterly columnar stores, 
+    supporting fast approximate company name matching.
+
+
+    Required arguments:
+
+    idxdir  :   Directory holding the cached quarterly index files.
+
+    """
+
+    def __init__(self, idxdir):
+        super().__init__(idxdir, 'names')
+        self.names_path = os.path.join(idxdir, 'names.parquet')
+        self.trigrams_path = os.path.join(idxdir, 'names.npz')
+        self._loaded = None
+
+
+    def update(self, idxpaths, verbose = False):
+        """
+        Adds the company names found in the supplied quarterly index files to the index and rebuilds the
+        trigram posting lists if any new names were found.
+        """
+        idxpaths = [x for x in idxpaths if os.path.exists(store_path(x))]
+        if len(idxpaths) == 0:
+            return
+        names = set(self.names())
+        count = len(names)
+        for idxpath in idxpaths:
+            df = pq.read_table(store_path(idxpath), columns = ['Company Name']).to_pandas()
+            names.update(df['Company Name'].cat.categories)
+        if len(names) != count:
+            if verbose:
+                print('Rebuilding company name index for {} names ...'.format(len(names)))
+            self._build(sorted(names))
+        self._mark_current(idxpaths)
+
+
+    def _build(self, names):
+        """
+        Writes the list of names and the trigram posting lists (in compressed sparse row form) to disk.
+        """
+        ids, codes = _name_trigrams(names)
+        offsets = np.zeros(_trigram_space + 1, dtype = 'int64')
+        offsets[1:] = np.cumsum(np.bincount(codes, minlength = _trigram_space))
+        counts = np.bincount(ids, minlength = len(names)).astype('int32')
+        pq.write_table(pa.table({'name': names}), self.names_path + '.tmp')
+        os.replace(self.names_path + '.tmp', self.names_path)
+        with open(self.trigrams_path + '.tmp', 'wb') as f:
+            np.savez(f, ids = ids.astype('int32'), offsets = offsets, counts = counts)
+        os.replace(self.trigrams_path + '.tmp', self.trigrams_path)
+        self._loaded = None
+
+
+    def names(self):
+        """
+        Returns an array of all company names in the index.
+        """
+        if not os.path.exists(self.names_path):
+            return np.array([], dtype = object)
+        return pq.read_table(self.names_path).column('name').to_numpy(zero_copy_only = False)
+
+
+    def _load(self):
+        # Cache the arrays in memory, reloading them if the index has been rebuilt on disk since.
+        if not os.path.exists(self.trigrams_path):
+            return None
+        mtime = os.path.getmtime(self.trigrams_path)
+        if self._loaded is None or self._loaded[0] != mtime:
+            with np.load(self.trigrams_path) as z:
+                self._loaded = (mtime, self.names(), z['ids'], z['offsets'], z['counts'])
+        return self._loaded[1:]
+
+
+    def match(self, name, threshold = 0.5, limit = None):
+        """
+        Returns a dataframe of indexed company names whose trigram similarity (Jaccard index of the
+        trigram sets) with the supplied name is at least threshold, best matches first.
+        """
+        loaded = self._load()
+        if loaded is None:
+            return pd.DataFrame({'Company Name': [], 'score': []})
+        names, ids, offsets, counts = loaded
+        _, qcodes = _name_trigrams([name])
+        hits = np.bincount(np.concatenate([ids[offsets[c]:offsets[c + 1]] for c in qcodes] + \
+            [np.array([], dtype = 'int32')]), minlength = len(names))
+        candidates = np.flatnonzero(hits)
+        shared = hits[candidates]
+        score = shared / (len(qcodes) + counts[candidates] - shared)
+        keep = score >= threshold
+        result = pd.DataFrame({'Company Name': names[candidates[keep]], 'score': score[keep]})
+        result = result.sort_values(['score', 'Company Name'], ascending = [False, True], ignore_index = True)
+        if limit is not None:
+            result = result.head(limit)
+        return result
@@ -1,42 +1,257 @@
-from time import time, sleep
-from collections import deque
+from time import monotonic, sleep
+import threading
+import tempfile
+import getpass
+import struct
+import os
+
+from . import metrics
+
+
+# Adaptive mode: factor applied to the rate on a throttling response, and fraction of the maximum rate
+# added back after each successful request.
+_decrease_factor = 0.5
+_increase_step = 0.02
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _default_lockfile():
+    # One state file per user, since a file created by another user is normally not writable.
+    try:
+        user = str(os.getuid()) if hasattr(os, 'getuid') else getpass.getuser()
+    except Exception:
+        user = 'default'
+    return os.path.join(tempfile.gettempdir(), 'sectoolkit_rate_limiter_{}.state'.format(user))
+
+
+class _file_lock(object):
+
+    """
+    Exclusive inter-process lock on an open file descriptor, using flock() on POSIX systems and
+    msvcrt.locking() on Windows.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            # Lock a byte beyond the state record so that reads and writes of the record are unaffected.
+            os.lseek(self.fd, 64, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self.fd, 64, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
 
 
 class rate_limiter(object):
-    
+
     """
-    Implements a rate limiter for use in restricting the rate of file requests submitted to the SEC website.
+    Implements a token bucket rate limiter for use in restricting the rate of file requests submitted
+    to the SEC website.  Tokens accrue at limit / interval per second on a monotonic clock, up to a
+    maximum of burst tokens, and each request consumes one token.
 
     Arguments:
 
     interval :  limit interval in seconds
     limit    :  rate limit
+    burst    :  (default = 1) maximum number of requests that may be sent back to back after an idle
+                period.  Any window of interval seconds admits at most burst + limit - 1 requests, so
+                the default never exceeds limit requests per interval.
+    shared   :  (default = False) if True, the bucket is kept in a small state file guarded by a file
+                lock, so that all threads and processes on the host that use the same lockfile share
+                one request budget.  Otherwise the bucket is shared by the threads of one process only.
+    lockfile :  (default = sectoolkit_rate_limiter_<user id>.state in the system temp directory) state
+                file used in shared mode.  If it cannot be opened, the limiter falls back to a bucket of
+                its own process.
+    adaptive :  (default = False) if True, the rate adapts to throttling signals from the server (AIMD):
+                each throttle() report halves it, at most once per interval and down to min_rate, and
+                each recover() report adds back 2% of limit / interval until the full rate is reached.
+                In shared mode the current rate is shared like the bucket.
+    min_rate :  (default = 1/16 of limit / interval) lowest rate in requests per second in adaptive mode
 
     Usage:
-    
+
     limiter = rate_limiter(limit_interval, max_requests_per_interval)
 
     if limiter.allow():
         # Submit file request
-    
+
+    if limiter.try_acquire():
+        # Submit file request without waiting, otherwise do something else
+
     """
-    
-    def __init__(self, interval, limit):
+
+    def __init__(self, interval, limit, burst = 1, shared = False, lockfile = None, adaptive = False, \
+                 min_rate = None):
         self.interval = interval
         self.limit = limit
-        self.req_times = deque([time() - interval], maxlen = limit)
-        
-    def allow(self, verbose = False):
+        self.max_rate = limit / interval
+        self.rate = self.max_rate
+        self.adaptive = adaptive
+        self.min_rate = min_rate if min_rate else self.max_rate / 16
+        self.decreased = float('-inf')
+        self.burst = burst
+        self.shared = shared
+        self.lockfile = lockfile if lockfile else _default_lockfile()
+        self.tokens = float(self.burst)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def __getstate__(self):
+        # Locks and file descriptors cannot be pickled, so leave them out when the limiter is sent to a
+        # worker process.  In shared mode the worker reopens the state file and joins the common budget.
+        state = self.__dict__.copy()
+        del state['lock']
+        state['_fd'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _state_fd(self):
+        # Reopen the state file in each process, since flock() locks held through a descriptor
+        # inherited across fork() would not exclude the parent process.
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _read_state(self, fd):
+        # The state record holds the bucket level, the time it was last updated, the current rate and
+        # the time of the last rate decrease.
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 32)
+        if len(data) < 16:
+            return float(self.burst), monotonic(), self.max_rate, float('-inf')
+        if len(data) < 32:
+            return struct.unpack('dd', data[:16]) + (self.max_rate, float('-inf'))
+        tokens, updated, rate, decreased = struct.unpack('dddd', data)
+        # Another process may use a different limit.
+        return tokens, updated, min(max(rate, self.min_rate), self.max_rate), decreased
+
+    def _write_state(self, fd, tokens, updated, rate, decreased):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, struct.pack('dddd', tokens, updated, rate, decreased))
+
+    def _update(self, change):
+        # Applies change(tokens, updated, rate, decreased) to the bucket state, which is kept in the state 
+        # file in shared mode.  change returns the new state followed by a result that is passed on.
+        with self.lock:
+            if self.shared:
+                try:
+                    fd = self._state_fd()
+                except OSError as inst:
+                    # For example a state file owned by another user; requests are still limited per process.
+                    print('Rate limiter state file unavailable, limiting this process only: {}'.format(inst))
+                    self.shared = False
+            if self.shared:
+                with _file_lock(fd):
+                    tokens, updated, rate, decreased, result = change(*self._read_state(fd))
+                    self._write_state(fd, tokens, updated, rate, decreased)
+            else:
+                tokens, updated, rate, decreased, result = change(self.tokens, self.updated, self.rate, \
+                                                                  self.decreased)
+                self.tokens, self.updated, self.decreased = tokens, updated, decreased
+            self.rate = rate
+            return result
+
+    def _take(self, reserve):
         """
-        Returns True if within the rate limit, or blocks until within limit and then returns True.
+        Refills the bucket and takes a token.  If no token is available and reserve is True, the token
+        is borrowed against future refills and the time to wait for it is returned; if reserve is False,
+        nothing is taken and None is returned.  Returns 0.0 if a token was available immediately.
+        """
+        def take(tokens, updated, rate, decreased):
+            tokens, updated = self._refill(tokens, updated, rate)
+            if tokens >= 1.0:
+                return tokens - 1.0, updated, rate, decreased, 0.0
+            if not reserve:
+                return tokens, updated, rate, decreased, None
+            tokens -= 1.0
+            return tokens, updated, rate, decreased, -tokens / rate
+
+        return self._update(take)
+
+    def _refill(self, tokens, updated, rate):
+        now = monotonic()
+        # A state file left over from before a reboot may carry a timestamp from a later clock reading.
+        return min(float(self.burst), tokens + max(0.0, now - updated) * rate), now
+
+    def throttle(self):
+        """
+        Reports a throttling response from the server (HTTP 429 or 503).  In adaptive mode the rate is
+        halved, unless it was already lowered within the last interval (responses to requests that were
+        in flight together count once), and tokens saved up are dropped.  Returns the current rate.
         """
-        delay = self.interval - (time() - self.req_times[0])
+        if not self.adaptive:
+            return self.rate
+
+        def decrease(tokens, updated, rate, decreased):
+            tokens, updated = self._refill(tokens, updated, rate)
+            if updated - decreased < self.interval:
+                return tokens, updated, rate, decreased, rate
+            rate = max(self.min_rate, rate * _decrease_factor)
+            return min(tokens, 0.0), updated, rate, updated, rate
+
+        metrics.inc('rate_limiter_throttled_total')
+        return self._update(decrease)
+
+    def recover(self):
+        """
+        Reports a successful request.  In adaptive mode a lowered rate is raised again step by step until
+        it is back at limit / interval.  Returns the current rate.
+        """
+        if not self.adaptive or self.rate >= self.max_rate:
+            return self.rate
+
+        def increase(tokens, updated, rate, decreased):
+            # Tokens accrued so far are counted at the old rate.
+            tokens, updated = self._refill(tokens, updated, rate)
+            rate = min(self.max_rate, rate + self.max_rate * _increase_step)
+            return tokens, updated, rate, decreased, rate
+
+        return self._update(increase)
+
+    def acquire(self, verbose = False):
+        """
+        Blocks until a request is allowed within the rate limit.  Callers reserve their token under the
+        lock and then sleep outside of it, so waiting threads do not hold up one another.
+        """
+        delay = self._take(reserve = True)
+        metrics.observe('rate_limiter_wait_seconds', delay)
         if delay > 0:
             if verbose:
                 print("waiting... ", delay)
             # Block until we can request without exceeding the limit.
             sleep(delay)
-            
-        self.req_times.append(time())
-            
-        return True
\ No newline at end of file
+        return True
+
+    def try_acquire(self):
+        """
+        Returns True and consumes a token if a request is allowed right now, otherwise returns False
+        immediately without waiting.
+        """
+        return self._take(reserve = False) is not None
+
+    def allow(self, verbose = False):
+        """
+        Returns True if within the rate limit, or blocks until within limit and then returns True.
+        """
+        return self.acquire(verbose = verbose)
@@ -0,0 +1,582 @@
+import os
+import atexit
+import sqlite3
+import weakref
+import threading
+from time import time
+
+from . import config
+from .cache import cached_path, compression_suffixes, remove_cached
+
+
+# Top level directories of the data directory and the kind of cached file each holds.
+_kinds = {'filings': 'filing', 'headerfiles': 'header', 'idxfiles': 'index'}
+# Number of paths sent to SQLite per statement when checking or changing many files at once.
+_batch_size = 10000
+# Columns added to the files table after its first release, which are added to older manifests on open.
+_added_columns = [('cik', 'TEXT'), ('accessed', 'REAL'), ('hits', 'INTEGER DEFAULT 0'), ('url', 'TEXT'), \
+                  ('error', 'TEXT'), ('http_status', 'INTEGER'), ('attempts', 'INTEGER')]
+# HTTP statuses of failed downloads that will not succeed on a later try either.
+_permanent_statuses = (400, 401, 403, 404, 410)
+# Adds or updates the entry for a cached file.  The checksum of an earlier download is kept if the update
+# does not supply one, as is the access history used for eviction.
+_upsert = """INSERT INTO files (path, kind, accession, cik, size, fetched, checksum, status, accessed, hits, url, 
+    error, http_status, attempts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?, ?, ?) 
+    ON CONFLICT (path) DO UPDATE SET size = excluded.size, fetched = excluded.fetched, status = excluded.status, 
+    checksum = COALESCE(excluded.checksum, files.checksum), url = COALESCE(excluded.url, files.url), 
+    error = excluded.error, http_status = excluded.http_status, attempts = excluded.attempts"""
+# File uses recorded by touch() are kept in memory and written in one transaction once this many files or
+# this many seconds have accumulated, and before eviction.
+_touch_buffer_size = 10000
+_touch_flush_interval = 30.0
+# Manifests holding unwritten file uses, which are written before the interpreter exits.
+_pending_touches = weakref.WeakSet()
+# Manifests already opened in this process, by data directory.
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(datadir):
+    """
+    Returns the cache_manifest of a data directory, creating it on first use.  All callers in a process
+    share the same instance, and with it one database connection and one buffer of file uses.
+    """
+    key = os.path.abspath(datadir)
+    with _manifests_lock:
+        manifest = _manifests.get(key)
+        if manifest is None:
+            manifest = _manifests[key] = cache_manifest(datadir)
+    return manifest
+
+
+def _logical_path(path):
+    # Compressed files are listed under the path they would have uncompressed.  Files served compressed
+    # by the SEC (e.g. master.gz) have no other extension and keep their name.
+    for suffix in compression_suffixes.values():
+        if path.endswith(suffix) and '.' in os.path.basename(path)[:-len(suffix)]:
+            return path[:-len(suffix)]
+    return path
+
+
+def _abspaths(paths):
+    # Paths of cached files share a handful of directories, so each directory is made absolute only once.
+    dirs = {}
+    result = []
+    for path in paths:
+        head, tail = os.path.split(path)
+        absdir = dirs.get(head)
+        if absdir is None:
+            absdir = dirs[head] = os.path.abspath(head)
+        result.append(os.path.join(absdir, tail))
+    return result
+
+
+def _is_cached_file(kind, fname):
+    # Index directories also hold columnar stores, posting lists and refresh state, which are derived 
+    # from the cached files rather than fetched.
+    if fname.endswith('.part') or fname.endswith('.tmp'):
+        return False
+    if kind == 'index':
+        return (fname.startswith('master.') and not fname.endswith('.parquet')) or fname.startswith('index.json')
+    return True
+
+
+class cache_manifest(object):
+
+    """
+    SQLite database listing every file in the local cache (filing archives, SGML header files and index
+    files) with its accession number, size on disk, fetch time, checksum and status.  Deciding which of
+    many files still need to be fetched then takes one set-based query instead of a file system check per
+    file.  The downloaders, fetch_* methods and clear_*_cache methods keep the manifest in sync, and
+    rebuild() reconciles it with the files actually on disk.
+
+    Files are listed under their absolute, uncompressed path.  Status is 'ok' for files present in the
+    cache, 'missing' for files that were listed but found to be gone by rebuild(), and 'failed' for files
+    whose last download failed.  Failed downloads keep their URL, error, HTTP status and number of
+    attempts, so that failures() can hand them back to the downloaders.
+
+
+    Required arguments:
+
+    datadir :   data directory holding the cache
+
+    Optional arguments:
+
+    path    :   (default = manifest.sqlite in the data directory) database file
+
+    """
+
+    def __init__(self, datadir, path = None):
+        self.datadir = os.path.abspath(datadir)
+        self.path = path if path else os.path.join(self.datadir, 'manifest.sqlite')
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._flushed = time()
+
+
+    def __getstate__(self):
+        # Connections cannot be shared with other processes, so worker processes open their own.  File uses
+        # not yet written are left to this process.
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        state['_touched'] = {}
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            # Several threads download at once, so one connection is shared under a lock.
+            conn = sqlite3.connect(self.path, timeout = 60, check_same_thread = False)
+            conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, kind TEXT, accession TEXT, size INTEGER, fetched REAL,
+                checksum TEXT, status TEXT)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_accession ON files (accession)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS pins (kind TEXT, value TEXT, PRIMARY KEY (kind, value))")
+            self._upgrade(conn)
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+
+    def _upgrade(self, conn):
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(files)")]
+        missing = [(name, decl) for name, decl in _added_columns if name not in columns]
+        for name, decl in missing:
+            conn.execute("ALTER TABLE files ADD COLUMN {} {}".format(name, decl))
+        if 'cik' in dict(missing):
+            rows = conn.execute("SELECT path FROM files WHERE kind IN ('filing', 'header')").fetchall()
+            conn.executemany("UPDATE files SET cik = ? WHERE path = ?", \
+                ((self._describe(path)[2], path) for (path,) in rows))
+
+
+    @property
+    def complete(self):
+        """
+        True once rebuild() has listed the files already on disk, from when on the manifest alone decides
+        which files are cached.
+        """
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM meta WHERE key = 'rebuilt'").fetchone()
+        return row is not None
+
+
+    def _describe(self, path):
+        """
+        Returns the kind of cached file, its accession number and the CIK of the directory it is cached in
+        (None for index files).
+        """
+        rel = os.path.relpath(path, self.datadir).split(os.sep)
+        kind = _kinds.get(rel[0], 'other')
+        if kind in ('filing', 'header') and len(rel) > 2:
+            return kind, os.path.basename(path).split('.')[0], rel[1]
+        return kind, None, None
+
+
+    def record(self, localpath, checksum = None, status = 'ok', fetched = None, url = None, error = None, \
+               http_status = None, attempts = None):
+        """
+        Adds or updates the entry for a cached file, taking its size from the file stored on disk.  The 
+        error details of a failed download are cleared by the next successful one.
+        """
+        path = os.path.abspath(localpath)
+        stored = cached_path(path)
+        size = os.path.getsize(stored) if stored else None
+        kind, accession, cik = self._describe(path)
+        fetched = fetched if fetched else time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(_upsert, (path, kind, accession, cik, size, fetched, checksum, status, fetched, url, error, \
+                                   http_status, attempts))
+            conn.commit()
+
+
+    def _select_ok(self, conn, paths):
+        found = set()
+        for i in range(0, len(paths), _batch_size):
+            batch = paths[i:i + _batch_size]
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (path TEXT)")
+            conn.execute("DELETE FROM lookup")
+            conn.executemany("INSERT INTO lookup VALUES (?)", ((x,) for x in batch))
+            found.update(x for (x,) in conn.execute("""SELECT files.path FROM lookup JOIN files
+                ON files.path = lookup.path WHERE files.status = 'ok'"""))
+            # Filling the lookup table opens a transaction, which would keep other connections from writing.
+            conn.commit()
+        return found
+
+
+    def existing(self, localpaths, verify = None):
+        """
+        Returns the subset of localpaths that are present in the cache, determined with one set-based
+        query.  If verify is True, paths that are not listed are checked on disk, and files found there
+        (e.g. cached before the manifest existed) are added, so the manifest fills itself in over time.
+        By default paths are only checked on disk until rebuild() has been run once.
+        """
+        localpaths = list(localpaths)
+        paths = _abspaths(localpaths)
+        if verify is None:
+            verify = not self.complete
+        with self._lock:
+            found = self._select_ok(self._connect(), paths)
+        if verify:
+            # Files found on disk are added in one transaction.
+            rows = []
+            for path in paths:
+                stored = cached_path(path) if path not in found else None
+                if stored is not None:
+                    st = os.stat(stored)
+                    kind, accession, cik = self._describe(path)
+                    rows.append((path, kind, accession, cik, st.st_size, st.st_mtime, None, 'ok', st.st_mtime, \
+                                 None, None, None, None))
+                    found.add(path)
+            if rows:
+                with self._lock:
+                    conn = self._connect()
+                    conn.executemany(_upsert, rows)
+                    conn.commit()
+        return set(x for x, path in zip(localpaths, paths) if path in found)
+
+
+    def exists(self, localpath, verify = None):
+        """
+        Returns True if a single file is present in the cache.  See existing().
+        """
+        return len(self.existing([localpath], verify = verify)) > 0
+
+
+    def remove(self, localpaths):
+        """
+        Removes the entries for files that have been deleted from the cache.
+        """
+        paths = [(os.path.abspath(x),) for x in localpaths]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("DELETE FROM files WHERE path = ?", paths)
+            conn.commit()
+
+
+    def remove_dir(self, localdir):
+        """
+        Removes the entries for all files below a directory, e.g. after the directory has been cleared.
+        """
+        prefix = os.path.abspath(localdir).rstrip(os.sep) + os.sep
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+            conn.commit()
+
+
+    def entries(self, kind = None, status = None):
+        """
+        Returns the manifest entries as a list of dictionaries, optionally for one kind of file or status.
+        """
+        query = "SELECT * FROM files"
+        clauses = []
+        params = []
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        self.flush()
+        with self._lock:
+            cursor = self._connect().execute(query, params)
+            columns = [x[0] for x in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+    def failures(self, kinds = None, permanent = False):
+        """
+        Returns (url, localpath) tuples for the files whose last download failed, ready to be passed to 
+        utils.fetch_sec_files() again.  Failures with an HTTP status that will not change on a later try 
+        (such as 404) are left out unless permanent is True.  The full details of each failure are 
+        available from entries(status = 'failed').
+        """
+        query = "SELECT url, path FROM files WHERE status = 'failed' AND url IS NOT NULL"
+        params = []
+        if kinds:
+            query += " AND kind IN ({})".format(','.join('?' * len(kinds)))
+            params.extend(kinds)
+        if not permanent:
+            query += " AND (http_status IS NULL OR http_status NOT IN ({}))".format(','.join('?' * \
+                len(_permanent_statuses)))
+            params.extend(_permanent_statuses)
+        with self._lock:
+            return self._connect().execute(query, params).fetchall()
+
+
+    def rebuild(self, localdirs = None, verbose = False):
+        """
+        Reconciles the manifest with the files on disk below the supplied directories (by default the
+        filings, header and index file directories).  Files that are not listed are added, sizes of
+        listed files are updated, and listed files that no longer exist are marked 'missing'.  Checksums
+        of existing entries are kept.  Returns a dictionary with the number of files added, updated and
+        marked missing.  A full rebuild (the default directories) also makes the manifest authoritative,
+        so that existing() stops checking unlisted files on disk.
+        """
+        full = localdirs is None
+        if full:
+            localdirs = [os.path.join(self.datadir, x) for x in _kinds]
+        summary = {'added': 0, 'updated': 0, 'missing': 0}
+        for localdir in localdirs:
+            prefix = os.path.abspath(localdir).rstrip(os.sep) + os.sep
+            ondisk = {}
+            for root, dirs, files in os.walk(localdir):
+                for fname in files:
+                    stored = os.path.abspath(os.path.join(root, fname))
+                    if not _is_cached_file(self._describe(stored)[0], fname):
+                        continue
+                    st = os.stat(stored)
+                    ondisk[_logical_path(stored)] = (st.st_size, st.st_mtime)
+            with self._lock:
+                conn = self._connect()
+                listed = dict(conn.execute("SELECT path, status FROM files WHERE substr(path, 1, ?) = ?", \
+                    (len(prefix), prefix)))
+                rows = []
+                for path, (size, mtime) in ondisk.items():
+                    if path in listed:
+                        conn.execute("UPDATE files SET size = ?, status = 'ok' WHERE path = ?", (size, path))
+                        summary['updated'] += 1
+                    else:
+                        kind, accession, cik = self._describe(path)
+                        rows.append((path, kind, accession, cik, size, mtime, 'ok', mtime))
+                conn.executemany("""INSERT INTO files (path, kind, accession, cik, size, fetched, status, 
+                    accessed, hits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)""", rows)
+                summary['added'] += len(rows)
+                gone = [(x,) for x, status in listed.items() if x not in ondisk and status == 'ok']
+                conn.executemany("UPDATE files SET status = 'missing' WHERE path = ?", gone)
+                summary['missing'] += len(gone)
+                conn.commit()
+        if full:
+            # The manifest now lists everything on disk, so lookups no longer need to check the disk.
+            with self._lock:
+                conn = self._connect()
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('rebuilt', ?)", (str(time()),))
+                conn.commit()
+        if verbose:
+            print('Manifest rebuilt: {added} files added, {updated} updated, {missing} missing.'.format(**summary))
+        return summary
+
+
+    def touch(self, localpaths):
+        """
+        Records that cached files have been used, which is what the eviction policies go by.  Uses are
+        collected in memory and written in batches (see flush()), so that reading a single cached file
+        does not cost a database transaction.
+        """
+        now = time()
+        with self._lock:
+            for path in _abspaths(localpaths):
+                hits = self._touched.get(path, (0, 0))[1]
+                self._touched[path] = (now, hits + 1)
+            _pending_touches.add(self)
+            due = len(self._touched) >= _touch_buffer_size or now - self._flushed >= _touch_flush_interval
+        if due:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Writes the file uses collected by touch() to the database in one transaction.
+        """
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._flushed = time()
+            if len(touched) == 0:
+                return
+            conn = self._connect()
+            conn.executemany("UPDATE files SET accessed = MAX(COALESCE(accessed, 0), ?), hits = hits + ? WHERE path = ?", \
+                             ((last, hits, path) for path, (last, hits) in touched.items()))
+            conn.commit()
+
+
+    def pin(self, accessions = None, ciks = None):
+        """
+        Exempts the filing archives and header files of the supplied accession numbers and CIKs from 
+        eviction.
+        """
+        self._set_pins(accessions, ciks, "INSERT OR IGNORE INTO pins VALUES (?, ?)")
+
+
+    def unpin(self, accessions = None, ciks = None):
+        """
+        Makes pinned accession numbers and CIKs subject to eviction again.
+        """
+        self._set_pins(accessions, ciks, "DELETE FROM pins WHERE kind = ? AND value = ?")
+
+
+    def _set_pins(self, accessions, ciks, statement):
+        # CIKs are pinned in the unpadded form used for the cache directories.
+        items = [('accession', str(x)) for x in (accessions or [])] + \
+                [('cik', str(int(x))) for x in (ciks or [])]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(statement, items)
+            conn.commit()
+
+
+    def pins(self):
+        """
+        Returns a dictionary with the lists of pinned accession numbers and CIKs.
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT kind, value FROM pins ORDER BY kind, value").fetchall()
+        return {'accessions': [v for k, v in rows if k == 'accession'], 'ciks': [v for k, v in rows if k == 'cik']}
+
+
+    def evict(self, max_bytes = None, max_age = None, policy = None, kinds = ('filing', 'header'), \
+              in_use = None, dry_run = False, verbose = False):
+        """
+        Deletes cached files until the files of the given kinds fit in max_bytes, and deletes files that 
+        have not been used for max_age days.  Files are evicted in policy order: 'lru' evicts the least 
+        recently used files first, 'lfu' the least frequently used (ties broken by last use).  Files of 
+        pinned accession numbers and CIKs and the paths in in_use (an iterable, or a callable returning 
+        one) are never evicted.  Index files are only evicted if 'index' is included in kinds.  With 
+        dry_run the files are listed but not deleted.  Returns a dictionary with the number of files and 
+        bytes evicted, the bytes remaining and the evicted paths.
+
+        Arguments:
+
+        max_bytes   :   (default = config.cache_max_bytes) size budget in bytes, 0 for no limit
+        max_age     :   (default = config.cache_max_age) days since last use, 0 for no limit
+        policy      :   (default = config.cache_eviction_policy) 'lru' or 'lfu'
+        kinds       :   (default = ('filing', 'header')) kinds of cached files subject to eviction
+        in_use      :   (default = None) paths of files that must be kept
+        dry_run     :   (default = False)
+        verbose     :   (default = False)
+
+        """
+        self.flush()
+        max_bytes = max_bytes if max_bytes != None else config.cache_max_bytes
+        max_age = max_age if max_age != None else config.cache_max_age
+        policy = policy if policy != None else config.cache_eviction_policy
+        if policy not in ('lru', 'lfu'):
+            raise ValueError("Eviction policy must be 'lru' or 'lfu', not {!r}.".format(policy))
+        if callable(in_use):
+            in_use = in_use()
+        keep = set(_abspaths(in_use)) if in_use else set()
+        order = "last" if policy == 'lru' else "hits, last"
+        marks = ', '.join('?' * len(kinds))
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files WHERE status = 'ok' AND kind IN ({})" \
+                .format(marks), kinds).fetchone()[0]
+            candidates = conn.execute("""SELECT path, size, COALESCE(accessed, fetched) AS last FROM files 
+                WHERE status = 'ok' AND kind IN ({}) AND NOT EXISTS (SELECT 1 FROM pins WHERE 
+                (pins.kind = 'accession' AND pins.value = files.accession) OR 
+                (pins.kind = 'cik' AND pins.value = files.cik)) ORDER BY {}""".format(marks, order), \
+                kinds).fetchall()
+        cutoff = time() - max_age * 86400 if max_age else None
+        evicted = []
+        freed = 0
+        for path, size, last in candidates:
+            size = size or 0
+            if path in keep:
+                continue
+            if not ((cutoff and last < cutoff) or (max_bytes and total - freed > max_bytes)):
+                continue
+            if not dry_run:
+                try:
+                    remove_cached(path)
+                except OSError as inst:
+                    print(path)
+                    print(inst)
+                    continue
+                # Remove the directory of the CIK once its last file has gone.
+                try:
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+            evicted.append(path)
+            freed += size
+        if not dry_run:
+            self.remove(evicted)
+        summary = {'files': len(evicted), 'bytes': freed, 'remaining': total - freed, 'paths': evicted}
+        if verbose:
+            print('{} {} files ({} bytes), {} bytes remain cached.'.format('Would evict' if dry_run else 'Evicted', \
+                summary['files'], summary['bytes'], summary['remaining']))
+        return summary
+
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+
+
+@atexit.register
+def _flush_pending_touches():
+    for manifest in list(_pending_touches):
+        try:
+            manifest.flush()
+        except Exception as inst:
+            print(inst)
+
+
+
+class cache_sweeper(object):
+
+    """
+    Background thread that runs cache_manifest.evict() at a fixed interval, so that the cache stays within 
+    its budget while long running jobs keep fetching files.
+
+
+    Required arguments:
+
+    manifest    :   cache_manifest of the cache to sweep
+    interval    :   seconds between sweeps
+
+    Optional arguments:
+
+    keyword arguments are passed on to evict() on every sweep, e.g. in_use = callable returning the paths 
+    that are currently in use
+
+    """
+
+    def __init__(self, manifest, interval, **kwargs):
+        self.manifest = manifest
+        self.interval = interval
+        self.kwargs = kwargs
+        self.last = None
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target = self._run, name = 'cache_sweeper', daemon = True)
+            self._thread.start()
+        return self
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last = self.manifest.evict(**self.kwargs)
+            except Exception as inst:
+                # A failed sweep is retried at the next interval.
+                print('Cache sweep failed:', inst)
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
@@ -0,0 +1,288 @@
+import json
+import bisect
+import threading
+from time import perf_counter
+
+from . import config
+
+
+# Upper bounds in seconds of the buckets of latency histograms.
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Prefix of metric names in Prometheus text exports.
+prometheus_prefix = 'sectoolkit_'
+
+
+class _timed(object):
+
+    """
+    Context manager that observes the time spent inside it in a histogram.
+    """
+
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, perf_counter() - self.start, **self.labels)
+
+
+class _null_timed(object):
+
+    # Returned by timed() while metrics are disabled, so that instrumented code costs nothing but the call.
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_null = _null_timed()
+
+
+class metrics_registry(object):
+
+    """
+    Collects counters and histograms from instrumented sectoolkit code: stage timings, HTTP request
+    latencies, bytes downloaded, rate limiter waits, cache hits and misses and parser throughput.  Values
+    are aggregated in memory and can be exported as JSON or in the Prometheus text format at any time.
+    Callbacks registered with add_hook() are called with every recorded value, so metrics can also be
+    forwarded to an external monitoring system as they occur.
+
+    Nothing is recorded while the registry is disabled; every instrumentation point then returns after a
+    single attribute check.  The package-wide registry is enabled by config.metrics_enabled or the
+    SECTOOLKIT_METRICS environment variable, or with enable().  Values recorded in worker_pool worker
+    processes are sent back with the task results and added to the registry of the calling process.
+
+    Arguments:
+
+    enabled     :   (default = config.metrics_enabled) whether values are recorded
+    buckets     :   (default = default_buckets) upper bounds of histogram buckets
+
+    Usage:
+
+    from sectoolkit import metrics
+
+    metrics.enable()
+    idx.filter_index(filters)
+    print(metrics.to_prometheus())
+
+    """
+
+    def __init__(self, enabled = None, buckets = default_buckets):
+        self.enabled = enabled if enabled != None else config.metrics_enabled
+        self.buckets = tuple(sorted(buckets))
+        self.hooks = []
+        self._counters = {}
+        self._histograms = {}
+        self._buffer = None
+        self._lock = threading.Lock()
+
+
+    def inc(self, name, value = 1, **labels):
+        """
+        Adds value to a counter.
+        """
+        if self.enabled:
+            self._record('counter', name, value, labels)
+
+
+    def observe(self, name, value, **labels):
+        """
+        Records a single observation, such as a duration in seconds, in a histogram.
+        """
+        if self.enabled:
+            self._record('histogram', name, value, labels)
+
+
+    def timed(self, name, **labels):
+        """
+        Returns a context manager that records the time spent inside it in a histogram.
+        """
+        if self.enabled:
+            return _timed(self, name, labels)
+        return _null
+
+
+    def _record(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if self._buffer is not None:
+                # Inside a pool worker process values are passed back to the caller instead.
+                self._buffer.append((kind, name, value, labels))
+                return
+            if kind == 'counter':
+                self._counters[key] = self._counters.get(key, 0) + value
+            else:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+                histogram[1] += value
+                histogram[2] += 1
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value, labels)
+            except Exception as inst:
+                print(inst)
+
+
+    def replay(self, events):
+        """
+        Records a list of (kind, name, value, labels) tuples, as collected in a worker process.
+        """
+        for kind, name, value, labels in events:
+            self._record(kind, name, value, labels)
+
+
+    def add_hook(self, hook):
+        """
+        Registers a callback that is called as hook(kind, name, value, labels) for every recorded value,
+        where kind is 'counter' or 'histogram'.
+        """
+        self.hooks.append(hook)
+
+
+    def remove_hook(self, hook):
+        """
+        Removes a callback registered with add_hook().
+        """
+        self.hooks.remove(hook)
+
+
+    def reset(self):
+        """
+        Discards all recorded values.
+        """
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+
+    def snapshot(self):
+        """
+        Returns a dictionary holding the current value of every counter and the bucket counts, sum and
+        count of every histogram.  Bucket counts are cumulative and keyed by their upper bound.
+        """
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items()]
+        snapshot = {'counters': [], 'histograms': []}
+        for (name, labels), value in sorted(counters, key = lambda x: repr(x[0])):
+            snapshot['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), (counts, total, count) in sorted(histograms, key = lambda x: repr(x[0])):
+            buckets = {}
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                buckets['+Inf' if bound == float('inf') else repr(bound)] = cumulative
+            snapshot['histograms'].append({'name': name, 'labels': dict(labels), 'buckets': buckets, \
+                                           'sum': total, 'count': count})
+        return snapshot
+
+
+    def to_json(self, indent = None):
+        """
+        Returns snapshot() as a JSON string.
+        """
+        return json.dumps(self.snapshot(), indent = indent)
+
+
+    def to_prometheus(self):
+        """
+        Returns the current values in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+
+        def labelstr(labels, extra = None):
+            items = list(labels.items()) + ([extra] if extra else [])
+            if not items:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"') \
+                                  .replace('\n', '\\n')) for k, v in items) + '}'
+
+        for counter in snapshot['counters']:
+            name = prometheus_prefix + counter['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, labelstr(counter['labels']), counter['value']))
+        for histogram in snapshot['histograms']:
+            name = prometheus_prefix + histogram['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_bucket{} {}'.format(name, labelstr(histogram['labels'], ('le', bound)), count))
+            lines.append('{}_sum{} {}'.format(name, labelstr(histogram['labels']), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, labelstr(histogram['labels']), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+# Package-wide registry used by all instrumented code.
+registry = metrics_registry()
+
+
+def enable():
+    """
+    Starts recording metrics in the package-wide registry.
+    """
+    registry.enabled = True
+
+
+def disable():
+    """
+    Stops recording metrics.  Values recorded so far are kept.
+    """
+    registry.enabled = False
+
+
+def inc(name, value = 1, **labels):
+    if registry.enabled:
+        registry._record('counter', name, value, labels)
+
+
+def observe(name, value, **labels):
+    if registry.enabled:
+        registry._record('histogram', name, value, labels)
+
+
+def timed(name, **labels):
+    if registry.enabled:
+        return _timed(registry, name, labels)
+    return _null
+
+
+def add_hook(hook):
+    registry.add_hook(hook)
+
+
+def remove_hook(hook):
+    registry.remove_hook(hook)
+
+
+def reset():
+    registry.reset()
+
+
+def snapshot():
+    return registry.snapshot()
+
+
+def to_json(indent = None):
+    return registry.to_json(indent = indent)
+
+
+def to_prometheus():
+    return registry.to_prometheus()
@@ -0,0 +1,196 @@
+import os
+import atexit
+import weakref
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from . import config
+from . import metrics
+from . import profiling
+
+
+# Pools with running workers, which are shut down cleanly before the interpreter exits.
+_active_pools = weakref.WeakSet()
+
+
+def _run_chunk(function, chunk, args):
+    return [function(item, *args) for item in chunk]
+
+
+def _run_chunk_profiled(function, chunk, args):
+    # Thread backend chunk run while profiling is enabled.  Before Python 3.12 cProfile only sees the thread 
+    # it runs in, so each chunk is profiled in its worker thread; from 3.12 a chunk started while another 
+    # profile is active is covered by that profile instead (see _profiled_stage).  tracemalloc already 
+    # covers all threads.
+    with profiling.profiler.stage(function.__name__, memory = False):
+        return _run_chunk(function, chunk, args)
+
+
+def _run_chunk_instrumented(function, chunk, args, collect_metrics = False, profile = False, memory = False):
+    # Worker process side of a chunk run while metrics or profiling are enabled in the calling process.  The 
+    # values and profiles recorded by the chunk are returned with its results and added to the caller's 
+    # registry and profiler.
+    registry = metrics.registry
+    profiler = profiling.profiler
+    if collect_metrics:
+        registry.enabled = True
+        registry._buffer = []
+    profiler.enabled = profile
+    try:
+        with registry.timed('pool_task_seconds', function = function.__name__):
+            with profiler.stage(function.__name__, memory = memory):
+                results = _run_chunk(function, chunk, args)
+        registry.inc('pool_items_total', len(chunk), function = function.__name__)
+    finally:
+        events, registry._buffer = registry._buffer, None
+    return results, events, profiler.take() if profile else None
+
+
+@atexit.register
+def _close_active_pools():
+    for pool in list(_active_pools):
+        pool.close()
+
+
+class worker_pool(object):
+
+    """
+    Long-lived pool of workers for running the same function over many inputs.  Workers are started on
+    first use and reused by later calls, tasks are sent in chunks, results are returned in input order
+    and the number of chunks in flight is capped, so neither queued tasks nor finished results pile up
+    in memory when the consumer is slower than the workers.
+
+    Arguments:
+
+    backend     :   (default = config.pool_backend) 'process' for a pool of worker processes (CPU bound
+                    work), 'thread' for a pool of threads (I/O bound work) or 'serial' to run everything
+                    in the calling thread, which is convenient for debugging and small jobs
+    max_workers :   (default = config.pool_max_workers) number of workers, 0 uses all CPU cores
+    chunksize   :   (default = 1) number of inputs sent to a worker per task
+    max_pending :   (default = None allows two chunks per worker) maximum number of chunks in flight
+
+    Usage:
+
+    pool = worker_pool('process')
+
+    for result in pool.map(function, inputs, args = (x, y)):
+        # function(input, x, y) for each input, in order
+
+    pool.close()
+
+    """
+
+    def __init__(self, backend = None, max_workers = None, chunksize = 1, max_pending = None):
+        self.backend = backend if backend != None else config.pool_backend
+        if self.backend not in ('process', 'thread', 'serial'):
+            raise ValueError("Pool backend must be 'process', 'thread' or 'serial', not {!r}.".format(self.backend))
+        max_workers = max_workers if max_workers != None else config.pool_max_workers
+        self.max_workers = max_workers if max_workers else (os.cpu_count() or 1)
+        self.chunksize = chunksize
+        self.max_pending = max_pending
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Workers belong to the process that started them.  A copy sent to a worker process starts its own
+        # workers if it is ever used there.
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.backend == 'process':
+                    self._executor = ProcessPoolExecutor(max_workers = self.max_workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers = self.max_workers)
+                _active_pools.add(self)
+            return self._executor
+
+    def map(self, function, inputs, args = (), chunksize = None, max_pending = None, ordered = True):
+        """
+        Runs function(input, *args) for every item of inputs and yields the results, in input order
+        unless ordered is False.  Inputs are consumed lazily, so they may come from a generator.  For the
+        process backend, function, inputs and args must be picklable.
+        """
+        chunksize = chunksize if chunksize else self.chunksize
+        max_pending = max_pending if max_pending else (self.max_pending or 2 * self.max_workers)
+        if self.backend == 'serial':
+            for item in inputs:
+                yield function(item, *args)
+            return
+
+        executor = self._get_executor()
+        run = _run_chunk
+        if self.backend == 'process' and (metrics.registry.enabled or profiling.profiler.enabled):
+            run = functools.partial(_run_chunk_instrumented, collect_metrics = metrics.registry.enabled, \
+                                    profile = profiling.profiler.enabled, memory = profiling.profiler.memory)
+        elif self.backend == 'thread' and profiling.profiler.enabled:
+            run = _run_chunk_profiled
+        pending = deque()
+        try:
+            chunk = []
+            for item in inputs:
+                chunk.append(item)
+                if len(chunk) == chunksize:
+                    for result in self._drain(pending, max_pending - 1, ordered):
+                        yield result
+                    pending.append(executor.submit(run, function, chunk, args))
+                    chunk = []
+            if chunk:
+                for result in self._drain(pending, max_pending - 1, ordered):
+                    yield result
+                pending.append(executor.submit(run, function, chunk, args))
+            for result in self._drain(pending, 0, ordered):
+                yield result
+        except BrokenProcessPool:
+            # A worker process died; start a fresh pool on the next call.
+            self.close()
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _drain(self, pending, limit, ordered):
+        # Yield results until no more than limit chunks remain in flight.
+        while len(pending) > limit:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when = FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            results = future.result()
+            if isinstance(results, tuple):
+                results, events, profile = results
+                if events:
+                    metrics.registry.replay(events)
+                if profile:
+                    profiling.profiler.merge(profile)
+            for result in results:
+                yield result
+
+    def close(self):
+        """
+        Shuts down the workers.  The pool starts new workers if it is used again.
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait = True, cancel_futures = True)
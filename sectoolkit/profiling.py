@@ -0,0 +1,357 @@
+import io
+import os
+import json
+import atexit
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from time import perf_counter, strftime
+
+from . import config
+
+
+# Number of allocation sites kept per profiled stage call.
+top_sites = 50
+
+
+class _raw_stats(object):
+
+    # Lets pstats.Stats load a stats dictionary received from a worker process.
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class _profiled_stage(object):
+
+    """
+    Context manager that profiles the code inside it with cProfile and, optionally, tracemalloc, and
+    adds the results to a stage of a stage_profiler.  Stages nested inside a profiled stage of the same
+    thread are counted as part of the outer stage.
+    """
+
+    __slots__ = ('profiler', 'name', 'memory', 'profile', 'start')
+
+    def __init__(self, profiler, name, memory):
+        self.profiler = profiler
+        self.name = name
+        self.memory = memory
+        self.profile = None
+
+    def __enter__(self):
+        local = self.profiler._local
+        if getattr(local, 'active', False):
+            return self
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 only one profiler can be active per process, and it sees every thread, so a 
+            # stage that starts while another thread's stage is profiled is covered by that one.
+            return self
+        local.active = True
+        if self.memory:
+            self.profiler._start_tracing()
+        self.profile = profile
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        elapsed = perf_counter() - self.start
+        peak, sites = self.profiler._stop_tracing() if self.memory else (None, None)
+        self.profiler._local.active = False
+        self.profile.create_stats()
+        self.profiler._add(self.name, {'calls': 1, 'seconds': elapsed, 'stats': self.profile.stats, \
+                                       'peak': peak, 'sites': sites})
+
+
+class _null_stage(object):
+
+    # Returned by stage() while profiling is disabled.
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_null = _null_stage()
+
+
+class stage_profiler(object):
+
+    """
+    Collects cProfile and tracemalloc data for the stages of a run: idx methods such as updateidx,
+    filter_index and parse_filings, the functions run on worker_pool workers (for example
+    _filter_index_part, header_records and _parse_filing_chunk), header file and filing archive reads
+    and form parsers.  Profiles of the same stage are merged across calls, threads and worker processes,
+    so one report per run shows the functions that take the most time and the lines that allocate the
+    most memory in each stage.
+
+    Profiling is off by default and slows the profiled code down.  The package-wide profiler is enabled by
+    config.profile_enabled or the SECTOOLKIT_PROFILE environment variable, or with enable().  When it is
+    enabled, the report is written to config.profile_dir when the program exits.
+
+    Arguments:
+
+    enabled     :   (default = config.profile_enabled) whether stages are profiled
+    memory      :   (default = config.profile_memory) also trace memory allocations with tracemalloc
+
+    Usage:
+
+    from sectoolkit import profiling
+
+    profiling.enable()
+    idx.filter_index(filters)
+    idx.parse_filings()
+    print(profiling.report(top = 15))
+    profiling.write_report('profiles')
+
+    """
+
+    def __init__(self, enabled = None, memory = None):
+        self.enabled = enabled if enabled != None else config.profile_enabled
+        self.memory = memory if memory != None else config.profile_memory
+        self.stages = {}
+        self.started = strftime('%Y%m%d-%H%M%S')
+        self._pid = os.getpid()
+        self._process = self._pid
+        self._tracing = 0
+        self._started_tracemalloc = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+
+    def stage(self, name, memory = None):
+        """
+        Returns a context manager that profiles the code inside it as part of stage name.
+        """
+        if self.enabled:
+            self._check_process()
+            return _profiled_stage(self, name, self.memory if memory is None else memory)
+        return _null
+
+
+    def _check_process(self):
+        # A worker process forked inside a profiled stage inherits the parent's active stage, tracing 
+        # count and traced allocations, none of which apply to it.
+        if self._process != os.getpid():
+            self._process = os.getpid()
+            self._local = threading.local()
+            self._lock = threading.Lock()
+            self._tracing = 0
+            self.stages = {}
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+
+    def _start_tracing(self):
+        # tracemalloc is process wide, so it runs while any traced stage is active.
+        with self._lock:
+            if self._tracing == 0:
+                self._started_tracemalloc = not tracemalloc.is_tracing()
+                if self._started_tracemalloc:
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+            self._tracing += 1
+
+
+    def _stop_tracing(self):
+        with self._lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            self._tracing -= 1
+            if self._tracing == 0 and self._started_tracemalloc:
+                tracemalloc.stop()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), \
+                                           tracemalloc.Filter(False, __file__)])
+        # Memory allocated during the stage that is still held when it ends, by source line.
+        sites = {}
+        for stat in snapshot.statistics('lineno')[:top_sites]:
+            frame = stat.traceback[0]
+            sites['{}:{}'.format(frame.filename, frame.lineno)] = [stat.size, stat.count]
+        return peak, sites
+
+
+    def _add(self, name, data):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'stats': None, 'peak': None, 'sites': {}}
+            stage['calls'] += data['calls']
+            stage['seconds'] += data['seconds']
+            if data['stats']:
+                stats = pstats.Stats(_raw_stats(data['stats']))
+                if stage['stats'] is None:
+                    stage['stats'] = stats
+                else:
+                    stage['stats'].add(stats)
+            if data['peak'] is not None:
+                stage['peak'] = max(stage['peak'] or 0, data['peak'])
+            for site, (size, count) in (data['sites'] or {}).items():
+                total = stage['sites'].setdefault(site, [0, 0])
+                total[0] += size
+                total[1] += count
+
+
+    def take(self):
+        """
+        Returns the collected stage data in a picklable form and starts over, as worker processes do after
+        each task.
+        """
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return {name: dict(stage, stats = stage['stats'].stats if stage['stats'] else None) \
+                for name, stage in stages.items()}
+
+
+    def merge(self, stages):
+        """
+        Adds stage data returned by take() in another process.
+        """
+        for name, data in stages.items():
+            self._add(name, data)
+
+
+    def reset(self):
+        """
+        Discards all collected profiles.
+        """
+        with self._lock:
+            self.stages = {}
+
+
+    def _top_functions(self, stats, top):
+        functions = []
+        items = sorted(stats.stats.items(), key = lambda x: x[1][2], reverse = True)[:top]
+        for (filename, line, function), (cc, nc, tt, ct, callers) in items:
+            functions.append({'function': '{}:{}({})'.format(filename, line, function), 'ncalls': nc, \
+                              'tottime': tt, 'cumtime': ct})
+        return functions
+
+
+    def summary(self, top = 20):
+        """
+        Returns a dictionary with the calls, total seconds and peak traced memory of each stage and its top
+        functions by own time and top allocation sites by size.
+        """
+        with self._lock:
+            stages = list(self.stages.items())
+        summary = {'started': self.started, 'pid': self._pid, 'stages': {}}
+        for name, stage in sorted(stages, key = lambda x: -x[1]['seconds']):
+            sites = sorted(stage['sites'].items(), key = lambda x: -x[1][0])[:top]
+            summary['stages'][name] = {'calls': stage['calls'], 'seconds': stage['seconds'], \
+                'peak_traced_bytes': stage['peak'], \
+                'top_functions': self._top_functions(stage['stats'], top) if stage['stats'] else [], \
+                'top_allocations': [{'site': site, 'bytes': size, 'blocks': count} for site, (size, count) in sites]}
+        return summary
+
+
+    def report(self, top = 20):
+        """
+        Returns a text report listing, for each stage, the top functions by own and cumulative time and the
+        top allocation sites.
+        """
+        with self._lock:
+            stages = list(self.stages.items())
+        out = io.StringIO()
+        out.write('sectoolkit profile report, run started {}\n'.format(self.started))
+        for name, stage in sorted(stages, key = lambda x: -x[1]['seconds']):
+            out.write('\n{}\nStage {}: {} calls, {:.3f} seconds'.format('=' * 100, name, stage['calls'], \
+                      stage['seconds']))
+            if stage['peak'] is not None:
+                out.write(', peak traced memory {:.1f} MB'.format(stage['peak'] / 1e6))
+            out.write('\n')
+            if stage['stats']:
+                stats = pstats.Stats(_raw_stats(stage['stats'].stats), stream = out).strip_dirs()
+                out.write('\nTop functions by own time:\n')
+                stats.sort_stats('tottime').print_stats(top)
+                out.write('Top functions by cumulative time:\n')
+                stats.sort_stats('cumulative').print_stats(top)
+            if stage['sites']:
+                out.write('Top allocation sites (memory held at the end of the stage):\n')
+                for site, (size, count) in sorted(stage['sites'].items(), key = lambda x: -x[1][0])[:top]:
+                    out.write('{:>12,} bytes {:>10,} blocks   {}\n'.format(size, count, site))
+        return out.getvalue()
+
+
+    def write_report(self, outdir = None, top = 20):
+        """
+        Writes the text report (report.txt), a JSON summary (profile.json) and one pstats file per stage
+        (<stage>.prof, for pstats or snakeviz) to a new directory for this run under outdir (default =
+        config.profile_dir).  Returns the directory path.
+        """
+        outdir = os.path.join(outdir if outdir != None else config.profile_dir, \
+                              'profile-{}-{}'.format(self.started, self._pid))
+        os.makedirs(outdir, exist_ok = True)
+        with open(os.path.join(outdir, 'report.txt'), 'w') as f:
+            f.write(self.report(top = top))
+        with open(os.path.join(outdir, 'profile.json'), 'w') as f:
+            json.dump(self.summary(top = top), f, indent = 1)
+        with self._lock:
+            stages = list(self.stages.items())
+        for name, stage in stages:
+            if stage['stats']:
+                stage['stats'].dump_stats(os.path.join(outdir, name + '.prof'))
+        return outdir
+
+
+# Package-wide profiler used by all instrumented code.
+profiler = stage_profiler()
+
+
+@atexit.register
+def _write_report_at_exit():
+    # Worker processes hand their profiles to the calling process and never write reports themselves.
+    if profiler.enabled and profiler.stages and os.getpid() == profiler._pid:
+        try:
+            print('Profile report written to {}'.format(profiler.write_report()))
+        except Exception as inst:
+            print(inst)
+
+
+def enable(memory = None):
+    """
+    Starts profiling stages with the package-wide profiler, tracing memory allocations too unless memory
+    is False (default = config.profile_memory).
+    """
+    if memory != None:
+        profiler.memory = memory
+    profiler.enabled = True
+
+
+def disable():
+    """
+    Stops profiling.  Profiles collected so far are kept.
+    """
+    profiler.enabled = False
+
+
+def stage(name, memory = None):
+    return profiler.stage(name, memory = memory)
+
+
+def reset():
+    profiler.reset()
+
+
+def summary(top = 20):
+    return profiler.summary(top = top)
+
+
+def report(top = 20):
+    return profiler.report(top = top)
+
+
+def write_report(outdir = None, top = 20):
+    return profiler.write_report(outdir = outdir, top = top)
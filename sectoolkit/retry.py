@@ -0,0 +1,147 @@
+import socket
+import random
+import http.client
+import urllib.error
+import email.utils
+from time import time, sleep
+
+from . import config
+from . import metrics
+
+
+# HTTP statuses that are worth trying again: rate limiting and transient server errors.
+retry_statuses = (429, 500, 502, 503, 504)
+# HTTP statuses the SEC website sends when requests come in too fast.
+throttle_statuses = (429, 503)
+# Network errors that usually go away on their own.
+_transient_errors = (ConnectionError, TimeoutError, socket.timeout, http.client.HTTPException, EOFError)
+
+
+def http_status(inst):
+    """
+    Returns the HTTP status code of an exception raised by a download, or None if it is not an HTTP error.
+    """
+    return inst.code if isinstance(inst, urllib.error.HTTPError) else None
+
+
+def retry_after(inst):
+    """
+    Returns the number of seconds the server asked to wait in the Retry-After header of an HTTP error, or
+    None if it did not say.
+    """
+    headers = getattr(inst, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttle(inst):
+    """
+    True if a download failed because the server is throttling requests.
+    """
+    return http_status(inst) in throttle_statuses
+
+
+def describe_failure(inst):
+    """
+    Returns a dictionary describing a failed download: the error, its HTTP status (None for network errors),
+    the number of attempts made and whether trying again later may succeed.
+    """
+    status = http_status(inst)
+    if status is not None:
+        retryable = status in retry_statuses
+    else:
+        retryable = isinstance(inst, _transient_errors + (urllib.error.URLError,))
+    return {'error': '{}: {}'.format(type(inst).__name__, inst), 'http_status': status, \
+            'attempts': getattr(inst, 'attempts', 1), 'retryable': retryable}
+
+
+class retry_policy(object):
+
+    """
+    Retries failed SEC downloads with jittered exponential backoff.  Rate limiting and transient server
+    errors (HTTP 429, 500, 502, 503 and 504) and network errors are retried; other errors, such as 404 for
+    a file that does not exist, fail at once.  The n-th retry waits a random time between 0 and
+    backoff * 2 ** n seconds, capped at max_backoff, unless the server asked for a longer wait with a
+    Retry-After header.  Throttling responses (429 and 503) are also reported to the rate limiter, which
+    slows down all requests sharing it if it is adaptive (see limiter.rate_limiter).
+
+    Arguments:
+
+    max_retries :   (default = config.sec_max_retries) number of retries after the first attempt
+    backoff     :   (default = config.sec_retry_backoff) base delay in seconds
+    max_backoff :   (default = config.sec_retry_max_backoff) longest delay in seconds, also for Retry-After
+
+    Defaults are read from config on every use, so changes to config apply to existing policies.
+
+    """
+
+    def __init__(self, max_retries = None, backoff = None, max_backoff = None):
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+    @property
+    def max_retries(self):
+        return self._max_retries if self._max_retries != None else config.sec_max_retries
+
+    @property
+    def backoff(self):
+        return self._backoff if self._backoff != None else config.sec_retry_backoff
+
+    @property
+    def max_backoff(self):
+        return self._max_backoff if self._max_backoff != None else config.sec_retry_max_backoff
+
+    def retryable(self, inst):
+        return describe_failure(inst)['retryable']
+
+    def delay(self, attempt, inst = None):
+        """
+        Returns the number of seconds to wait before retry number attempt (counting from 0).
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        wait = retry_after(inst) if inst is not None else None
+        if wait is not None:
+            # Spread out the clients that were all told to come back at the same time.
+            delay = max(delay, min(self.max_backoff, wait) + random.uniform(0, self.backoff))
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs), retrying it as long as it fails with a retryable error and retries
+        are left.  The limiter and verbose keyword arguments, if any, are also used here.  The exception of
+        the last attempt is raised with the number of attempts made in its attempts attribute.
+        """
+        limiter = kwargs.get('limiter')
+        attempt = 0
+        while True:
+            try:
+                result = function(*args, **kwargs)
+            except Exception as inst:
+                if limiter is not None and is_throttle(inst):
+                    limiter.throttle()
+                if attempt >= self.max_retries or not self.retryable(inst):
+                    inst.attempts = attempt + 1
+                    raise
+                delay = self.delay(attempt, inst)
+                metrics.inc('download_retries_total', reason = http_status(inst) or type(inst).__name__)
+                if kwargs.get('verbose'):
+                    print('Retrying in {:.1f} seconds after {}: {}'.format(delay, type(inst).__name__, inst))
+                sleep(delay)
+                attempt += 1
+            else:
+                if limiter is not None:
+                    limiter.recover()
+                return result
+
+
+# Used by the downloaders unless they are given a policy of their own.
+default_policy = retry_policy()
@@ -1,4 +1,3 @@
-from bs4 import BeautifulSoup
 import urllib
 import pandas as pd
 from time import time
@@ -12,17 +11,27 @@ import webbrowser as wb
 from datetime import timedelta
 
 # Sub-package imports
-from .config import default_datadir, sec_base_url, binary_file_types
+from .config import default_datadir, binary_file_types
 from .utils import seclimiter, timer, fetch_sec_file
+from .cache import map_cached, open_cached, remove_cached
+from .manifest import get_manifest
+from .archive import scan_documents, acceptance_datetime, document_soup, document_entry, documents, \
+	decode_document
 from .secmeta import headerfile
 from .formparsers import parsers
+from . import config
+from . import metrics
+from . import profiling
 
 
 class filingDocument(object):
 
 	
 	"""
-	This class represents an SEC filing document contained within a single filing archive file. 
+	This class represents an SEC filing document contained within a single filing archive file.  Only the 
+	document's metadata and its location in the locally cached archive are held in memory; body and html 
+	are parsed from the archive on first access and kept in a shared, size-bounded cache (see 
+	config.document_cache_size).
 
 	...
 
@@ -37,9 +46,15 @@ class filingDocument(object):
 		followed by supporting exhibits, news releases, etc.
 	description : str
 		file description field as shown in the SEC filing archive file
+	localpath : str
+		path of the locally cached filing archive containing the document
+	start, end : int
+		byte offsets of the document, including its <DOCUMENT> tags, in the uncompressed archive
+	text : int
+		byte offset of the document's <TEXT> tag, or -1 if the document has no text section
 	body : str
 		file content stripped of html markup - note that for binary files this field is stored in uuencoded form
-	html : str
+	html : BeautifulSoup tag
 		complete file contents - note that for binary files this field is stored in uuencoded form
 
 
@@ -50,18 +65,69 @@ class filingDocument(object):
 		file type.
 	"""
 
+	__slots__ = ('filename', 'type', 'sequence', 'description', 'localpath', 'start', 'end', 'text', \
+		'parser', 'parsed')
+
 	
-	def __init__(self, fileName, fileType, sequence, description, bstext, bsdoc):
+	def __init__(self, fileName, fileType, sequence, description, localpath, start, end, text = -1):
 
 		self.filename = fileName
 		self.type = fileType
 		self.sequence = sequence
 		self.description = description
-		self.body = bstext
-		self.html = bsdoc
+		self.localpath = localpath
+		self.start = start
+		self.end = end
+		self.text = text
 		self.parser = ''
 		self.parsed = {}
 
+
+	def _entry(self):
+		return document_entry(self.start, self.end, self.text, self.type, self.sequence, self.filename, \
+			self.description)
+
+
+	@property
+	def html(self):
+		key = (self.localpath, self.start, 'html')
+		doc = documents.get(key)
+		if doc is None:
+			with map_cached(self.localpath) as data:
+				doc = document_soup(data, self._entry())
+			# A parse tree takes several times the memory of the raw document.
+			documents.put(key, doc, 8 * (self.end - self.start))
+		return doc
+
+
+	@property
+	def body(self):
+		if self.text < 0:
+			return '_'
+		key = (self.localpath, self.start, 'body')
+		text = documents.get(key)
+		if text is None:
+			text = self.html.get_text()
+			documents.put(key, text, len(text))
+		return text
+
+
+	def decode(self, outpath = None):
+		"""
+		Returns the decoded content of the document as bytes.  Binary files such as PDFs, images and 
+		spreadsheets, which are stored uuencoded or base64 encoded in the archive, are decoded straight from 
+		the memory-mapped cached archive without reading the rest of it.  If outpath is supplied, the content 
+		is written to that file instead and outpath is returned.
+		"""
+		with map_cached(self.localpath) as data:
+			if outpath == None:
+				return decode_document(data, self._entry())
+			pathlib.Path(outpath).parent.mkdir(parents=True, exist_ok=True)
+			with open(outpath, 'wb') as f:
+				decode_document(data, self._entry(), f)
+		return outpath
+
+
 	def parse(self, **kwargs):
 
 		# First check to see whether a custom parser has been specified in the self.parser instance variable.
@@ -100,18 +166,26 @@ class filingArchive(object):
                             where locally cached SEC files will be stored.
     rate_limiter        :   (defaults to rate_limiter class provided in limiter sub-package)
     binary_file_types   :   (defaults to ['gz', 'zip', 'Z'])
+    session             :   (default = None) sec_session used for downloads of the archive and its header 
+                            file.  Defaults to the package-wide session with persistent connections.
+    manifest            :   (default = None) cache_manifest listing the locally cached files.  By default 
+                            the manifest.sqlite database in the data directory is used, through one instance 
+                            shared within the process (see manifest.get_manifest()).
     
 		
 	"""
 
 	def __init__(self, sec_filepath, datadir = default_datadir, ratelimiter = seclimiter, \
-		user_agent = None, binary_file_types = ['gz', 'zip', 'Z']):
+		user_agent = None, binary_file_types = ['gz', 'zip', 'Z'], session = None, manifest = None):
 		self.user_agent = user_agent
 		self.binary_types = binary_file_types
 		self.limiter = ratelimiter
+		self.session = session
+		self.manifest = manifest if manifest != None else get_manifest(datadir)
 		self.sec_filepath = sec_filepath
-		self.header = headerfile(self.sec_filepath, datadir = datadir, user_agent = self.user_agent).get_headerDict()
-		self.filingURL = sec_base_url + self.sec_filepath
+		self.header = headerfile(self.sec_filepath, datadir = datadir, rate_limiter = self.limiter, \
+			user_agent = self.user_agent, session = self.session, manifest = self.manifest).get_headerDict()
+		self.filingURL = config.sec_base_url + self.sec_filepath
 		self.filingsdir = datadir + os.sep + 'filings'
 		_, _, cik, fname = self.sec_filepath.split('/')
 		self.localfilename = os.sep.join([self.filingsdir, cik, fname])
@@ -131,7 +205,7 @@ class filingArchive(object):
 		"""
 		Verify that file is present in the local cache.
 		"""
-		return os.path.exists(self.localfilename)
+		return self.manifest.exists(self.localfilename)
 
 	
 	def get_filingArchive(self, document_types = 'ALL', text_only = True, verbose = False):
@@ -145,48 +219,29 @@ class filingArchive(object):
 	
 		text_suffixes = ['txt','htm','html']
 
-		# Read locally cached filing if it exists, or fetch the filing from the SEC website.
+		# Fetch the filing from the SEC website unless it is already present in the local cache.
 		try:
-			if os.path.exists(self.localfilename):
-				with open(self.localfilename, 'r') as f:
-					# data = f.read().decode('latin-1')
-					data = f.read()
-			else:
-				_, data = fetch_sec_file(self.filingURL, self.localfilename, content = True, \
-					limiter = self.limiter, user_agent = self.user_agent, verbose = verbose)
-
-			# Parse file content
-			soup = BeautifulSoup(data, 'lxml')
+			if not self.manifest.exists(self.localfilename):
+				metrics.inc('cache_lookups_total', kind = 'filing', result = 'miss')
+				if fetch_sec_file(self.filingURL, self.localfilename, limiter = self.limiter, \
+					user_agent = self.user_agent, verbose = verbose, session = self.session, \
+					manifest = self.manifest) == None:
+					return
 
-			if soup.find('acceptance-datetime'):
-					self.acceptance_datetime = soup.find('acceptance-datetime').contents[0].strip()[:14]
+			else:
+				metrics.inc('cache_lookups_total', kind = 'filing', result = 'hit')
+			self.manifest.touch([self.localfilename])
 
+			# Locate documents with a byte-level scan of the archive.  Documents that pass the document type 
+			# and text_only filters are only parsed when their body or html is first used.
 			self.files = []
-
-			for doc in soup.find_all('document'):
-				if doc.find('filename'):
-					fn = doc.find('filename').contents[0].strip()
-				else:
-					fn = '_'
-				if doc.find('type'):
-					doc_type = doc.find('type').contents[0].strip()
-				else:
-					doc_type = '_'
-				if doc.find('sequence'):
-					sequence = doc.find('sequence').contents[0].strip()
-				else:
-					sequence = '_'
-				if doc.find('description'):
-					description = doc.find('description').contents[0].strip()
-				else:
-					description = '_'
-				if doc.find('text'):
-					text = doc.get_text()
-				else:
-					text = '_'
-				if doc_type in self.doc_types or self.doc_types == 'ALL':
-					if (fn.split('.')[-1] in text_suffixes) or not self.text_only:
-						self.files.append(filingDocument(fn, doc_type, sequence, description, text, doc))
+			with map_cached(self.localfilename) as data, profiling.stage('filingArchive.get_filingArchive'):
+				self.acceptance_datetime = acceptance_datetime(data)
+				for entry in scan_documents(data):
+					if entry.type in self.doc_types or self.doc_types == 'ALL':
+						if (entry.filename.split('.')[-1] in text_suffixes) or not self.text_only:
+							self.files.append(filingDocument(entry.filename, entry.type, entry.sequence, \
+								entry.description, self.localfilename, entry.start, entry.end, entry.text))
 
 			if verbose:
 				for f in self.files:
@@ -213,13 +268,14 @@ class filingArchive(object):
 		# Make sure that the directory path exists
 		path = pathlib.Path(newfilepath)
 		path.parent.mkdir(parents=True, exist_ok=True)
-		# Copy the file to the new location
-		shutil.copyfile(self.localfilename, newfilepath)
+		# Copy the file to the new location, decompressing it if it is stored compressed
+		with open_cached(self.localfilename, 'rb') as src, open(newfilepath, 'wb') as dst:
+			shutil.copyfileobj(src, dst)
 
 
 	def delete_filingArchive(self):
-		if os.path.exists(self.localfilename):
-			os.remove(self.localfilename)
+		remove_cached(self.localfilename)
+		self.manifest.remove([self.localfilename])
 		# Add some additional code here to delete the current directory and parent directory if the are now empty
 
 
@@ -4,14 +4,61 @@ import urllib
 import urllib.request
 import os.path
 import pathlib
-import xmltodict
 import json
+import shutil
 from tqdm.notebook import tqdm
-import multiprocessing as mp 
 import re
 
-from .config import default_datadir, sec_base_url, binary_file_types
-from .utils import seclimiter, timer, fetch_sec_file
+from .config import default_datadir, binary_file_types, sec_max_workers
+from .utils import seclimiter, timer, fetch_sec_file, fetch_sec_files, fetch_if_modified
+from .session import sec_session
+from .cache import migrate_cache, open_cached
+from .manifest import get_manifest, cache_sweeper
+from .textindex import text_index
+from .tickers import get_ticker_lookup
+from . import config
+from . import metrics
+from . import profiling
+from .sgml import read_sgml_header, header_records, header_columns
+from .archive import extract_documents, parse_archive_documents
+from .bulk import record_sink
+from .pool import worker_pool
+from .idxstore import read_index_store, convert_index_file, store_is_current, \
+    categorical_columns, index_columns, posting_index, name_index, quarter_overlaps, store_path, store_keys, \
+    new_records, append_to_store, last_date_filed, read_daily_index_file, filter_index_frame, quarter_key
+
+
+def _extract_filing_documents(item, document_types, suffixes):
+    # Pool worker for idx.extract_documents(); item is a (cached archive path, output directory) tuple.
+    return extract_documents(item[0], item[1], document_types = document_types, suffixes = suffixes)
+
+
+
+def _parse_filing_chunk(chunk, document_types):
+    # Pool worker for idx.parse_filings(); chunk is a list of (accession number, cached archive path) tuples.
+    records = []
+    for accession, localpath in chunk:
+        try:
+            parsed = parse_archive_documents(localpath, document_types = document_types)
+        except Exception as e:
+            parsed = [{'Error': '{}: {}'.format(type(e).__name__, e)}]
+        for record in parsed:
+            records.append(dict({'Accession': accession}, **record))
+    return [x[0] for x in chunk], records
+
+# Number of part files in the parsed header cache above which they are merged into one.
+_header_cache_max_parts = 32
+
+
+def _header_file_paths(sec_filename, hdrdir, sec_base):
+    # Retrieval URL of the SGML header file of a filing, given the SEC filepath from its index record and
+    # the base URL of the SEC Archives, and the local filepath where it is cached under hdrdir.
+    _, _, cik, fname = sec_filename.split('/')
+    fname_body = fname.split('.')[0]
+    new_fname = fname_body+'.hdr.sgml'
+    hdrfilepath = os.sep.join([hdrdir, cik, new_fname])
+    url = sec_base+'edgar/data/'+'/'.join([cik, ''.join(fname_body.split('-')), new_fname])
+    return url, hdrfilepath
 
 
 class idx(object):
@@ -36,6 +83,16 @@ class idx(object):
     end_quarter         :   (default = 4)
     rate_limiter        :   (defaults to rate_limiter class provided in limiter sub-package)
     binary_file_types   :   (defaults to ['gz', 'zip', 'Z'])
+    session             :   (default = None) sec_session used for all downloads.  By default a new session
+                            with persistent connections is created for the user_agent and shared with
+                            the headerfile objects created by this instance.
+    pool                :   (default = None) worker_pool used to spread index conversion, filtering and 
+                            bulk parsing over several CPU cores.  By default a process pool with one 
+                            worker per core (see config.pool_backend) is created on first use and kept 
+                            for the life of the instance.  Pass worker_pool('serial') for debugging.
+    manifest            :   (default = None) cache_manifest listing the locally cached files.  By default 
+                            the manifest.sqlite database in the data directory is used, through one instance 
+                            shared within the process (see manifest.get_manifest()).
 
     """
     
@@ -43,26 +100,41 @@ class idx(object):
     def __init__(self, datadir = default_datadir, start_year = 1993, \
                  start_quarter = 1, end_year = 0, end_quarter = 4, \
                  rate_limiter = seclimiter, \
-                 user_agent = None, binary_file_types = binary_file_types):
+                 user_agent = None, binary_file_types = binary_file_types, session = None, pool = None, \
+                 manifest = None):
         self.user_agent = user_agent
+        self.session = session if session != None else sec_session(user_agent = user_agent)
+        self.pool = pool if pool != None else worker_pool()
         self.binary_types = binary_file_types
         self.datadir = datadir
         self.idxdir = os.path.join(self.datadir, 'idxfiles')
         self.hdrdir = os.path.join(self.datadir, 'headerfiles')
         self.filingsdir = os.path.join(self.datadir, 'filings')
-        self.parsed_header_cache = os.path.join(self.datadir, 'parsed_header_cache.p')
-        self.sec_base = sec_base_url
+        self.manifest = manifest if manifest != None else get_manifest(self.datadir)
+        self.text_index = text_index(self.datadir)
+        self.parsed_header_cache = os.path.join(self.datadir, 'parsed_headers')
+        self.refresh_state = os.path.join(self.idxdir, 'refresh.json')
+        self.delta_path = os.path.join(self.idxdir, 'delta.parquet')
+        self.delta_idx = pd.DataFrame(columns = index_columns)
+        self.sec_base = config.sec_base_url
         self.limiter = rate_limiter
         self.beg_yr = start_year
         self.beg_qtr = start_quarter
         self.end_yr = end_year
         self.end_qtr = end_quarter
+        self.postings = posting_index(self.idxdir)
+        self.names = name_index(self.idxdir)
         self.idxlist = self.updateidx()
         self.hdrlist = []
         self.filinglist = []
         self.localparsed = []
         self.working_idx = pd.DataFrame() # initialize as empty dataframe to avoid exceptions
         self.working_paths = []
+        self.fetch_failures = []
+        self.header_failures = []
+        self.sweeper = None
+        if config.cache_sweep_interval:
+            self.start_cache_sweeper()
         
         
     def _idxurls(self):
@@ -85,27 +157,32 @@ class idx(object):
                 eq = self.end_qtr
             for i in range(bq, eq + 1):
                 yq.append([y,i])  
-        return ['https://www.sec.gov/Archives/edgar/full-index/%d/QTR%s/master.gz' % (x[0], x[1]) for x in yq]
+        return [self.sec_base + 'edgar/full-index/%d/QTR%s/master.gz' % (x[0], x[1]) for x in yq]
 
                 
-    def _filter_index_file(self, file, filters, verbose = False):
+    @staticmethod
+    def _filter_index_file(file, filters, row_groups = None, date_range = None, verbose = False):
         """
-        Apply row filters specified in filters dictionary to a particular index file.  An empty filter
-        dictionary will return the entire index file.
-
-        Note: Filtering on date ranges is not yet supported.
+        Apply row filters specified in filters dictionary to a particular index file.  Filters are pushed 
+        down into the columnar store for the quarter, so only matching rows are materialized.  If a list 
+        of row groups is supplied, only those parts of the store are read.  An optional (start, end) 
+        date_range restricts the 'Date Filed' column.  An empty filter dictionary will return the entire 
+        index file.
         """
         if verbose:
             print(file, '\n')
-        df = pd.read_csv(file, sep = '|', skiprows = 9, compression = 'gzip', \
-        	parse_dates = [3], encoding = 'latin-1', low_memory = False)
-        df.dropna(inplace = True)
-        # Apply filters
-        ## More work needed on this section to support filtering on date ranges
-        ## and fuzzy matching on company names
-        for key in filters.keys():
-            df = df[df[key].isin(filters[key])]
-        return df
+        return read_index_store(file, filters, row_groups = row_groups, date_range = date_range)
+
+
+    @staticmethod
+    def _filter_index_part(part, filters, date_range = None, verbose = False):
+        """
+        Apply row filters to one (index file, row groups) entry of a posting index query plan.  Static, so
+        that worker processes receive only the plan entry and not the whole idx instance.
+        """
+        file, row_groups = part
+        return idx._filter_index_file(file, filters, row_groups = row_groups, date_range = date_range, \
+                                       verbose = verbose)
 
 
     def _clear_local_cache(self, localdir, suffix = None):
@@ -126,30 +203,12 @@ class idx(object):
                     os.rmdir(dpath)
       
     
-    def _catalog_local_files(self, localdir, suffix = None):
-        localfiles = []
-        for root, dirs, files in os.walk(localdir, topdown=False):
-            for fname in files:
-                fpath = os.sep.join([root, fname])
-                if suffix:
-                    if fname.endswith(suffix):
-                        localfiles.append(fpath)
-                else:
-                    localfiles.append(fpath)
-        return localfiles
-    
-    
     def _convert_sec_filename(self, sec_filename):
         """
         Accepts SEC filepath as input and returns retrieval URL for SGML header file and 
         local filepath where header file may be cached.
         """
-        _, _, cik, fname = sec_filename.split('/')
-        fname_body = fname.split('.')[0]
-        new_fname = fname_body+'.hdr.sgml'
-        hdrfilepath = os.sep.join([self.hdrdir, cik, new_fname])
-        url = self.sec_base+'/'.join([cik, ''.join(fname_body.split('-')), new_fname])
-        return url, hdrfilepath
+        return _header_file_paths(sec_filename, self.hdrdir, self.sec_base)
     
     
     def _get_working_paths(self):
@@ -167,57 +226,109 @@ class idx(object):
             return working_paths
     
 
-    def _process_files(self, function, filelist, func_args, max_processes = 0, \
-                       verbose = False):
+    def _read_refresh_state(self):
+        if os.path.exists(self.refresh_state):
+            with open(self.refresh_state, 'r') as f:
+                return json.load(f)
+        return {'validators': {}, 'daily': {}}
+
+
+    def _write_refresh_state(self, state):
+        tmppath = self.refresh_state + '.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmppath, self.refresh_state)
+
+
+    def _fetch_index_file(self, url, localpath, state, verbose = False):
         """
-        This utility function makes use of multiple CPU cores to run the same function on multiple
-        input files.  It returns function output to the calling function in list form for aggregation.
+        Fetches an index file with a conditional GET, so that an unchanged file costs a single 304 response.  
+        Returns True if a new version was downloaded.  Errors are reported and treated as unchanged.
+        """
+        try:
+            modified, validators = fetch_if_modified(url, localpath, state['validators'].get(url), \
+                limiter = self.limiter, user_agent = self.user_agent, verbose = verbose, session = self.session, \
+                manifest = self.manifest)
+        except Exception as inst:
+            print(url)
+            print(inst)
+            return False
+        state['validators'][url] = validators
+        return modified
+
 
+    def _apply_daily_indexes(self, idxpath, state, verbose = False):
         """
-        
-        files = [x for x in filelist if x != None]
-        completed = []
-        inprocess = []
-        if mp.cpu_count() <= max_processes or max_processes == 0:
-            nprc = mp.cpu_count()
-        else:
-            nprc = max_processes
-        if verbose:
-            print('Processing {} files ...'.format(len(files)))
-            print('Number of CPUs: ', nprc)
-        with mp.Pool(processes = nprc) as pool:
-            for file in files:
-                r = pool.apply_async(function, (file, *func_args), \
-                                     callback=completed.append)
-                inprocess.append(r)
-            for r in inprocess:
-                r.wait()
+        Adds filings from the EDGAR daily index files of a quarter that are newer than its cached master.gz 
+        file to the quarter's columnar store.  The daily index directory listing is fetched with a 
+        conditional GET, and only daily files that have not been applied yet are fetched.  Returns the 
+        records that were added.
+        """
+        qkey = quarter_key(idxpath)
+        applied = state['daily'].setdefault(qkey, [])
+        listing_url = self.sec_base + 'edgar/daily-index/' + qkey + '/index.json'
+        dailydir = os.path.join(self.idxdir, 'daily', *qkey.split('/'))
+        listing_path = os.path.join(dailydir, 'index.json')
+        self._fetch_index_file(listing_url, listing_path, state, verbose = verbose)
+        if not self.manifest.exists(listing_path):
+            return pd.DataFrame(columns = index_columns)
+        with open_cached(listing_path, 'r') as f:
+            items = json.load(f)['directory']['item']
+        dates = sorted(m.group(1) for m in (re.match(r'master\.(\d{8})\.idx$', x['name']) for x in items) if m)
+        # The master.gz file covers complete days up to its last filing date, so only that day and later 
+        # days can hold new filings.
+        last = last_date_filed(idxpath)
+        first = last.strftime('%Y%m%d') if last is not None else ''
+        todo = [x for x in dates if x >= first and x not in applied]
+        if len(todo) == 0:
+            return pd.DataFrame(columns = index_columns)
         if verbose:
-            print('Finished processing files.')
-            
-        return completed
-                
-            
+            print('Applying {} daily index files for {} ...'.format(len(todo), qkey))
+        fetchlist = [(self.sec_base + 'edgar/daily-index/' + qkey + '/master.{}.idx'.format(x), \
+                      os.path.join(dailydir, 'master.{}.idx'.format(x))) for x in todo]
+        cached = self.manifest.existing(x[1] for x in fetchlist)
+        fetched, failed = fetch_sec_files([x for x in fetchlist if x[1] not in cached], \
+            limiter = self.limiter, user_agent = self.user_agent, verbose = verbose, session = self.session, \
+            manifest = self.manifest)
+        cached.update(fetched)
+        daily = []
+        for date, (url, localpath) in zip(todo, fetchlist):
+            if localpath in cached:
+                daily.append(read_daily_index_file(localpath))
+                applied.append(date)
+        if len(daily) == 0:
+            return pd.DataFrame(columns = index_columns)
+        return append_to_store(idxpath, pd.concat(daily, ignore_index = True))
+
+
     @timer
     def updateidx(self, verbose = False):
         """
         Updates the locally cached quarterly index files for the date range specified in the instance dict.
-        By default the most recent quarterly index file included in the local cache is deleted and replaced 
-        by the most current version available from the SEC website.
+        Missing quarterly index files are downloaded.  The most recent cached quarterly index file is 
+        refreshed with a conditional GET, so it is only downloaded again if the SEC has updated it, and 
+        filings from the EDGAR daily index files that are newer than it are added to its columnar store.  
+        Records that were not present before the update are kept in the delta_idx attribute (see 
+        filter_index(new_only = True)).
 
         """
-        ## Also need to suppress timer report if verbose output has not been requested
-        # if verbose:
         print("Updating locally cached SEC index files...")
         
-        # Catalog locally saved index files
-        idxlocal = self._catalog_local_files(self.idxdir, suffix = 'gz')
+        # Look up which of the quarterly index files in the date range are cached locally.
+        idxurls = self._idxurls()
+        idxpaths = [self.idxdir+os.sep+os.sep.join(url.split('/')[-3:]) for url in idxurls]
+        idxlocal = self.manifest.existing(idxpaths)
+        metrics.inc('cache_lookups_total', len(idxlocal), kind = 'index', result = 'hit')
+        metrics.inc('cache_lookups_total', len(idxpaths) - len(idxlocal), kind = 'index', result = 'miss')
+        state = self._read_refresh_state()
+        # On the very first update every record is new, so no delta is kept.
+        first_update = 'last_refresh' not in state
         
-        # Drop the most recently saved idx file since it may be incomplete.
+        # The most recently saved idx file may be incomplete, so it is refreshed if it has changed.  It is the 
+        # latest cached quarter of the date range.
+        last = None
         if len(idxlocal) > 0:
-            idxlocal.sort()
-            last = idxlocal.pop()
-            os.remove(last)
+            last = [x for x in idxpaths if x in idxlocal][-1]
         else:
             if verbose:
                 print("You don't seem to have any SEC index files cached in your data directory.")
@@ -225,24 +336,86 @@ class idx(object):
 
         # Fetch any missing idxfiles
         idxlist = []
+        refreshed = []
         ## Need to fix first day of the quarter problem with self._idxurls()
-        for url in tqdm(self._idxurls()):
-            idxpath = self.idxdir+os.sep+os.sep.join(url.split('/')[-3:])
-            if idxpath not in idxlocal:
-                path = pathlib.Path(idxpath)
-                path.parent.mkdir(parents=True, exist_ok=True)
-                fname = fetch_sec_file(url, idxpath, user_agent = self.user_agent, verbose = verbose)
-            idxlist.append(idxpath)
+        for url, idxpath in tqdm(list(zip(idxurls, idxpaths))):
+            if idxpath not in idxlocal or idxpath == last:
+                if self._fetch_index_file(url, idxpath, state, verbose = verbose):
+                    refreshed.append(idxpath)
+            # Quarters whose index file could not be fetched, such as a quarter the SEC has not published 
+            # yet, are left out so that filter_index() does not try to read them.
+            if os.path.exists(idxpath):
+                idxlist.append(idxpath)
+            elif verbose:
+                print('No index file for {}, skipping this quarter.'.format(url))
+
+        # Remember which records a refreshed quarter held before, so that new records can be identified.
+        previous = {}
+        for idxpath in refreshed:
+            if os.path.exists(store_path(idxpath)):
+                previous[idxpath] = store_keys(idxpath)
+            # Records applied from daily index files are replaced by the new master.gz file.
+            state['daily'].pop(quarter_key(idxpath), None)
+
+        # Convert any new or refreshed index files into typed columnar stores so that filter_index()
+        # never has to parse the raw index files again.
+        unconverted = [x for x in idxlist if os.path.exists(x) and not store_is_current(x)]
+        if len(unconverted) > 0:
+            if verbose:
+                print('Converting {} index files to columnar stores ...'.format(len(unconverted)))
+            for _ in self.pool.map(convert_index_file, unconverted):
+                pass
+
+        delta = []
+        if not first_update:
+            for idxpath in refreshed:
+                if idxpath in previous:
+                    delta.append(new_records(read_index_store(idxpath), previous[idxpath]))
+                elif os.path.exists(idxpath):
+                    delta.append(read_index_store(idxpath))
+
+        # Add filings from the daily index files that are newer than the latest quarterly index file.
+        current = [x for x in idxlist if os.path.exists(x)]
+        if len(current) > 0:
+            added = self._apply_daily_indexes(current[-1], state, verbose = verbose)
+            if not first_update:
+                delta.append(added)
+
+        # Bring the CIK and form type posting lists and the company name index up to date for any new 
+        # or refreshed quarters.
+        self.postings.update(self.postings.stale(idxlist), verbose = verbose)
+        self.names.update(self.names.stale(idxlist), verbose = verbose)
+
+        # Keep the records added by this update, also on disk for the next session.
+        delta = [x for x in delta if len(x) != 0]
+        self.delta_idx = pd.concat(delta, ignore_index = True) if len(delta) > 0 else \
+            pd.DataFrame(columns = index_columns)
+        for col in categorical_columns:
+            self.delta_idx[col] = self.delta_idx[col].astype(str).astype('category')
+        self.delta_idx.to_parquet(self.delta_path, index = False)
+        state['last_refresh'] = datetime.datetime.now().isoformat()
+        self._write_refresh_state(state)
+        if verbose:
+            print('{} new index records.'.format(len(self.delta_idx)))
             
         return idxlist
+
+
+    def refresh(self, filters = {}, verbose = False):
+        """
+        Brings the cached index up to date (see updateidx()) and returns the records added since the 
+        previous update that match the filters, which also become the working index.  Unchanged index files 
+        cost a single 304 response each, so this is cheap enough to run every few minutes.
+        """
+        self.idxlist = self.updateidx(verbose = verbose)
+        return self.filter_index(filters, new_only = True, verbose = verbose)
        
     
     def show_index_fields(self):
         """
         Return index file column names and data types.
         """
-        df = pd.read_csv(self.idxlist[-1], sep = '|', skiprows = 9, compression = 'gzip', \
-        	parse_dates = [3], encoding = 'latin-1', low_memory = False, nrows = 5)
+        df = read_index_store(self.idxlist[-1])
         return df.dtypes
     
     
@@ -251,86 +424,287 @@ class idx(object):
         Read the a specified number of rows from the index file for the most recent quarter in the date range
         specified in the instance dict.
         """
-        df = pd.read_csv(self.idxlist[-1], sep = '|', skiprows = 9, compression = 'gzip', \
-        	parse_dates = [3], encoding = 'latin-1', low_memory = False)
+        df = read_index_store(self.idxlist[-1])
         return df.tail(rows)
     
 
+    def match_company_names(self, company_name, threshold = 0.5, limit = None):
+        """
+        Return a dataframe of company names from the cached index files that approximately match the 
+        supplied name, together with their trigram similarity scores, best matches first.
+
+        Arguments:
+
+        company_name    :   Company name, or part of a company name, to match.
+        threshold       :   (default = 0.5)  Minimum similarity score between 0 and 1.
+        limit           :   (default = None)  Maximum number of matches to return.
+
+        """
+        return self.names.match(company_name, threshold = threshold, limit = limit)
+
+
     @timer
-    def filter_index(self, filters = {}, verbose = False):
+    def filter_index(self, filters = {}, start_date = None, end_date = None, company_name = None, \
+                     name_threshold = 0.5, new_only = False, verbose = False):
         """
         Apply filters to the full set of index files for the date range specified in the index dict
         to create a working index.
 
         Arguments:
 
-        filters     :   (default = {})  Specify a dictionary containing column specific row filters to 
-                        be applied to the index files.
-        verbose     :   (default = False)
+        filters         :   (default = {})  Specify a dictionary containing column specific row filters to 
+                            be applied to the index files.
+        start_date      :   (default = None)  Earliest 'Date Filed' to include.  Quarters ending before this
+                            date are not opened.
+        end_date        :   (default = None)  Latest 'Date Filed' to include.  Quarters starting after this
+                            date are not opened.
+        company_name    :   (default = None)  Include only filings by companies whose names approximately
+                            match this string (see match_company_names()).
+        name_threshold  :   (default = 0.5)  Minimum similarity score for company name matches.
+        new_only        :   (default = False)  Only include records added by the last index update, i.e. 
+                            filings that have appeared since the previous refresh (see refresh()).
+        verbose         :   (default = False)
 
         """
         
         # Initialize a dataframe that will contain filtered index records
-        self.working_idx = pd.DataFrame()
+        self.working_idx = pd.DataFrame(columns = index_columns)
+
+        # Translate an approximate company name into an exact filter on the matching names.
+        filters = dict(filters)
+        if company_name is not None:
+            matches = list(self.match_company_names(company_name, threshold = name_threshold)['Company Name'])
+            if 'Company Name' in filters:
+                matches = [x for x in matches if x in set(filters['Company Name'])]
+            if verbose:
+                print('{} company names match "{}".'.format(len(matches), company_name))
+            if len(matches) == 0:
+                return self.working_idx
+            filters['Company Name'] = matches
+
+        # Skip quarters that fall entirely outside the requested date range.
+        date_range = None
+        if start_date is not None or end_date is not None:
+            date_range = (start_date, end_date)
+        idxlist = [x for x in self.idxlist if quarter_overlaps(x, date_range)]
+
+        # The delta view is small and held in memory, so it is filtered directly.
+        if new_only:
+            self.working_idx = filter_index_frame(self.delta_idx, filters, date_range)
+            if verbose:
+                print("Filtered index contains ", len(self.working_idx), " new records.")
+            return self.working_idx
         
         # Run filters on index files
         ## Need to improve this to allow for interactive, iterative, filtering.
+        # Use the posting index to skip quarters and row groups that cannot contain matching records.
+        plan = self.postings.plan(idxlist, filters)
         if verbose:
-            print('Filtering {} quarterly index files ...'.format(len(self.idxlist)))
-        filter_results = self._process_files(self._filter_index_file, self.idxlist, (filters,))
-        self.working_idx = pd.concat([x for x in filter_results if len(x) != 0]) 
+            print('Filtering {} of {} quarterly index files ...'.format(len(plan), len(self.idxlist)))
+        # Results arrive in quarter order; empty parts are dropped as they arrive.
+        filter_results = [x for x in self.pool.map(idx._filter_index_part, plan, (filters, date_range)) \
+                          if len(x) != 0]
+        if len(filter_results) > 0:
+            self.working_idx = pd.concat(filter_results)
+            # Per-quarter categories differ, so restore categorical dtypes after concatenation.
+            for col in categorical_columns:
+                self.working_idx[col] = self.working_idx[col].astype('category')
         if verbose:
             print("Filtered index contains ", len(self.working_idx), " records.")
         
         return self.working_idx
 
     
-    def fetch_headers(self, verbose = False):
+    @timer
+    def fetch_headers(self, max_workers = sec_max_workers, verbose = False):
         """
         Fetch any SGML header files for the current working index that are not already present in the
-        local cache.
+        local cache.  Up to max_workers requests are kept in flight at once under the shared rate limiter.
+        Files that could not be fetched are listed in the fetch_failures attribute.
         """
         
         if len(self.working_idx) == 0:
             print("Run filter_index() before fetch_header_files()...")
             return
                             
-        # Make sure that we have relevant paths for files in self.working_idx
-        if len(self.working_paths) == 0:
-            self.working_paths = self._get_working_paths()
+        # Header file paths for the files in self.working_idx, which may have changed since the last call.
+        self.working_paths = self._get_working_paths()
            
-        # Determine whether additional header files need to be fetched from the SEC
+        # Determine whether additional header files need to be fetched from the SEC, with a single manifest 
+        # lookup for the whole working index.
+        local = self.manifest.existing(x[1] for x in self.working_paths)
         fetchnum = 0
         self.hdrlist = []
-        for file in list(self.working_idx.Filename):
-            hdr = headerfile(file, datadir = self.datadir, user_agent = self.user_agent)
+        for file, (url, localpath) in zip(list(self.working_idx.Filename), self.working_paths):
+            hdr = headerfile(file, datadir = self.datadir, rate_limiter = self.limiter, \
+                             user_agent = self.user_agent, session = self.session, manifest = self.manifest, \
+                             islocal = localpath in local)
             if not hdr.islocal:
                 fetchnum += 1
             self.hdrlist.append(hdr)
+        metrics.inc('cache_lookups_total', len(self.hdrlist) - fetchnum, kind = 'header', result = 'hit')
+        metrics.inc('cache_lookups_total', fetchnum, kind = 'header', result = 'miss')
         
-        # Fetch any additional header files that are needed - single threaded because of SEC rate limit.
+        # Fetch any additional header files that are needed - concurrently, within the SEC rate limit.
+        self.fetch_failures = []
         if fetchnum != 0:
             if verbose:
                 print('Fetching {} header files ...'.format(fetchnum))
+            fetchlist = [(item.url, item.localpath) for item in self.hdrlist if not item.islocal]
+            fetched, self.fetch_failures = fetch_sec_files(fetchlist, limiter = self.limiter, \
+                user_agent = self.user_agent, max_workers = max_workers, verbose = verbose, \
+                session = self.session, manifest = self.manifest)
+            fetched = set(fetched)
             for item in self.hdrlist:
-                if not item.islocal:
-                    item.fetch_file(verbose = verbose)
+                if item.localpath in fetched:
+                    item.islocal = True
             if verbose:
                 print('Finished fetching header files.')
         else:
             if verbose:
                 print('All header files are present in the local cache.')
+        self.manifest.touch(item.localpath for item in self.hdrlist if item.islocal)
+
+
+    def attach_tickers(self, column = 'Ticker'):
+        """
+        Add the primary ticker of each filer's CIK to the current working index as a new column, with a 
+        single vectorized join against the shared ticker table (see tickers.ticker_lookup).  Filers without 
+        a listed ticker get a missing value.  Returns the updated working index.
+        """
+        lookup = get_ticker_lookup(self.datadir, user_agent = self.user_agent, session = self.session, \
+                                   limiter = self.limiter)
+        self.working_idx = lookup.attach_tickers(self.working_idx, column = column)
+        return self.working_idx
+
+
+    def _read_parsed_header_cache(self):
+        # The cache is a directory of Parquet part files, one per call that parsed new headers.
+        if not os.path.isdir(self.parsed_header_cache):
+            return pd.DataFrame(columns = header_columns + ['Error'])
+        parts = sorted(x for x in os.listdir(self.parsed_header_cache) if x.endswith('.parquet'))
+        frames = [pd.read_parquet(os.path.join(self.parsed_header_cache, x)) for x in parts]
+        if len(frames) == 0:
+            return pd.DataFrame(columns = header_columns + ['Error'])
+        parsed = pd.concat(frames, ignore_index = True)
+        if len(frames) > _header_cache_max_parts:
+            # Merge the parts once there are many, so that reading the cache stays fast.
+            self._write_parsed_header_cache(parsed, replace = parts)
+        return parsed
+
+
+    def _write_parsed_header_cache(self, parsed, replace = ()):
+        # Adds a part file holding newly parsed headers; the parts listed in replace are deleted once the new 
+        # part is in place.  Temporary files are renamed into place so that an interrupted run never leaves 
+        # a truncated part.
+        os.makedirs(self.parsed_header_cache, exist_ok = True)
+        name = 'part-{}-{}.parquet'.format(datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'), os.getpid())
+        path = os.path.join(self.parsed_header_cache, name)
+        parsed.to_parquet(path + '.tmp', index = False)
+        os.replace(path + '.tmp', path)
+        for part in replace:
+            os.remove(os.path.join(self.parsed_header_cache, part))
 
 
-    def fetch_filings(self, headers = False, verbose = False):
+    @timer
+    def get_parsed_headers(self, fetch = True, chunksize = 500, verbose = False):
+        """
+        Return a flat dataframe of SGML header data for the filings in the current working index, with
+        one row per filing entity (filer, subject company, filed-by party, reporting owner or issuer)
+        giving its role, CIK, name, SIC code, IRS number, state of incorporation, fiscal year end and
+        business address state and city, along with the form type, filing date, acceptance time and
+        period of the filing.
+
+        Parsed headers are kept in a persistent cache (parsed_header_cache) keyed by accession number.
+        Only headers that are not yet in the cache are parsed, in parallel on the worker pool, and added to
+        the cache as a new part file, so repeat calls over the same working index only read the cache.
+        Header files that cannot be parsed are recorded in the cache too, so they are not parsed again;
+        their accession numbers are listed in the header_failures attribute and they are left out of the
+        result.
+
+        Arguments:
+
+        fetch           :   (default = True)  Fetch header files that are not present in the local cache
+                            before parsing.  Otherwise filings without a cached header file are skipped.
+        chunksize       :   (default = 500)  Number of header files parsed per task by each worker.
+        verbose         :   (default = False)
+
+        """
+
+        if len(self.working_idx) == 0:
+            print("Run filter_index() before get_parsed_headers()...")
+            return pd.DataFrame(columns = header_columns)
+
+        accessions = [os.path.basename(x).split('.')[0] for x in self.working_idx.Filename]
+        parsed = self._read_parsed_header_cache()
+        cached = set(parsed['Accession'])
+        todo = [(file, acc) for file, acc in zip(self.working_idx.Filename, accessions) if acc not in cached]
+        metrics.inc('cache_lookups_total', len(accessions) - len(todo), kind = 'parsed_header', result = 'hit')
+        metrics.inc('cache_lookups_total', len(todo), kind = 'parsed_header', result = 'miss')
+
+        if len(todo) != 0:
+            if verbose:
+                print('Parsing {} header files not present in the parsed header cache ...'.format(len(todo)))
+            paths = [self._convert_sec_filename(file) for file, acc in todo]
+            local = self.manifest.existing(item[1] for item in paths)
+            fetchlist = [item for item in paths if item[1] not in local]
+            metrics.inc('cache_lookups_total', len(local), kind = 'header', result = 'hit')
+            metrics.inc('cache_lookups_total', len(fetchlist), kind = 'header', result = 'miss')
+            if fetch and len(fetchlist) != 0:
+                fetched, self.fetch_failures = fetch_sec_files(fetchlist, limiter = self.limiter, \
+                    user_agent = self.user_agent, verbose = verbose, session = self.session, \
+                    manifest = self.manifest)
+                local.update(fetched)
+            localpaths = [item[1] for item in paths if item[1] in local]
+            self.manifest.touch(localpaths)
+            chunks = [localpaths[i:i + chunksize] for i in range(0, len(localpaths), chunksize)]
+            records = []
+            for result in self.pool.map(header_records, chunks):
+                records.extend(result)
+            if len(records) != 0:
+                new = pd.DataFrame(records, columns = header_columns + ['Error'])
+                new['CIK'] = pd.to_numeric(new['CIK'], errors = 'coerce').astype('Int64')
+                for col, fmt in (('Filing Date', '%Y%m%d'), ('Period', '%Y%m%d'), \
+                                 ('Acceptance Datetime', '%Y%m%d%H%M%S')):
+                    new[col] = pd.to_datetime(new[col], format = fmt, errors = 'coerce')
+                self._write_parsed_header_cache(new)
+                parsed = new if len(parsed) == 0 else pd.concat([parsed, new], ignore_index = True)
+            if verbose:
+                print('Finished parsing header files.')
+        elif verbose:
+            print('All headers are present in the parsed header cache.')
+
+        self.localparsed = accessions
+        parsed = parsed[parsed['Accession'].isin(set(accessions))]
+        failed = parsed['Error'].notna()
+        self.header_failures = list(parsed.loc[failed, 'Accession'])
+        if verbose and len(self.header_failures) > 0:
+            print('{} header files could not be parsed.'.format(len(self.header_failures)))
+        return parsed[~failed].drop(columns = 'Error').reset_index(drop = True)
+
+
+    def clear_parsed_header_cache(self):
+        """
+        Delete the persistent cache of parsed SGML header data.
+        """
+        if os.path.isdir(self.parsed_header_cache):
+            shutil.rmtree(self.parsed_header_cache)
+        self.localparsed = []
+
+
+    @timer
+    def fetch_filings(self, headers = False, max_workers = sec_max_workers, verbose = False):
         """
         Fetch any filing archive files included in the current working index if they are not already 
-        present in the local file cache.
+        present in the local file cache.  Files that could not be fetched are listed in the 
+        fetch_failures attribute.
 
         Arguments:
 
         headers     :   (default = False)  Also download the SGML header file for each filing
                         and store it in the local cache.
+        max_workers :   (default = config.sec_max_workers)  Maximum number of concurrent requests.  All
+                        requests share the same rate limiter.
         verbose     :   (default = False)
 
         """
@@ -347,32 +721,236 @@ class idx(object):
             localfilepath = os.sep.join([self.filingsdir, cik, fname])
             filing_paths.append((filingURL, localfilepath))
            
-        # Determine whether additional filing archives need to be fetched from the SEC
+        # Determine whether additional filing archives need to be fetched from the SEC, with a single 
+        # manifest lookup for the whole working index.
+        local = self.manifest.existing(item[1] for item in filing_paths)
         fetchnum = 0
         fetchlist = []
         self.filinglist = []
         for item in filing_paths:
-            if not os.path.exists(item[1]):
+            if item[1] not in local:
                 fetchnum += 1
                 fetchlist.append(item)
             else:
                 self.filinglist.append(item[1])
+        metrics.inc('cache_lookups_total', len(self.filinglist), kind = 'filing', result = 'hit')
+        metrics.inc('cache_lookups_total', fetchnum, kind = 'filing', result = 'miss')
         
-        # Fetch any additional filing archives that are needed - single threaded because of SEC rate limit.
+        # Fetch any additional filing archives that are needed - concurrently, within the SEC rate limit.
+        self.fetch_failures = []
         if fetchnum != 0:
             if verbose:
                 print('Fetching {} filing archives ...'.format(fetchnum))
-            for item in fetchlist:
-                fetch_sec_file(item[0], item[1], user_agent = self.user_agent, verbose = verbose)
+            fetched, self.fetch_failures = fetch_sec_files(fetchlist, limiter = self.limiter, \
+                user_agent = self.user_agent, max_workers = max_workers, verbose = verbose, \
+                session = self.session, manifest = self.manifest)
+            self.filinglist.extend(fetched)
             if verbose:
                 print('Finished fetching filing archives.')
         else:
             if verbose:
                 print('All filing archives are present in the local cache.')
+        self.manifest.touch(self.filinglist)
+        if config.text_index_on_fetch:
+            self.update_text_index(verbose = verbose)
 
         # Also fetch SGML header files if requested.
         if headers:
-            self.fetch_headers(verbose = verbose)
+            failures = self.fetch_failures
+            self.fetch_headers(max_workers = max_workers, verbose = verbose)
+            self.fetch_failures = failures + self.fetch_failures
+
+
+    def retry_failed_fetches(self, kinds = ('filing', 'header'), max_workers = sec_max_workers, verbose = False):
+        """
+        Fetch again the filing archives and header files whose download failed in an earlier run even after 
+        retries, as recorded in the cache manifest (see cache_manifest.failures()), for example after an 
+        outage of the SEC website.  Failures that cannot succeed on a later try, such as files that do not 
+        exist, are skipped.  Returns the list of files that still could not be fetched, which is also kept 
+        in the fetch_failures attribute.
+        """
+        items = self.manifest.failures(kinds)
+        if verbose:
+            print('Fetching {} files whose download failed before ...'.format(len(items)))
+        fetched, self.fetch_failures = fetch_sec_files(items, limiter = self.limiter, user_agent = self.user_agent, \
+            max_workers = max_workers, verbose = verbose, session = self.session, manifest = self.manifest)
+        return self.fetch_failures
+
+
+    @timer
+    def extract_documents(self, document_types = 'ALL', suffixes = None, outdir = None, verbose = False):
+        """
+        Decode documents of the requested types from the cached filing archives of all filings in the 
+        current working index and save them as files, in parallel across CPU cores.  uuencoded and base64 
+        encoded binary exhibits (PDFs, images, spreadsheets, zip files) are written as their original 
+        bytes.  Each file is saved under outdir/<CIK>/<accession number>/<file name>.  Returns the list of 
+        files written.  Run fetch_filings() first; filings that are not cached locally are skipped.
+
+        Arguments:
+
+        document_types  :   (default = 'ALL')  List of document types to extract, e.g. ['GRAPHIC', 'EX-99.1']
+        suffixes        :   (default = None)  Optional list of file name suffixes, e.g. ['pdf', 'jpg']
+        outdir          :   (default = 'exhibits' subdirectory of the data directory)
+        verbose         :   (default = False)
+
+        """
+
+        if len(self.working_idx) == 0:
+            print("Run filter_index() before extract_documents()...")
+            return []
+
+        outdir = outdir if outdir != None else os.path.join(self.datadir, 'exhibits')
+        if isinstance(document_types, str) and document_types != 'ALL':
+            document_types = [document_types]
+        if suffixes:
+            suffixes = [x.lower().lstrip('.') for x in suffixes]
+        items = []
+        missing = 0
+        filings = [sec_filepath.split('/')[2:] for sec_filepath in list(self.working_idx.Filename)]
+        local = self.manifest.existing(os.sep.join([self.filingsdir, cik, fname]) for cik, fname in filings)
+        for cik, fname in filings:
+            localfilepath = os.sep.join([self.filingsdir, cik, fname])
+            if localfilepath in local:
+                items.append((localfilepath, os.path.join(outdir, cik, fname.split('.')[0])))
+            else:
+                missing += 1
+        if missing and verbose:
+            print('{} filing archives are not present in the local cache and were skipped.'.format(missing))
+        self.manifest.touch(item[0] for item in items)
+        written = []
+        for result in self.pool.map(_extract_filing_documents, items, (document_types, suffixes)):
+            written.extend(result)
+        return written
+
+
+    @timer
+    def parse_filings(self, outpath = None, document_types = None, fetch = False, chunksize = 20, \
+                      max_pending = None, verbose = False):
+        """
+        Parse all documents that have a registered parser in the cached filing archives of the filings in 
+        the current working index, in parallel on the worker pool.  Each parsed document is streamed as a 
+        record holding its accession number, document sequence, file name and type plus the parsed items 
+        to an append-only output file, so results are never all held in memory.  Accessions whose results 
+        have been written are recorded in outpath + '.done', and a repeated call skips them, so an 
+        interrupted run can simply be restarted.  Returns a dictionary summarizing the run; the output can 
+        be loaded with sectoolkit.bulk.read_records().
+
+        Arguments:
+
+        outpath         :   (default = 'parsed.jsonl' in the data directory)  Paths ending in '.parquet' are 
+                            written as a directory of Parquet part files, others as JSON lines.
+        document_types  :   (default = None parses all types with a registered parser) list of document 
+                            types to parse
+        fetch           :   (default = False)  Fetch filing archives that are not cached locally first.  
+                            Otherwise filings without a cached archive are skipped.
+        chunksize       :   (default = 20)  Number of filings parsed per task
+        max_pending     :   (default = None uses the pool setting)  Maximum number of tasks submitted to the 
+                            worker pool whose results have not yet been written
+        verbose         :   (default = False)
+
+        """
+
+        if len(self.working_idx) == 0:
+            print("Run filter_index() before parse_filings()...")
+            return None
+
+        if fetch:
+            self.fetch_filings(verbose = verbose)
+        outpath = outpath if outpath != None else os.path.join(self.datadir, 'parsed.jsonl')
+        if isinstance(document_types, str):
+            document_types = [document_types]
+        summary = {'outpath': outpath, 'filings': 0, 'records': 0, 'skipped': 0, 'missing': 0}
+
+        with record_sink(outpath) as sink:
+            done = sink.done()
+            filings = [sec_filepath.split('/')[2:] for sec_filepath in dict.fromkeys(self.working_idx.Filename)]
+            local = self.manifest.existing(os.sep.join([self.filingsdir, cik, fname]) for cik, fname in filings \
+                                           if fname.split('.')[0] not in done)
+            items = []
+            for cik, fname in filings:
+                accession = fname.split('.')[0]
+                localfilepath = os.sep.join([self.filingsdir, cik, fname])
+                if accession in done:
+                    summary['skipped'] += 1
+                elif localfilepath not in local:
+                    summary['missing'] += 1
+                else:
+                    items.append((accession, localfilepath))
+            if verbose:
+                print('Parsing {} filings ({} already parsed, {} not cached) ...'.format(len(items), \
+                    summary['skipped'], summary['missing']))
+            self.manifest.touch(item[1] for item in items)
+
+            def write(result):
+                accessions, records = result
+                sink.write(records, accessions)
+                summary['filings'] += len(accessions)
+                summary['records'] += len(records)
+
+            # The pool keeps at most max_pending tasks in flight and returns results in submission order, 
+            # so neither the task queue nor the results grow with the size of the run.
+            chunks = (items[i:i + chunksize] for i in range(0, len(items), chunksize))
+            for result in self.pool.map(_parse_filing_chunk, chunks, (document_types,), chunksize = 1, \
+                                        max_pending = max_pending):
+                write(result)
+
+        if verbose:
+            print('Wrote {} records for {} filings to {}.'.format(summary['records'], summary['filings'], outpath))
+        return summary
+
+
+    @timer
+    def update_text_index(self, document_types = None, chunksize = 20, verbose = False):
+        """
+        Add the documents of filing archives that entered the local cache since the last update to the 
+        full-text index (text_index), extracting their text in parallel on the worker pool.  Archives 
+        already indexed are skipped, so the index grows incrementally with the cache.  Called by 
+        fetch_filings() when config.text_index_on_fetch is set.  Returns a dictionary with the number of 
+        archives and documents indexed.
+
+        Arguments:
+
+        document_types  :   (default = None indexes all types) list of document types to index
+        chunksize       :   (default = 20)  Number of filing archives handled per task
+        verbose         :   (default = False)
+
+        """
+        if isinstance(document_types, str):
+            document_types = [document_types]
+        return self.text_index.update(self.manifest, pool = self.pool, document_types = document_types, \
+                                      chunksize = chunksize, verbose = verbose)
+
+
+    def search_text(self, query, limit = 100, document_types = None, working_only = True, snippet_tokens = 16):
+        """
+        Search the full-text index of the cached filings (see update_text_index()) and return a dataframe 
+        of matching documents, best matches first, with the accession number, CIK, document sequence, 
+        type and file name, a snippet with the matches marked with [ ] and the BM25 score (lower is 
+        better), joined with the Company Name, Form Type, Date Filed and Filename columns of the working 
+        index.  Queries use the SQLite FTS5 syntax, e.g. 'tender offer', '"going private"', 
+        'merger NOT terminated' or 'NEAR(control acquire, 10)'.
+
+        Arguments:
+
+        query           :   FTS5 query string
+        limit           :   (default = 100)  Maximum number of documents returned, None for all
+        document_types  :   (default = None)  Only return documents of these types, e.g. ['SC 13D']
+        working_only    :   (default = True)  Only search filings in the current working index.  Otherwise 
+                            all indexed filings are searched and index columns are filled where available.
+        snippet_tokens  :   (default = 16)  Approximate number of words in each snippet
+
+        """
+        if isinstance(document_types, str):
+            document_types = [document_types]
+        working = self.working_idx.reindex(columns = ['Company Name', 'Form Type', 'Date Filed', 'Filename'])
+        working['Accession'] = pd.Series([os.path.basename(x).split('.')[0] for x in working.Filename], \
+                                         index = working.index, dtype = str)
+        working = working.drop_duplicates('Accession')
+        accessions = list(working['Accession']) if working_only else None
+        results = self.text_index.search(query, limit = limit, document_types = document_types, \
+                                         accessions = accessions, snippet_tokens = snippet_tokens)
+        results['Accession'] = results['Accession'].astype(str)
+        return results.merge(working, how = 'left', on = 'Accession')
 
 
     def clear_index_cache(self):
@@ -380,6 +958,7 @@ class idx(object):
         Delete locally cached SEC index files.
         """
         self._clear_local_cache(self.idxdir)
+        self.manifest.remove_dir(self.idxdir)
         # Reset idxlist to an empty list since we have deleted the cached index files
         self.idxlist = []
     
@@ -389,16 +968,117 @@ class idx(object):
         Delete locally cached SGML header files.
         """
         self._clear_local_cache(self.hdrdir)
+        self.manifest.remove_dir(self.hdrdir)
         # Reset islocal attribute to False for all items in hdrlist since we have deleted the cached header files
         for item in self.hdrlist:
             item.islocal = False
 
 
+    def migrate_cache(self, compression = None, verbose = False):
+        """
+        Convert the locally cached filing archives and SGML header files to the requested compression 
+        (None, 'gzip' or 'zstd').  Set config.cache_compression to the same value so that new downloads 
+        are stored the same way.
+        """
+        converted = migrate_cache(self.filingsdir, compression = compression, verbose = verbose)
+        converted += migrate_cache(self.hdrdir, compression = compression, verbose = verbose)
+        # Converted files have new sizes on disk.
+        self.manifest.rebuild([self.filingsdir, self.hdrdir])
+        return converted
+
+
+    def _cache_in_use(self):
+        """
+        Returns the local paths of the quarterly index files in the instance date range and of the filing 
+        archives and header files of the current working index, which are never evicted.
+        """
+        paths = list(self.idxlist)
+        if len(self.working_idx) != 0:
+            for sec_filepath in list(self.working_idx.Filename):
+                _, _, cik, fname = sec_filepath.split('/')
+                paths.append(os.sep.join([self.filingsdir, cik, fname]))
+                paths.append(self._convert_sec_filename(sec_filepath)[1])
+        return paths
+
+
+    def evict_cache(self, max_bytes = None, max_age = None, policy = None, kinds = ('filing', 'header'), \
+                    dry_run = False, verbose = False):
+        """
+        Delete locally cached files to keep the cache within a size budget and/or drop files that have not 
+        been used for a number of days.  Files are evicted least recently used first ('lru') or least 
+        frequently used first ('lfu'), going by the use recorded in the cache manifest.  Files of pinned 
+        accession numbers and CIKs (see pin_cache()), the filings and header files of the current working 
+        index and the index files of the instance date range are never evicted.  Returns a dictionary 
+        with the number of files and bytes evicted, the bytes remaining and the evicted paths.
+
+        Arguments:
+
+        max_bytes   :   (default = config.cache_max_bytes)  Size budget in bytes, 0 for no limit
+        max_age     :   (default = config.cache_max_age)  Days since last use, 0 for no limit
+        policy      :   (default = config.cache_eviction_policy)  'lru' or 'lfu'
+        kinds       :   (default = ('filing', 'header'))  Kinds of cached files subject to eviction; add 
+                        'index' to also evict index files of quarters outside the instance date range
+        dry_run     :   (default = False)  Only report the files that would be evicted
+        verbose     :   (default = False)
+
+        """
+        return self.manifest.evict(max_bytes = max_bytes, max_age = max_age, policy = policy, kinds = kinds, \
+                                   in_use = self._cache_in_use, dry_run = dry_run, verbose = verbose)
+
+
+    def pin_cache(self, accessions = None, ciks = None):
+        """
+        Exempt the cached filing archives and header files of the supplied accession numbers and CIKs from 
+        eviction.
+        """
+        self.manifest.pin(accessions = accessions, ciks = ciks)
+
+
+    def unpin_cache(self, accessions = None, ciks = None):
+        """
+        Make pinned accession numbers and CIKs subject to eviction again.
+        """
+        self.manifest.unpin(accessions = accessions, ciks = ciks)
+
+
+    def start_cache_sweeper(self, interval = None, verbose = False):
+        """
+        Start a background thread that runs evict_cache() with the config defaults every interval seconds 
+        (default = config.cache_sweep_interval, or one hour if that is 0).  Started automatically when 
+        config.cache_sweep_interval is set.
+        """
+        self.stop_cache_sweeper()
+        interval = interval if interval else (config.cache_sweep_interval or 3600)
+        self.sweeper = cache_sweeper(self.manifest, interval, in_use = self._cache_in_use, verbose = verbose)
+        self.sweeper.start()
+
+
+    def stop_cache_sweeper(self):
+        """
+        Stop the background eviction thread started by start_cache_sweeper().
+        """
+        if self.sweeper != None:
+            self.sweeper.stop()
+            self.sweeper = None
+
+
+    def rebuild_manifest(self, verbose = False):
+        """
+        Reconcile the cache manifest with the files actually present in the local cache: files that are 
+        not listed are added, and listed files that have been deleted outside sectoolkit are marked 
+        missing.  Run this once for a cache that was filled before the manifest existed, or after files 
+        have been copied into or removed from the data directory by other means.  Returns a dictionary 
+        with the number of files added, updated and marked missing.
+        """
+        return self.manifest.rebuild(verbose = verbose)
+
+
     def clear_filing_cache(self):
         """
         Delete locally cached filing archive files.
         """
         self._clear_local_cache(self.filingsdir)
+        self.manifest.remove_dir(self.filingsdir)
         # Reset filinglist to an empty list since we have deleted the cached filing archive files
         self.filinglist = []
 
@@ -422,60 +1102,45 @@ class headerfile(object):
     datadir             :   (default creates 'secdata' subdirectory under the current directory)  This is 
                             where locally cached SEC files will be stored.
     rate_limiter        :   (defaults to rate_limiter class provided in limiter sub-package)
+    session             :   (default = None) sec_session used for downloads.  Defaults to the package-wide 
+                            session with persistent connections.
+    manifest            :   (default = None) cache_manifest listing the locally cached files.  By default 
+                            the manifest.sqlite database in the data directory is used, through one instance 
+                            shared within the process (see manifest.get_manifest()).
+    islocal             :   (default = None) whether the header file is known to be cached locally, which 
+                            saves a lookup when many header files are checked at once.  By default the 
+                            manifest is consulted.
 
     """
     
     
     def __init__(self, sec_filename, datadir = default_datadir, \
                  rate_limiter = seclimiter, \
-                 user_agent = None):
+                 user_agent = None, session = None, manifest = None, islocal = None):
         self.user_agent = user_agent
+        self.session = session
         self.limiter = rate_limiter
         self.datadir = datadir
+        self.manifest = manifest if manifest != None else get_manifest(self.datadir)
         self.hdrdir = os.path.join(self.datadir, 'headerfiles')
-        self.sec_base = 'http://www.sec.gov/Archives/edgar/data/'
+        self.sec_base = config.sec_base_url
         self.url, self.localpath = self._convert_sec_filename(sec_filename)
-        self.islocal = os.path.exists(self.localpath)
+        self.islocal = islocal if islocal != None else self.manifest.exists(self.localpath)
         
 
-    ## This should be pulled out as a standalone function since it is needed by both idx and headerfile classes.
     def _convert_sec_filename(self, sec_filename):
         """
         Accepts SEC filepath as input and returns retrieval URL for SGML header file and local filepath
         where header file may be cached.
         """
-        _, _, cik, fname = sec_filename.split('/')
-        fname_body = fname.split('.')[0]
-        new_fname = fname_body+'.hdr.sgml'
-        hdrfilepath = os.sep.join([self.hdrdir, cik, new_fname])
-        url = self.sec_base+'/'.join([cik, ''.join(fname_body.split('-')), new_fname])
-        return url, hdrfilepath
+        return _header_file_paths(sec_filename, self.hdrdir, self.sec_base)
         
     
     def _SGMLfiletoDict(self):
         """
         Reads an SGML header file and converts it to a Python dictionary.
         """
-        end_tags = []
-        xmlstring = ''
-        tag = re.compile("<.[^(><.)]+>")
-        with open(self.localpath, 'r', encoding = 'latin-1') as f:
-            xmlstring += '<?xml version="1.0"?>'+'\n'
-            lines = f.read().splitlines()
-            # Identify containers
-            for line in lines:
-                if line.startswith("</"):
-                    end_tags.append(line)
-            container_tags = [s.replace('/', '') for s in end_tags] + end_tags
-            # Add closing tags for non-container fields
-            for line in lines:
-                a = re.findall(tag, line)
-                if len(a) > 0:
-                    if a[0] in container_tags:
-                        xmlstring += line+'\n'
-                    else:
-                        xmlstring += line.replace("&", "and") + a[0][:1]+'/'+a[0][1:]+'\n'
-        return xmltodict.parse(xmlstring)['SEC-HEADER']
+        return read_sgml_header(self.localpath)
 
 
     def get_headerDict(self, verbose = False):
@@ -484,9 +1149,14 @@ class headerfile(object):
         """
 
         if not self.islocal:
+            metrics.inc('cache_lookups_total', kind = 'header', result = 'miss')
             self.fetch_file(verbose = verbose)
+        else:
+            metrics.inc('cache_lookups_total', kind = 'header', result = 'hit')
+            self.manifest.touch([self.localpath])
 
-        return self._SGMLfiletoDict()
+        with profiling.stage('headerfile.get_headerDict'):
+            return self._SGMLfiletoDict()
     
     
     def fetch_file(self, content = False, verbose = False):
@@ -496,7 +1166,9 @@ class headerfile(object):
         """
             
         _ = fetch_sec_file(self.url, self.localpath, content = content, limiter = self.limiter, \
-            user_agent = self.user_agent, verbose = verbose)
+            user_agent = self.user_agent, verbose = verbose, session = self.session, manifest = self.manifest)
+        if _ != None:
+            self.islocal = True
             
         return
  
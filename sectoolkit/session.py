@@ -0,0 +1,188 @@
+import http.client
+import urllib.error
+import urllib.parse
+import threading
+import queue
+from time import perf_counter
+
+from .config import sec_max_workers
+from . import metrics
+
+
+# Errors that indicate an idle keep-alive connection was closed by the server before it was reused.
+_stale_connection_errors = (http.client.RemoteDisconnected, http.client.BadStatusLine, \
+    ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+_redirect_codes = (301, 302, 303, 307, 308)
+
+
+class sec_response(object):
+
+    """
+    Wraps an http.client response so that its connection is returned to the session pool once the body
+    has been read and the response is closed.  Use as a context manager.
+    """
+
+    def __init__(self, session, key, conn, response, url):
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt = None):
+        return self._response.read(amt)
+
+    def close(self):
+        if self._conn is None:
+            return
+        # A connection can only be reused once the previous response has been consumed in full.
+        if self._response.isclosed() and not self._response.will_close:
+            self._session._release(self._key, self._conn)
+        else:
+            self._response.close()
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class sec_session(object):
+
+    """
+    Reusable HTTP session that keeps persistent (keep-alive) connections to the SEC website open between
+    requests, so that consecutive downloads do not each pay for a new TCP and TLS handshake.  Default
+    request headers such as the User-Agent are set once.  A session may be shared between threads and
+    between the idx, headerfile and filingArchive objects working on the same data.
+
+
+    Optional arguments:
+
+    user_agent  :   (default = None) The SEC requires that all file requests contain a header specifying
+                    a user agent string of the form "<Company or institution name>, <contact email>".
+    pool_size   :   (default = config.sec_max_workers) maximum number of idle connections kept per host
+    timeout     :   (default = 60) socket timeout in seconds
+    headers     :   (default = None) dictionary of additional headers sent with every request
+
+    """
+
+    def __init__(self, user_agent = None, pool_size = sec_max_workers, timeout = 60, headers = None):
+        self.user_agent = user_agent
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.headers = {}
+        if user_agent != None:
+            self.headers['User-Agent'] = user_agent
+        if headers:
+            self.headers.update(headers)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Open connections cannot be pickled, so worker processes start with empty pools.
+        state = self.__dict__.copy()
+        state['_pools'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = queue.LifoQueue(maxsize = self.pool_size)
+            return self._pools[key]
+
+    def _connect(self, key):
+        """
+        Returns an idle pooled connection for (scheme, host, port) if one is available, or a new one.
+        The second return value indicates whether the connection was reused.
+        """
+        try:
+            return self._pool(key).get_nowait(), True
+        except queue.Empty:
+            scheme, host, port = key
+            if scheme == 'https':
+                return http.client.HTTPSConnection(host, port, timeout = self.timeout), False
+            return http.client.HTTPConnection(host, port, timeout = self.timeout), False
+
+    def _release(self, key, conn):
+        try:
+            self._pool(key).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, url, headers = None, max_redirects = 5):
+        """
+        Sends a GET request and returns an sec_response.  Redirects are followed and error statuses are
+        raised as urllib.error.HTTPError, as urllib.request.urlopen() would.
+        """
+        for _ in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            req_headers = dict(self.headers)
+            if headers:
+                req_headers.update(headers)
+            start = perf_counter()
+            while True:
+                conn, reused = self._connect(key)
+                try:
+                    conn.request('GET', path, headers = req_headers)
+                    response = conn.getresponse()
+                    break
+                except _stale_connection_errors as inst:
+                    conn.close()
+                    # Retry on a fresh connection if the server dropped an idle pooled connection.
+                    if not reused:
+                        metrics.inc('http_errors_total', error = type(inst).__name__)
+                        raise
+                except Exception as inst:
+                    conn.close()
+                    metrics.inc('http_errors_total', error = type(inst).__name__)
+                    raise
+            # Time to the response headers; the body is streamed by the caller.
+            metrics.observe('http_request_seconds', perf_counter() - start, host = parts.hostname)
+            metrics.inc('http_responses_total', status = response.status)
+            result = sec_response(self, key, conn, response, url)
+            if response.status in _redirect_codes and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                result.read()
+                result.close()
+                continue
+            if response.status >= 400:
+                result.read()
+                result.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return result
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+    def get(self, url, headers = None):
+        """
+        Sends a GET request and returns the complete response body as bytes.
+        """
+        with self.request(url, headers = headers) as response:
+            return response.read()
+
+    def close(self):
+        """
+        Closes all idle pooled connections.
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
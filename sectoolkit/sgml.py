@@ -0,0 +1,222 @@
+import os
+import re
+
+from .cache import open_cached
+
+
+# First tag on a line, as recognized by the original regex based header converter.
+_tag = re.compile("<.[^(><.)]+>")
+_bad_tag_chars = frozenset('(><.)')
+# Tag names made up only of letters, digits and hyphens, which covers all tags used in SEC headers.
+_plain_tag = re.compile(r'[A-Z0-9][A-Z0-9-]+\Z', re.I).match
+
+
+def _split_line(line):
+    """
+    Returns (prefix, tag, rest) for the first tag on a line, or None if the line holds no tag.  Lines
+    that start with a plain tag are handled without running the regex.
+    """
+    if line.startswith('<'):
+        end = line.find('>', 2)
+        if end > 1 and not _bad_tag_chars.intersection(line[2:end]):
+            return '', line[:end + 1], line[end + 1:]
+    m = _tag.search(line)
+    if m is None:
+        return None
+    return line[:m.start()], m.group(0), line[m.end():]
+
+
+def _add_item(d, key, value):
+    # Repeated keys become lists, as in xmltodict.
+    if key in d:
+        if isinstance(d[key], list):
+            d[key].append(value)
+        else:
+            d[key] = [d[key], value]
+    else:
+        d[key] = value
+
+
+def _container_value(children):
+    """
+    Builds the dictionary value of a container element from its resolved child nodes.
+    """
+    d = {}
+    text = []
+    for node in children:
+        if node[0] is None:
+            text.append(node[1])
+        else:
+            _add_item(d, node[0], node[1])
+    text = '\n'.join(text).strip()
+    if not d:
+        return text if text else None
+    if text:
+        d['#text'] = text
+    return d
+
+
+def _leaf_value(rest):
+    value = rest.replace('&', 'and').strip()
+    return value if value else None
+
+
+def parse_sgml_header(lines):
+    """
+    Parses the lines of an SEC SGML header file in a single pass and returns the nested dictionary
+    under the root SEC-HEADER element.
+
+    SGML header files only close container elements, so whether a tag is a container or a field is not
+    known until its closing tag is seen.  Opened tags are kept in a flat list of pending nodes together
+    with a stack of their positions; when a closing tag arrives, the pending nodes opened after it become
+    its children and any tags that were never closed are resolved as fields.  The result has the same
+    structure as the original conversion to XML and xmltodict: field values are stripped strings (None
+    if empty) with '&' replaced by 'and', repeated elements become lists, and text found directly inside
+    a container is stored under '#text'.
+    """
+    # Pending nodes are [tag name, None, rest of the opening line] lists.  Resolved nodes are (tag name,
+    # value) tuples, and text nodes are (None, text) tuples.
+    nodes = []
+    stack = []
+    for line in lines:
+        if line.startswith('</'):
+            name = line[2:].rstrip().rstrip('>')
+            # Unwind to the matching opening tag.  Tags passed over on the way were fields.
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    break
+            else:
+                continue
+            pos = stack[i][1]
+            del stack[i:]
+            node = nodes[pos]
+            children = [_resolve(n) for n in nodes[pos + 1:]]
+            del nodes[pos + 1:]
+            if node[2].strip():
+                children.insert(0, (None, node[2]))
+            nodes[pos] = (name, _container_value(children))
+            continue
+        # Fast path for the usual '<TAG>value' line; anything else goes through the regex.
+        end = line.find('>', 2) if line.startswith('<') else -1
+        if end > 1 and _plain_tag(line[1:end]):
+            name = line[1:end]
+            rest = line[end + 1:]
+        else:
+            parts = _split_line(line)
+            if parts is None:
+                continue
+            prefix, tag, rest = parts
+            if prefix.strip():
+                nodes.append((None, prefix))
+            if tag.startswith('</'):
+                continue
+            name = tag[1:-1]
+        stack.append((name, len(nodes)))
+        nodes.append([name, None, rest])
+    root = {}
+    for node in nodes:
+        if node[0] is not None:
+            _add_item(root, *_resolve(node))
+    return root['SEC-HEADER']
+
+
+def _resolve(node):
+    # Pending nodes that were never closed are fields.
+    return node if len(node) == 2 else (node[0], _leaf_value(node[2]))
+
+
+def read_sgml_header(localpath):
+    """
+    Reads and parses a locally cached SGML header file, which may be stored compressed.
+    """
+    with open_cached(localpath, 'r') as f:
+        return parse_sgml_header(f.read().splitlines())
+
+
+def read_sgml_headers(localpaths, errors = 'raise'):
+    """
+    Parses many locally cached SGML header files, yielding a (localpath, header dictionary) tuple for
+    each.  If errors is 'skip', files that cannot be read or parsed are yielded with None in place of
+    the dictionary instead of raising an exception.
+    """
+    for localpath in localpaths:
+        try:
+            yield localpath, read_sgml_header(localpath)
+        except Exception:
+            if errors != 'skip':
+                raise
+            yield localpath, None
+
+
+# Header sections that describe a filing entity, and the columns of the flat parsed header table.
+header_roles = ['FILER', 'SUBJECT-COMPANY', 'FILED-BY', 'REPORTING-OWNER', 'ISSUER']
+header_columns = ['Accession', 'Form Type', 'Filing Date', 'Acceptance Datetime', 'Period', 'Role', 'CIK', \
+    'Company Name', 'SIC', 'IRS Number', 'State of Incorporation', 'Fiscal Year End', 'State', 'City']
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def flatten_sgml_header(header, accession = None):
+    """
+    Flattens a parsed header dictionary into a list of records, one per filing entity (filer, subject
+    company, filed-by party, reporting owner or issuer).  Headers without any entities produce a single
+    record with an empty role, so that every parsed header is represented.
+    """
+    base = {
+        'Accession': accession if accession else header.get('ACCESSION-NUMBER'),
+        'Form Type': header.get('TYPE'),
+        'Filing Date': header.get('FILING-DATE'),
+        'Acceptance Datetime': header.get('ACCEPTANCE-DATETIME'),
+        'Period': header.get('PERIOD'),
+    }
+    records = []
+    for role in header_roles:
+        for entity in _as_list(header.get(role)):
+            if not isinstance(entity, dict):
+                continue
+            data = entity.get('COMPANY-DATA') or entity.get('OWNER-DATA') or {}
+            address = entity.get('BUSINESS-ADDRESS') or entity.get('MAIL-ADDRESS') or {}
+            data = data if isinstance(data, dict) else {}
+            address = address[0] if isinstance(address, list) else address
+            address = address if isinstance(address, dict) else {}
+            record = dict(base)
+            record.update({
+                'Role': role,
+                'CIK': data.get('CIK'),
+                'Company Name': data.get('CONFORMED-NAME'),
+                'SIC': data.get('ASSIGNED-SIC'),
+                'IRS Number': data.get('IRS-NUMBER'),
+                'State of Incorporation': data.get('STATE-OF-INCORPORATION'),
+                'Fiscal Year End': data.get('FISCAL-YEAR-END'),
+                'State': address.get('STATE'),
+                'City': address.get('CITY'),
+            })
+            records.append(record)
+    if len(records) == 0:
+        records.append(dict(base, Role = None))
+    return records
+
+
+def header_records(localpaths):
+    """
+    Parses a batch of locally cached SGML header files and returns the flattened records for all of
+    them.  A file that cannot be parsed yields a single record holding its accession number and the
+    error in an 'Error' entry, so that it is not parsed again; files that have gone missing are skipped.
+    Intended to be run in worker processes.
+    """
+    records = []
+    for localpath in localpaths:
+        accession = os.path.basename(localpath).split('.')[0]
+        try:
+            header = read_sgml_header(localpath)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            records.append({'Accession': accession, 'Error': '{}: {}'.format(type(e).__name__, e)})
+            continue
+        records.extend(flatten_sgml_header(header, accession = accession))
+    return records
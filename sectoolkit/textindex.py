@@ -0,0 +1,279 @@
+import os
+import sqlite3
+import threading
+import pandas as pd
+from time import time
+
+from .config import default_datadir
+from .cache import map_cached
+from .archive import scan_documents, document_text
+from . import metrics
+
+
+# Number of archives whose documents are written per transaction.
+_batch_archives = 200
+# Number of accession numbers sent to SQLite per statement when restricting a search.
+_batch_size = 10000
+result_columns = ['Accession', 'CIK', 'Sequence', 'Type', 'Document', 'Snippet', 'Score']
+
+
+def _archive_documents(item, document_types = None):
+    # Pool worker for text_index.update(); item is a (cached archive path, accession number, CIK, fetch
+    # time, previously indexed) tuple.  Returns the item with a list of (sequence, type, file name, text)
+    # tuples, or None if the archive could not be read.
+    documents = []
+    try:
+        with map_cached(item[0]) as data:
+            for entry in scan_documents(data):
+                if document_types and entry.type not in document_types:
+                    continue
+                text = document_text(data, entry)
+                if text:
+                    documents.append((entry.sequence, entry.type, entry.filename, text))
+    except (OSError, ValueError):
+        # Evicted or deleted since the manifest was read, or empty.
+        return item, None
+    return item, documents
+
+
+class text_index(object):
+
+    """
+    Full-text search index over the documents of the cached filing archives, kept in a SQLite FTS5 database
+    (fulltext.sqlite in the data directory).  Each prose document (.txt, .htm and .html files) is indexed
+    under its accession number, document sequence and type, with markup removed.  update() indexes only the
+    archives that have entered the cache, or were fetched again, since the last update, as listed in the
+    cache manifest.  Indexed text stays searchable after its archive has been evicted from the cache.
+
+    search() takes FTS5 query syntax: words, "exact phrases", AND, OR, NOT, NEAR(a b, 10) and prefix* terms
+    (see https://www.sqlite.org/fts5.html#full_text_query_syntax).
+
+    Arguments:
+
+    datadir     :   (default = config.default_datadir) data directory holding the cached filings
+    path        :   (default = fulltext.sqlite in datadir) path of the index database
+
+    Usage:
+
+    index = text_index(datadir)
+    index.update(manifest, pool = pool)
+    hits = index.search('"poison pill" NOT rights', limit = 50)
+
+    """
+
+    def __init__(self, datadir = default_datadir, path = None):
+        self.datadir = datadir
+        self.path = path if path else os.path.join(self.datadir, 'fulltext.sqlite')
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        # Connections cannot be shared with other processes, so worker processes open their own.
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            conn = sqlite3.connect(self.path, timeout = 60, check_same_thread = False)
+            # Searches can run while another process adds documents.
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY, accession TEXT, cik TEXT, sequence TEXT, type TEXT, filename TEXT)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS documents_accession ON documents (accession)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS archives (
+                path TEXT PRIMARY KEY, accession TEXT, fetched REAL, documents INTEGER, indexed REAL)""")
+            # The text of each document is stored under the id of its documents row, so that snippets can
+            # be shown.
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS document_text USING fts5(body,
+                tokenize = 'unicode61 remove_diacritics 2')""")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+
+    def stale(self, manifest):
+        """
+        Returns (path, accession, CIK, fetch time, previously indexed) tuples for the cached filing archives
+        listed in the cache manifest that have not been indexed yet or were fetched again after they were
+        indexed.
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("ATTACH DATABASE ? AS manifest", (manifest.path,))
+            try:
+                return conn.execute("""SELECT f.path, f.accession, f.cik, COALESCE(f.fetched, 0),
+                    a.path IS NOT NULL FROM manifest.files AS f LEFT JOIN archives AS a ON a.path = f.path
+                    WHERE f.kind = 'filing' AND f.status = 'ok' AND f.accession IS NOT NULL
+                    AND (a.path IS NULL OR f.fetched > a.fetched) ORDER BY f.path""").fetchall()
+            finally:
+                conn.execute("DETACH DATABASE manifest")
+
+
+    def update(self, manifest, pool = None, document_types = None, chunksize = 20, verbose = False):
+        """
+        Indexes the documents of the cached filing archives that are new or were fetched again since the
+        last update (see stale()).  Text is extracted on the worker pool, if one is supplied, and written
+        in batches.  Returns a dictionary with the number of archives and documents indexed and of
+        archives that could not be read.
+
+        Arguments:
+
+        manifest        :   cache_manifest of the data directory
+        pool            :   (default = None extracts text in the calling thread) worker_pool
+        document_types  :   (default = None indexes all types) list of document types to index
+        chunksize       :   (default = 20) number of archives handled per worker task
+        verbose         :   (default = False)
+
+        """
+        todo = self.stale(manifest)
+        summary = {'archives': 0, 'documents': 0, 'failed': 0}
+        if len(todo) == 0:
+            if verbose:
+                print('The full-text index is up to date.')
+            return summary
+        if verbose:
+            print('Indexing the documents of {} filing archives ...'.format(len(todo)))
+        if pool is not None:
+            results = pool.map(_archive_documents, todo, (document_types,), chunksize = chunksize)
+        else:
+            results = (_archive_documents(item, document_types) for item in todo)
+        batch = []
+        for item, documents in results:
+            if documents is None:
+                summary['failed'] += 1
+                continue
+            batch.append((item, documents))
+            summary['archives'] += 1
+            summary['documents'] += len(documents)
+            if len(batch) >= _batch_archives:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+        metrics.inc('text_index_documents_total', summary['documents'])
+        if verbose:
+            print('Indexed {} documents of {} filing archives.'.format(summary['documents'], summary['archives']))
+        return summary
+
+
+    def _write(self, batch):
+        now = time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                # Take the write lock before reading MAX(id), so that processes indexing at the same time 
+                # cannot hand out the same ids.
+                conn.execute("BEGIN IMMEDIATE")
+                reindexed = [(item[1],) for item, _ in batch if item[4]]
+                if reindexed:
+                    self._delete(conn, reindexed)
+                next_id = (conn.execute("SELECT MAX(id) FROM documents").fetchone()[0] or 0) + 1
+                rows = []
+                texts = []
+                for (path, accession, cik, fetched, _), documents in batch:
+                    for sequence, doctype, filename, text in documents:
+                        rows.append((next_id, accession, cik, sequence, doctype, filename))
+                        texts.append((next_id, text))
+                        next_id += 1
+                conn.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)", rows)
+                conn.executemany("INSERT INTO document_text (rowid, body) VALUES (?, ?)", texts)
+                conn.executemany("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)", \
+                    ((item[0], item[1], item[3], len(documents), now) for item, documents in batch))
+
+
+    def _delete(self, conn, accessions):
+        conn.executemany("DELETE FROM document_text WHERE rowid IN (SELECT id FROM documents WHERE accession = ?)", \
+                         accessions)
+        conn.executemany("DELETE FROM documents WHERE accession = ?", accessions)
+
+
+    def remove(self, accessions):
+        """
+        Removes the documents of the supplied accession numbers from the index.  They are indexed again if
+        their archives are fetched again.
+        """
+        accessions = [(x,) for x in accessions]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                self._delete(conn, accessions)
+                conn.executemany("DELETE FROM archives WHERE accession = ?", accessions)
+
+
+    def search(self, query, limit = 100, document_types = None, accessions = None, snippet_tokens = 16):
+        """
+        Returns a dataframe of the documents matching an FTS5 query, best matches first, with columns
+        Accession, CIK, Sequence, Type, Document (file name), Snippet (matches marked with [ ]) and Score
+        (BM25 relevance, lower is better).  The Accession column joins with the accession numbers of an
+        index dataframe such as idx.working_idx (see idx.search_text()).
+
+        Arguments:
+
+        query           :   FTS5 query string
+        limit           :   (default = 100) maximum number of documents returned, None for all
+        document_types  :   (default = None) only return documents of these types, e.g. ['SC 13D']
+        accessions      :   (default = None) only return documents of these accession numbers
+        snippet_tokens  :   (default = 16) approximate number of words in each snippet
+
+        """
+        sql = """SELECT d.accession, d.cik, d.sequence, d.type, d.filename,
+            snippet(document_text, 0, '[', ']', '...', ?), bm25(document_text)
+            FROM document_text JOIN documents AS d ON d.id = document_text.rowid
+            WHERE document_text MATCH ?"""
+        params = [snippet_tokens, query]
+        if document_types:
+            sql += " AND d.type IN ({})".format(','.join('?' * len(document_types)))
+            params.extend(document_types)
+        with self._lock:
+            conn = self._connect()
+            if accessions is not None:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS search_accessions (accession TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM search_accessions")
+                accessions = [(x,) for x in accessions]
+                for i in range(0, len(accessions), _batch_size):
+                    conn.executemany("INSERT OR IGNORE INTO search_accessions VALUES (?)", \
+                                     accessions[i:i + _batch_size])
+                sql += " AND d.accession IN (SELECT accession FROM search_accessions)"
+            sql += " ORDER BY bm25(document_text)"
+            if limit:
+                sql += " LIMIT ?"
+                params.append(limit)
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            finally:
+                # Leave no transaction open that would block writers in other processes.
+                conn.commit()
+        results = pd.DataFrame(rows, columns = result_columns)
+        results['CIK'] = pd.to_numeric(results['CIK'], errors = 'coerce').astype('Int64')
+        return results
+
+
+    def count(self):
+        """
+        Returns a dictionary with the number of indexed archives and documents.
+        """
+        with self._lock:
+            conn = self._connect()
+            archives = conn.execute("SELECT COUNT(*) FROM archives").fetchone()[0]
+            documents = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return {'archives': archives, 'documents': documents}
+
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
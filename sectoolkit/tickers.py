@@ -0,0 +1,291 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from time import time
+from collections import namedtuple
+
+from . import config
+from .config import default_datadir
+from .utils import seclimiter, fetch_if_modified
+from .limiter import _file_lock
+from .cache import open_cached
+
+
+# Lookup tables already loaded in this process, by data directory.
+_lookups = {}
+_lookups_lock = threading.Lock()
+# Seconds between checks whether another process has written a newer table to disk.
+_reload_check_interval = 60
+
+
+def get_ticker_lookup(datadir = default_datadir, **kwargs):
+    """
+    Returns the ticker_lookup for a data directory, creating it on first use.  All callers in a process
+    share the same instance, so the table is read from disk and indexed only once.
+    """
+    key = os.path.abspath(datadir)
+    with _lookups_lock:
+        lookup = _lookups.get(key)
+        if lookup is None:
+            lookup = _lookups[key] = ticker_lookup(datadir, **kwargs)
+    return lookup
+
+
+# Lookup structures built from one version of the table.  Methods work on the snapshot returned by
+# ticker_lookup._index(), so a background refresh that swaps the table cannot change it under them.
+_lookup_index = namedtuple('_lookup_index', ['ticker_cik', 'cik_tickers', 'cik_name', 'primary', 'names', \
+                                             'names_upper'])
+
+
+def _read_company_tickers(localpath):
+    # The SEC file maps row numbers to {'cik_str': ..., 'ticker': ..., 'title': ...} records, listed in
+    # order of each company's primary ticker first.
+    with open_cached(localpath, 'rb') as f:
+        records = json.load(f)
+    records = [records[k] for k in sorted(records, key = int)] if isinstance(records, dict) else records
+    return pd.DataFrame({'cik': np.array([int(x['cik_str']) for x in records], dtype = 'int64'),
+                         'ticker': [str(x['ticker']).upper() for x in records],
+                         'name': [str(x['title']) for x in records]})
+
+
+class ticker_lookup(object):
+
+    """
+    Bidirectional lookup between tickers, CIKs and company names, based on the SEC company_tickers.json
+    file.  The file is converted once into a compact Parquet table in the data directory, which is shared
+    by all processes using the same data directory; each process loads and indexes it once and keeps it
+    in memory.  When the table is older than max_age it is refreshed in a background thread with a
+    conditional GET, so callers keep using the current table instead of waiting for the download.  Only
+    the very first use in a data directory waits for the file to be fetched.
+
+    Use get_ticker_lookup() to share one instance per data directory within a process.
+
+
+    Optional arguments:
+
+    datadir     :   (default = config.default_datadir) data directory holding the cached table
+    max_age     :   (default = config.ticker_max_age) seconds after which the table is refreshed
+    user_agent  :   (default = None) user agent string sent with the request
+    session     :   (default = None) sec_session used for the download
+    limiter     :   (defaults to the shared package rate limiter)
+    background  :   (default = True) refresh stale tables in a background thread instead of in the caller
+
+    """
+
+    def __init__(self, datadir = default_datadir, max_age = None, user_agent = None, session = None, \
+                 limiter = seclimiter, background = True):
+        self.datadir = datadir
+        self.max_age = max_age if max_age != None else config.ticker_max_age
+        self.user_agent = user_agent
+        self.session = session
+        self.limiter = limiter
+        self.background = background
+        self.jsonpath = os.path.join(datadir, 'company_tickers.json')
+        self.tablepath = os.path.join(datadir, 'company_tickers.parquet')
+        self.statepath = os.path.join(datadir, 'company_tickers.state.json')
+        self.lockpath = os.path.join(datadir, 'company_tickers.lock')
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self._loaded_mtime = None
+        self._checked = 0
+        self._set_table(None)
+
+
+    def _set_table(self, table):
+        self.table = table
+        self._snapshot = None
+        self._dicts = None
+
+
+    def _load(self):
+        mtime = os.path.getmtime(self.tablepath)
+        table = pd.read_parquet(self.tablepath)
+        with self._lock:
+            self._set_table(table)
+            self._loaded_mtime = mtime
+
+
+    def _table_age(self):
+        # The state file is rewritten by every refresh, the table only when its content has changed.
+        if not os.path.exists(self.tablepath):
+            return None
+        checked = self.statepath if os.path.exists(self.statepath) else self.tablepath
+        return time() - os.path.getmtime(checked)
+
+
+    def _ensure(self):
+        """
+        Makes sure that a table is loaded, and starts a refresh if the table on disk has gone stale.
+        """
+        now = time()
+        if self.table is not None and now - self._checked < _reload_check_interval:
+            return
+        self._checked = now
+        age = self._table_age()
+        if age is None:
+            # Nothing to serve yet, so the first fetch has to be waited for.
+            self.refresh()
+            age = self._table_age()
+            if age is None:
+                raise RuntimeError('The company tickers file could not be fetched from the SEC website.')
+        if self.table is None or os.path.getmtime(self.tablepath) != self._loaded_mtime:
+            # Another process may have refreshed the table on disk.
+            self._load()
+        if age > self.max_age:
+            if self.background:
+                self._start_refresh()
+            else:
+                self.refresh()
+
+
+    def _start_refresh(self):
+        with self._lock:
+            if self._refresher is not None and self._refresher.is_alive():
+                return
+            self._refresher = threading.Thread(target = self._background_refresh, name = 'ticker_refresh', \
+                                               daemon = True)
+            self._refresher.start()
+
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as inst:
+            # The current table stays in use; the refresh is retried on a later lookup.
+            print(config.sec_tickers_url)
+            print(inst)
+
+
+    def refresh(self, verbose = False):
+        """
+        Fetches the SEC company tickers file if it has changed since it was last fetched, using a
+        conditional GET, and rebuilds and reloads the table if it has.  Returns True if a new version
+        was fetched.  Concurrent calls run one after the other, within a process under a thread lock and
+        across processes under a lock on company_tickers.lock in the data directory.  A call that waited
+        for another refresh to finish uses its result instead of fetching again.
+        """
+        started = time()
+        with self._refresh_lock:
+            os.makedirs(self.datadir, exist_ok = True)
+            fd = os.open(self.lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                with _file_lock(fd):
+                    return self._refresh(started, verbose)
+            finally:
+                os.close(fd)
+
+
+    def _refresh(self, started, verbose):
+        if os.path.exists(self.statepath) and os.path.getmtime(self.statepath) > started \
+                and os.path.exists(self.tablepath):
+            # Refreshed by another process or thread while this one waited for the lock.
+            if self.table is None or os.path.getmtime(self.tablepath) != self._loaded_mtime:
+                self._load()
+            self._checked = time()
+            return False
+        validators = {}
+        if os.path.exists(self.statepath):
+            with open(self.statepath, 'r') as f:
+                validators = json.load(f)
+        modified, validators = fetch_if_modified(config.sec_tickers_url, self.jsonpath, validators, \
+            limiter = self.limiter, user_agent = self.user_agent, verbose = verbose, session = self.session)
+        rebuilt = modified or not os.path.exists(self.tablepath)
+        if rebuilt:
+            table = _read_company_tickers(self.jsonpath)
+            tmppath = '{}.{}.tmp'.format(self.tablepath, os.getpid())
+            table.to_parquet(tmppath, index = False)
+            os.replace(tmppath, self.tablepath)
+        # Rewriting the state file marks the table as fresh, so that neither this nor other processes 
+        # ask again before max_age has passed.
+        tmppath = '{}.{}.tmp'.format(self.statepath, os.getpid())
+        with open(tmppath, 'w') as f:
+            json.dump(validators, f)
+        os.replace(tmppath, self.statepath)
+        if rebuilt or self.table is None:
+            self._load()
+        self._checked = time()
+        return modified
+
+
+    def _index(self):
+        # Lookup structures are built on first use from the loaded table and returned as a snapshot.
+        self._ensure()
+        with self._lock:
+            if self._snapshot is None:
+                t = self.table
+                ciks = t['cik'].tolist()
+                tickers = t['ticker'].tolist()
+                cik_tickers = {}
+                for cik, ticker in zip(ciks, tickers):
+                    cik_tickers.setdefault(cik, []).append(ticker)
+                primary = t.drop_duplicates('cik', keep = 'first')
+                order = np.argsort(primary['name'].str.upper().to_numpy(), kind = 'stable')
+                names = primary.iloc[order].reset_index(drop = True)
+                self._snapshot = _lookup_index(dict(zip(tickers, ciks)), cik_tickers, \
+                    dict(zip(primary['cik'].tolist(), primary['name'])), primary.set_index('cik')['ticker'], \
+                    names, names['name'].str.upper().to_numpy())
+            return self._snapshot
+
+
+    def cik(self, ticker):
+        """
+        Returns the CIK of a ticker, or None if the ticker is not known.
+        """
+        return self._index().ticker_cik.get(str(ticker).upper())
+
+
+    def tickers(self, cik):
+        """
+        Returns the list of tickers of a CIK, primary ticker first.  CIKs may be given as integers or as
+        zero-padded strings.
+        """
+        return list(self._index().cik_tickers.get(int(cik), []))
+
+
+    def name(self, cik):
+        """
+        Returns the company name of a CIK, or None if the CIK has no listed ticker.
+        """
+        return self._index().cik_name.get(int(cik))
+
+
+    def search(self, prefix, limit = 20):
+        """
+        Returns a dataframe with the CIK, primary ticker and name of companies whose names start with
+        prefix (case insensitive), in alphabetical order.  At most limit rows are returned (None for all).
+        """
+        index = self._index()
+        prefix = prefix.upper()
+        start = np.searchsorted(index.names_upper, prefix, side = 'left')
+        # Names starting with prefix sort before prefix followed by the highest code point.
+        end = np.searchsorted(index.names_upper, prefix + '\U0010ffff', side = 'left')
+        if limit:
+            end = min(end, start + limit)
+        return index.names.iloc[start:end].reset_index(drop = True)
+
+
+    def attach_tickers(self, df, cik_column = 'CIK', column = 'Ticker'):
+        """
+        Returns a copy of df with the primary ticker of each row's CIK added as a new column, with one
+        vectorized join.  Rows whose CIK has no listed ticker get a missing value.
+        """
+        primary = self._index().primary
+        result = df.copy()
+        result[column] = pd.to_numeric(result[cik_column], errors = 'coerce').map(primary)
+        return result
+
+
+    def dicts(self):
+        """
+        Returns (ticker_dict, name_dict) mapping zero-padded 10 digit CIK strings to a ticker and company
+        name, as get_ticker_name_dicts() always has.
+        """
+        self._ensure()
+        with self._lock:
+            if self._dicts is None:
+                ciks = [str(x).zfill(10) for x in self.table['cik'].tolist()]
+                self._dicts = (dict(zip(ciks, self.table['ticker'])), dict(zip(ciks, self.table['name'])))
+            return self._dicts
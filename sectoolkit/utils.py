@@ -1,98 +1,335 @@
-import urllib.request
 import pathlib
+import urllib.error
+import zlib
 import re
 import os
+import email.utils
+import hashlib
+import functools
 import xmltodict
-import pandas as pd
 from time import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from .config import default_datadir, sec_base_url, binary_file_types, sec_rate_limit, sec_rate_interval
+from .config import default_datadir, sec_base_url, binary_file_types, sec_rate_limit, sec_rate_interval, \
+	sec_rate_burst, sec_rate_shared, sec_rate_adaptive, sec_max_workers, download_chunk_size
 from .limiter import rate_limiter
+from .session import sec_session
+from .cache import store_file, read_cached, cached_path
+from .retry import default_policy, describe_failure
+from . import config
+from . import metrics
+from . import profiling
 
-# Instantiate rate_limiter
-seclimiter = rate_limiter(sec_rate_interval, sec_rate_limit)
+# Instantiate rate_limiter.  In shared mode every thread and process on this host draws on one budget, and 
+# in adaptive mode they all slow down when the SEC signals that requests come in too fast.
+seclimiter = rate_limiter(sec_rate_interval, sec_rate_limit, burst = sec_rate_burst, shared = sec_rate_shared, \
+	adaptive = sec_rate_adaptive)
+
+# Default HTTP session, used when callers do not supply their own.
+secsession = sec_session()
 
 
 def timer(method):
+    """
+    Decorator for idx stages.  The run time of each call is recorded in the stage_seconds metric under 
+    the method name, and printed if the call was made with verbose = True.  Calls are profiled as a 
+    stage of the same name while profiling is enabled.
+    """
+    @functools.wraps(method)
     def wrapper(*args, **kwargs):
         start_time = time()
-        result = method(*args, **kwargs)
+        with profiling.stage(method.__name__):
+            result = method(*args, **kwargs)
         end_time = time()
         elapsed = end_time - start_time
-        if elapsed < 60:
-            print('Time elapsed: ', elapsed, ' seconds.')
-        else:
-            print('Time elapsed: ', elapsed/60, ' minutes.')
+        metrics.observe('stage_seconds', elapsed, stage = method.__name__)
+        if kwargs.get('verbose'):
+            if elapsed < 60:
+                print('Time elapsed: ', elapsed, ' seconds.')
+            else:
+                print('Time elapsed: ', elapsed/60, ' minutes.')
         return result
     return wrapper
 
 
-def fetch_sec_file(url, localpath, limiter = seclimiter, user_agent = None, content = False, verbose = False):
+def _expected_length(response):
+	# Number of body bytes the server announced, from Content-Length or, for a 206 response without it, 
+	# from Content-Range.  None if the response does not say.
+	length = response.headers.get('Content-Length')
+	if length and length.strip().isdigit():
+		return int(length)
+	match = re.match(r'bytes (\d+)-(\d+)/', response.headers.get('Content-Range') or '')
+	if match:
+		return int(match.group(2)) - int(match.group(1)) + 1
+	return None
+
+
+def _stream_to_file(response, f, decode = True, chunk_size = download_chunk_size, hasher = None):
+	"""
+	Copies a response body to an open binary file in chunks, undoing any gzip or deflate transfer 
+	encoding on the fly if decode is True.  If a hashlib hasher is supplied, it is updated with the bytes 
+	written.  Returns the number of bytes written.  Raises EOFError if the connection closed before the 
+	whole body arrived; the bytes received so far are left in f, so a retry can resume from them.
+	"""
+	encoding = (response.headers.get('Content-Encoding') or '').lower()
+	decoder = None
+	if decode and encoding in ('gzip', 'x-gzip', 'deflate'):
+		# wbits = 32 + MAX_WBITS detects gzip and zlib headers automatically.
+		decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+	expected = _expected_length(response)
+	received = 0
+	written = 0
+	while True:
+		chunk = response.read(chunk_size)
+		if not chunk:
+			break
+		received += len(chunk)
+		if decoder:
+			chunk = decoder.decompress(chunk)
+		f.write(chunk)
+		if hasher:
+			hasher.update(chunk)
+		written += len(chunk)
+	# http.client returns an empty read instead of raising when the connection closes early.
+	if expected is not None and received < expected:
+		raise EOFError('Response ended after {} of {} bytes.'.format(received, expected))
+	if decoder:
+		if not decoder.eof:
+			raise EOFError('Compressed response ended before the end of the stream.')
+		tail = decoder.flush()
+		f.write(tail)
+		if hasher:
+			hasher.update(tail)
+		written += len(tail)
+	return written
+
+
+def _download_sec_file(url, localpath, limiter = seclimiter, user_agent = None, content = False, verbose = False, \
+	session = None, manifest = None, retry = None):
+	"""
+	Downloads a single file from the SEC website to localpath, raising an exception on failure.  Rate 
+	limiting responses, transient server errors and network errors are retried according to the 
+	retry_policy retry (default = retry.default_policy, see retry.py), and throttling responses slow down 
+	the rate limiter if it is adaptive.  The exception of a failed download carries the number of attempts 
+	made in its attempts attribute.
+
+	The response is streamed to a temporary localpath + '.part' file, which is moved to localpath only 
+	once the download is complete, so an interrupted download never leaves a truncated file in the cache.  
+	Text files are compressed on the way into the cache if config.cache_compression is set.  
+	If a partial file is left over from an earlier attempt, the download resumes where it stopped with an 
+	HTTP Range request.  Fresh downloads ask for gzip/deflate transfer compression.  If a cache_manifest 
+	is supplied, the file is recorded in it with the SHA-256 checksum of its uncompressed content.
+	"""
+	policy = retry if retry != None else default_policy
+	return policy.call(_download_attempt, url, localpath, limiter = limiter, user_agent = user_agent, \
+		content = content, verbose = verbose, session = session, manifest = manifest)
+
+
+def _download_attempt(url, localpath, limiter = seclimiter, user_agent = None, content = False, verbose = False, \
+	session = None, manifest = None):
+	# A single attempt of _download_sec_file().
+	if session == None:
+		session = secsession
 		
-	# Setup request headers as required by SEC
-	req = urllib.request.Request(url)
+	# Setup request headers as required by SEC.  Headers set on the session are sent automatically.
+	headers = {}
 	if user_agent != None:
-		req.add_header("User-Agent", user_agent)
-	else:
+		headers["User-Agent"] = user_agent
+	elif 'User-Agent' not in session.headers:
 		"The SEC requires a User-Agent definition of the form <Company Name admin@company.com>"
-	# Restore gzip header after decode on read issue has been resolved
-	# req.add_header("Accept-Encoding", "gzip, deflate")
-	req.add_header("Host", "www.sec.gov")
 	
 	# Make sure that the directory path exists
 	path = pathlib.Path(localpath)
 	path.parent.mkdir(parents=True, exist_ok=True)
+
+	# Compressed file types are stored exactly as served, without any transfer decoding.
+	binary = url.split('.')[-1] in binary_file_types
+	partpath = localpath + '.part'
+	offset = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+	if offset > 0:
+		# Byte offsets refer to the uncompressed file, so resumed downloads are not transfer-compressed.
+		headers["Range"] = "bytes=%d-" % offset
+	elif not binary:
+		headers["Accept-Encoding"] = "gzip, deflate"
 	
+	if limiter != None:
+		limiter.allow(verbose = verbose)
 	try:
-		if limiter.allow(verbose = verbose) or limiter == None:
-			with urllib.request.urlopen(req) as response:
-				data = response.read()
-				if url.split('.')[-1] in binary_file_types:
-					with open(localpath, 'wb') as f:
-						f.write(data)
-				else:
-					with open(localpath, 'w') as f:
-						data = data.decode('latin-1')
-						f.write(data) 
-		  
-		if verbose:
-			print(localpath)
-		if content:
-			return localpath, data
-		else:
-			return localpath
+		response = session.request(url, headers = headers)
+	except urllib.error.HTTPError as err:
+		if err.code != 416 or offset == 0:
+			raise
+		# The partial file does not match the file on the server, so start over.
+		os.remove(partpath)
+		return _download_attempt(url, localpath, limiter = limiter, user_agent = user_agent, \
+			content = content, verbose = verbose, session = session, manifest = manifest)
+	hasher = hashlib.sha256() if manifest != None else None
+	with response:
+		# A 200 response means that the server ignored the Range header and sent the whole file.
+		mode = 'ab' if response.status == 206 else 'wb'
+		if hasher and mode == 'ab':
+			with open(partpath, 'rb') as f:
+				for chunk in iter(lambda: f.read(download_chunk_size), b''):
+					hasher.update(chunk)
+		with open(partpath, mode) as f:
+			written = _stream_to_file(response, f, decode = not binary, hasher = hasher)
+	metrics.inc('download_bytes_total', written)
+	metrics.inc('downloads_total')
+	# Move the completed file into the cache, compressing text files if a compressed cache is configured.
+	store_file(partpath, localpath, compression = None if binary else config.cache_compression)
+	if manifest != None:
+		manifest.record(localpath, checksum = hasher.hexdigest(), url = url)
+	  
+	if verbose:
+		print(localpath)
+	if content:
+		return localpath, read_cached(localpath, binary = binary)
+	else:
+		return localpath
+
+
+def _record_failure(url, localpath, inst, manifest = None):
+	# Failed downloads are listed in the manifest with their URL, error, HTTP status and number of attempts, 
+	# so that they can be fetched again later (see cache_manifest.failures()).
+	failure = describe_failure(inst)
+	metrics.inc('download_failures_total', error = type(inst).__name__)
+	if manifest != None:
+		manifest.record(localpath, status = 'failed', url = url, error = failure['error'], \
+			http_status = failure['http_status'], attempts = failure['attempts'])
+	return failure
+
+
+def fetch_sec_file(url, localpath, limiter = seclimiter, user_agent = None, content = False, verbose = False, \
+	session = None, manifest = None, retry = None):
+		
+	try:
+		return _download_sec_file(url, localpath, limiter = limiter, user_agent = user_agent, \
+			content = content, verbose = verbose, session = session, manifest = manifest, retry = retry)
 				
 	except Exception as inst:
+		_record_failure(url, localpath, inst, manifest = manifest)
 		print(url)
 		print(localpath)
 		print(inst)          # the exception instance
 		print(inst.args)     # arguments stored in .args
 
 
-# Read locally cached CIK, ticker and company name file, or fetch it from the SEC website.
-def get_ticker_name_dicts(datadir = default_datadir):
-	company_tickers_filename = datadir + os.sep + 'company_tickers.p'
-	# Check whether the local file exists and if so when it was last modified
-	if os.path.exists(company_tickers_filename):
-		mtime = os.path.getmtime(company_tickers_filename)
-	else:
-		mtime = 0.0
-	# Only use the local version of the file if it is less than a day old
-	if (time() - mtime)/(60*60*24) < 1.0:
-		#Read the local copy of the file
-		t = pd.read_pickle(company_tickers_filename)
+def fetch_if_modified(url, localpath, validators = None, limiter = seclimiter, user_agent = None, verbose = False, \
+	session = None, manifest = None, retry = None):
+	"""
+	Downloads a file from the SEC website only if it has changed since the locally cached copy was 
+	fetched, using a conditional GET.  validators is the dictionary returned by the previous call for the 
+	same file, holding its ETag and Last-Modified response headers; without it, the modification time of 
+	the cached file is sent instead.  Unchanged files cost a single 304 response with no body.  Raises an 
+	exception on failure.
+
+	Returns a tuple (modified, validators), where modified is True if a new version was downloaded and 
+	validators are the values to pass in on the next call.  A new version is recorded in the 
+	cache_manifest, if one is supplied.  Failed requests are retried as in _download_sec_file().
+	"""
+	policy = retry if retry != None else default_policy
+	return policy.call(_fetch_if_modified_attempt, url, localpath, validators, limiter = limiter, \
+		user_agent = user_agent, verbose = verbose, session = session, manifest = manifest)
+
+
+def _fetch_if_modified_attempt(url, localpath, validators = None, limiter = seclimiter, user_agent = None, \
+	verbose = False, session = None, manifest = None):
+	# A single attempt of fetch_if_modified().
+	if session == None:
+		session = secsession
+	headers = {}
+	if user_agent != None:
+		headers["User-Agent"] = user_agent
+	path = cached_path(localpath)
+	validators = dict(validators) if validators else {}
+	if path is not None:
+		if validators.get('etag'):
+			headers["If-None-Match"] = validators['etag']
+		headers["If-Modified-Since"] = validators.get('last_modified') or \
+			email.utils.formatdate(os.path.getmtime(path), usegmt = True)
 	else:
-		# Retrieve a fresh copy of the file
-		t = pd.read_json('https://www.sec.gov/files/company_tickers.json').transpose()
-		t['cik'] = t['cik_str'].apply(lambda x: str(x).zfill(10))
-		# Make sure that the local directory path exists
-		path = pathlib.Path(company_tickers_filename)
-		path.parent.mkdir(parents=True, exist_ok=True)
-		# Save a local copy of the file
-		t.to_pickle(company_tickers_filename)
-
-	# Setup cik->ticker and cik->company name dictionaries
-	ticker_dict = dict(zip(t.cik,t.ticker))
-	name_dict = dict(zip(t.cik,t.title))
-
-	return ticker_dict, name_dict
\ No newline at end of file
+		validators = {}
+	binary = url.split('.')[-1] in binary_file_types
+	if not binary:
+		headers["Accept-Encoding"] = "gzip, deflate"
+
+	if limiter != None:
+		limiter.allow(verbose = verbose)
+	response = session.request(url, headers = headers)
+	with response:
+		if response.status == 304:
+			response.read()
+			return False, validators
+		pathlib.Path(localpath).parent.mkdir(parents=True, exist_ok=True)
+		# Conditional fetches are not resumed, so each process downloads to a file of its own and processes
+		# refreshing the same file at once cannot write into each other's download.
+		partpath = '{}.{}.part'.format(localpath, os.getpid())
+		hasher = hashlib.sha256() if manifest != None else None
+		try:
+			with open(partpath, 'wb') as f:
+				written = _stream_to_file(response, f, decode = not binary, hasher = hasher)
+		except BaseException:
+			if os.path.exists(partpath):
+				os.remove(partpath)
+			raise
+		metrics.inc('download_bytes_total', written)
+		metrics.inc('downloads_total')
+		validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+	store_file(partpath, localpath, compression = None if binary else config.cache_compression)
+	if manifest != None:
+		manifest.record(localpath, checksum = hasher.hexdigest(), url = url)
+	if verbose:
+		print(localpath)
+	return True, validators
+
+def fetch_sec_files(items, limiter = seclimiter, user_agent = None, max_workers = sec_max_workers, \
+	verbose = False, session = None, manifest = None, retry = None):
+	"""
+	Downloads many files from the SEC website concurrently.  Up to max_workers requests are kept in 
+	flight at once, all drawing on the same rate limiter, so the SEC rate limit is respected while 
+	request round trips overlap.
+
+	Arguments:
+
+	items 		: 	iterable of (url, localpath) tuples
+	limiter 	: 	(defaults to the shared package rate limiter)
+	user_agent 	: 	(default = None) user agent string sent with every request
+	max_workers : 	(default = config.sec_max_workers) maximum number of concurrent requests
+	verbose 	: 	(default = False)
+	session 	: 	(default = None) sec_session whose pooled keep-alive connections are reused across 
+					requests; the package default session is used if none is supplied
+	manifest 	: 	(default = None) cache_manifest in which fetched files and failures are recorded
+	retry 		: 	(default = None uses retry.default_policy) retry_policy applied to each file
+
+	Returns a tuple (fetched, failed), where fetched is a list of local paths of files that were 
+	downloaded and failed is a list of (url, localpath, exception) tuples for files that were not, after 
+	all retries.  retry.describe_failure(exception) tells whether a failure is worth trying again later.
+	"""
+	fetched = []
+	failed = []
+	with ThreadPoolExecutor(max_workers = max_workers) as executor:
+		futures = {executor.submit(_download_sec_file, url, localpath, limiter = limiter, \
+			user_agent = user_agent, verbose = verbose, session = session, manifest = manifest, retry = retry): \
+			(url, localpath) for url, localpath in items}
+		for future in as_completed(futures):
+			url, localpath = futures[future]
+			try:
+				fetched.append(future.result())
+			except Exception as inst:
+				failed.append((url, localpath, inst))
+				_record_failure(url, localpath, inst, manifest = manifest)
+	if verbose and len(failed) > 0:
+		print('Failed to fetch {} files.'.format(len(failed)))
+	return fetched, failed
+
+
+def get_ticker_name_dicts(datadir = default_datadir):
+	"""
+	Returns (ticker_dict, name_dict) mapping zero-padded CIK strings to tickers and company names.  The 
+	dictionaries are built once per process from the shared ticker table in the data directory, which is 
+	refreshed in the background when it is more than a day old.  See tickers.ticker_lookup for ticker to 
+	CIK lookups and name search.
+	"""
+	# Imported here because the tickers module builds on the download functions in this module.
+	from .tickers import get_ticker_lookup
+	return get_ticker_lookup(datadir).dicts()
@@ -23,9 +23,10 @@ setup(
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.7",
     ],
-    packages=find_packages(exclude=("tests",)),
+    packages=find_packages(exclude=("tests", "benchmarks", "benchmarks.*")),
     include_package_data=True,
-    install_requires=["bs4", "numpy", "pandas", "xmltodict", "tqdm"],
+    install_requires=["bs4", "numpy", "pandas", "pyarrow", "xmltodict", "tqdm"],
+    extras_require={"zstd": ["zstandard"]},
     
 
     # entry_points={
@@ -0,0 +1,123 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.error
+import http.server
+
+from sectoolkit.limiter import rate_limiter
+from sectoolkit.session import sec_session
+from sectoolkit.retry import retry_policy
+from sectoolkit.utils import fetch_sec_files
+from sectoolkit.cache import open_cached
+
+
+class _mirror_handler(http.server.BaseHTTPRequestHandler):
+
+    # Serves /ok/<name> with a small text body after a short delay, so that requests overlap, and 404 for
+    # anything else.  Start times and the number of requests in flight are recorded on the server.
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.started.append(time.monotonic())
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            if self.path.startswith('/ok/'):
+                body = 'file {}\n'.format(self.path[4:]).encode()
+                self.send_response(200)
+            else:
+                body = b'not found'
+                self.send_response(404)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class fetch_sec_files_test(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _mirror_handler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.started = []
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+        self.server.delay = 0.2
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.base = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+        self.datadir = tempfile.mkdtemp()
+        self.session = sec_session()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.datadir, ignore_errors = True)
+
+    def _items(self, names):
+        return [(self.base + name, os.path.join(self.datadir, name.replace('/', '_') + '.txt')) for name in names]
+
+    def test_concurrent_requests(self):
+        items = self._items(['ok/{}'.format(i) for i in range(16)])
+        limiter = rate_limiter(1, 1000, burst = 1000)
+        start = time.monotonic()
+        fetched, failed = fetch_sec_files(items, limiter = limiter, max_workers = 8, session = self.session)
+        elapsed = time.monotonic() - start
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(fetched), sorted(x[1] for x in items))
+        self.assertGreater(self.server.max_in_flight, 1)
+        self.assertLessEqual(self.server.max_in_flight, 8)
+        # 16 requests of 0.2 seconds take 3.2 seconds one after the other.
+        self.assertLess(elapsed, 2.0)
+        for url, localpath in items:
+            with open_cached(localpath, 'r') as f:
+                self.assertEqual(f.read(), 'file {}\n'.format(url.split('/')[-1]))
+
+    def test_failures_are_reported_per_item(self):
+        items = self._items(['ok/1', 'missing/2', 'ok/3', 'missing/4'])
+        limiter = rate_limiter(1, 1000, burst = 1000)
+        fetched, failed = fetch_sec_files(items, limiter = limiter, max_workers = 4, session = self.session, \
+                                          retry = retry_policy(max_retries = 0))
+        self.assertEqual(sorted(fetched), sorted([items[0][1], items[2][1]]))
+        self.assertEqual(sorted(x[0] for x in failed), sorted([items[1][0], items[3][0]]))
+        for url, localpath, inst in failed:
+            self.assertIsInstance(inst, urllib.error.HTTPError)
+            self.assertEqual(inst.code, 404)
+            self.assertFalse(os.path.exists(localpath))
+
+    def test_rate_limiter_budget(self):
+        # 10 requests per second with a burst of 2: any one second window admits at most 11 requests,
+        # however many workers are waiting.
+        interval, limit, burst = 1.0, 10, 2
+        self.server.delay = 0.05
+        items = self._items(['ok/{}'.format(i) for i in range(25)])
+        limiter = rate_limiter(interval, limit, burst = burst)
+        start = time.monotonic()
+        fetched, failed = fetch_sec_files(items, limiter = limiter, max_workers = 8, session = self.session)
+        elapsed = time.monotonic() - start
+        self.assertEqual(failed, [])
+        self.assertEqual(len(fetched), 25)
+        started = sorted(self.server.started)
+        # Allow for the scheduling delay between taking a token and the request reaching the server.
+        slack = 0.05
+        for i, t in enumerate(started):
+            in_window = sum(1 for x in started[i:] if x < t + interval - slack)
+            self.assertLessEqual(in_window, burst + limit - 1)
+        # The first burst requests go out at once, the rest at limit / interval per second.
+        self.assertGreaterEqual(elapsed, (25 - burst) * interval / limit - slack)
+
+
+if __name__ == '__main__':
+    unittest.main()